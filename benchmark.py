@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import platform
+import threading
+import subprocess
+import contextlib
+import importlib.util
+from PIL import Image, ImageDraw, ImageFont
+import fake_gemini
+import telemetry
+from gemini_engine import BASE_URL_ENV
+
+# Offline throughput benchmark: a synthetic corpus, the real scripts, a local Gemini stand-in.
+#
+#   python benchmark.py                                  scripts one after the other (process_project.py phases,
+#                                                        generate_overlays.py, generate_html.py, the OCR script,
+#                                                        repair_json.py)
+#   python benchmark.py --mode pipeline                  run_pipeline.py instead
+#   python benchmark.py --latency 4 --quota-rpm 10 --error-rate 0.05
+#   python benchmark.py --compare benchmark_results/a.json benchmark_results/b.json
+#
+# The corpus is BOOKS multi-page PDFs of office tables at IPG scan size, drawn with PIL and kept
+# in BENCH_DIR between runs (same settings, same PDFs), so two versions of the code are measured
+# on the same input. Every run works in a fresh folder with its own processed_data, llm_cache and
+# keys.txt, and the scripts are pointed at fake_gemini.py through GEMINI_BASE_URL - no quota is used.
+#
+# The report (RESULTS_DIR/<label>-<time>.json) has, per stage and in total: seconds, pages/s, CPU
+# seconds, peak RSS, and the API requests by kind and status with calls per page, plus the run's
+# telemetry.py summary (p50/p95 per stage and request kind, slowest pages). The scripts' own
+# output goes to run.log in the run folder.
+
+# --- CONFIGURATION ---
+BENCH_DIR = "benchmark_runs"
+RESULTS_DIR = "benchmark_results"
+COLLECTION = "IPG"
+BOOKS = 2
+PAGES_PER_BOOK = 24
+PAGE_SIZE = (1650, 2550)  # px: foolscap scanned at 200 dpi, like the IPG PDFs
+SCAN_DPI = 200
+ROTATED_SHARE = 0.05      # pages scanned upside down, for the orientation audit
+KEYS = 2
+KEY_RPM = 600             # what keys.txt claims; the stand-in's --quota-rpm decides what it allows
+KEY_RPD = 100000
+SEED = 1859
+
+STAGES = ["render", "analyse", "tiles", "index", "coords", "html", "text", "repair"]
+
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+try:
+    import resource # not on Windows
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+# --- corpus ---
+def corpus_settings(books, pages):
+    return {"collection": COLLECTION, "books": books, "pages": pages, "size": PAGE_SIZE, "dpi": SCAN_DPI,
+            "rotated": ROTATED_SHARE, "seed": SEED}
+
+def draw_page(rng, number):
+    img = Image.new("L", PAGE_SIZE, 246)
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=PAGE_SIZE[0] // 48)
+    title = ImageFont.load_default(size=PAGE_SIZE[0] // 32)
+    width, height = PAGE_SIZE
+    margin = width // 12
+    draw.text((width // 2, margin), "LIST OF POST OFFICES", font=title, fill=20, anchor="mt")
+    columns = [margin, margin + width * 45 // 100, margin + width * 72 // 100, width - margin]
+    row_height = font.size * 2
+    top = margin + title.size * 3
+    rows = (height - top - margin) // row_height
+    for i in range(rows + 1):
+        draw.line([(columns[0], top + i * row_height), (columns[-1], top + i * row_height)], fill=60, width=2)
+    for x in columns:
+        draw.line([(x, top), (x, top + rows * row_height)], fill=60, width=2)
+    for i in range(rows):
+        cells = ["Name of Office", "District", "Miles"] if i == 0 else \
+                [rng.choice(fake_gemini.OFFICES), rng.choice(fake_gemini.DISTRICTS), str(rng.randint(1, 300))]
+        for x, cell in zip(columns, cells):
+            draw.text((x + 12, top + i * row_height + row_height // 4), cell, font=font, fill=25)
+    draw.text((width // 2, height - margin // 2), str(number), font=font, fill=40, anchor="mb")
+    # Paper grain, so the JPEGs compress like scans rather than like drawings
+    img = Image.blend(img, Image.effect_noise(PAGE_SIZE, 40), 0.06)
+    return img.rotate(180) if rng.random() < ROTATED_SHARE else img
+
+def make_corpus(books, pages):
+    """Writes (or reuses) the synthetic PDFs. Returns (folder holding the collection, total MB)."""
+    settings = corpus_settings(books, pages)
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+    corpus_dir = os.path.join(BENCH_DIR, f"corpus-{digest}")
+    pdf_dir = os.path.join(corpus_dir, COLLECTION)
+    if not os.path.exists(os.path.join(corpus_dir, "settings.json")):
+        print(f"Drawing a {books} x {pages} page corpus in {corpus_dir}...")
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        os.makedirs(pdf_dir)
+        rng = random.Random(SEED)
+        for b in range(books):
+            imgs = [draw_page(rng, p + 1) for p in range(pages)]
+            imgs[0].save(os.path.join(pdf_dir, f"{COLLECTION}-{1859 + b}.pdf"), "PDF",
+                         resolution=SCAN_DPI, save_all=True, append_images=imgs[1:])
+            print(f"   -> {COLLECTION}-{1859 + b}.pdf")
+        with open(os.path.join(corpus_dir, "settings.json"), "w") as f:
+            json.dump(settings, f)
+    size = sum(os.path.getsize(os.path.join(pdf_dir, f)) for f in os.listdir(pdf_dir))
+    return corpus_dir, size / 2**20
+
+def prepare_run(corpus_dir, label):
+    run_dir = os.path.abspath(os.path.join(BENCH_DIR, f"run-{label}-{time.strftime('%Y%m%d-%H%M%S')}"))
+    os.makedirs(os.path.join(run_dir, COLLECTION))
+    for name in os.listdir(os.path.join(corpus_dir, COLLECTION)):
+        src, dst = os.path.join(corpus_dir, COLLECTION, name), os.path.join(run_dir, COLLECTION, name)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    with open(os.path.join(run_dir, "keys.txt"), "w") as f:
+        for i in range(KEYS):
+            f.write(f"bench-key-{i + 1:06d} {KEY_RPM} {KEY_RPD}\n")
+    return run_dir
+
+# --- measuring ---
+class RssSampler:
+    # Peak resident memory of this process plus its workers while one stage runs
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = 0
+        self.stop = threading.Event()
+
+    def sample(self):
+        me = psutil.Process()
+        while not self.stop.is_set():
+            total = 0
+            for proc in [me] + me.children(recursive=True):
+                try:
+                    total += proc.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, total)
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        if HAS_PSUTIL:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        if HAS_PSUTIL:
+            self.thread.join()
+
+    def peak_mb(self):
+        if HAS_PSUTIL:
+            return round(self.peak / 2**20, 1)
+        if HAS_RESOURCE:
+            # Without psutil: the largest single process so far (Linux reports KB, macOS bytes)
+            unit = 1 if sys.platform == "darwin" else 1024
+            peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            return round(peak * unit / 2**20, 1)
+        return None
+
+def api_delta(before, after):
+    delta = {"requests": after["requests"] - before["requests"],
+             "bytes_in": after["bytes_in"] - before["bytes_in"], "bytes_out": after["bytes_out"] - before["bytes_out"]}
+    for field in ("status", "kinds", "keys"):
+        delta[field] = {k: v - before[field].get(k, 0) for k, v in after[field].items() if v - before[field].get(k, 0)}
+    return delta
+
+def measure(name, run, pages, server, log):
+    print(f"   {name:<8}", end="", flush=True)
+    before = server.snapshot()
+    cpu = os.times()
+    started = time.perf_counter()
+    error = None
+    with RssSampler() as rss, contextlib.redirect_stdout(log):
+        print(f"\n===== {name} =====")
+        try:
+            with telemetry.phase(name):
+                run()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"BENCHMARK: stage failed: {error}")
+    seconds = time.perf_counter() - started
+    cpu_end = os.times()
+    api = api_delta(before, server.snapshot())
+    result = {"seconds": round(seconds, 3), "pages_per_s": round(pages / seconds, 3) if seconds else None,
+              "cpu_seconds": round(sum(cpu_end[:4]) - sum(cpu[:4]), 2), "peak_rss_mb": rss.peak_mb(),
+              "api": api, "api_calls_per_page": round(api["requests"] / pages, 3) if pages else None, "error": error}
+    print(f"{seconds:8.1f}s  {result['pages_per_s'] or 0:7.2f} pages/s  {api['requests']:5d} calls" + (f"  FAILED: {error}" if error else ""))
+    return result
+
+def load_script(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def stage_runs(mode, repo_dir):
+    # [(stage, callable)] in the order a normal run goes through them
+    import process_project as pp
+    import tiles
+    if mode == "pipeline":
+        import run_pipeline
+        return [("pipeline", run_pipeline.run_pipeline), ("index", pp.build_index)]
+
+    import generate_overlays
+    import generate_html
+    import repair_json
+    ocr = load_script(os.path.join(repo_dir, "run_gemini_ocr_v2.py.py"), "run_gemini_ocr_v2")
+    # The single-key scripts take their key from the config block rather than keys.txt
+    for script in (ocr, repair_json):
+        script.API_KEY, script.API_RPM, script.API_RPD = "bench-key-000001", KEY_RPM, KEY_RPD
+
+    def analyse():
+        if pp.HAS_TESSERACT:
+            pp.analyse_pages()
+        else:
+            print("pytesseract not installed - nothing to analyse.")
+
+    runs = {
+        "render": lambda: pp.render_new_pdfs(os.getcwd(), pp.EXCLUDE_DIRS),
+        "analyse": analyse,
+        "tiles": tiles.generate_tiles,
+        "index": pp.build_index,
+        "coords": generate_overlays.generate_json_map,
+        "html": generate_html.main,
+        "text": ocr.run_smart_ocr,
+        "repair": repair_json.repair_overlays,
+    }
+    return [(stage, runs[stage]) for stage in STAGES]
+
+def git_commit(repo_dir):
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_benchmark(mode="scripts", books=BOOKS, pages=PAGES_PER_BOOK, label=None, keep=False, **server_options):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    commit = git_commit(repo_dir)
+    label = label or commit or "local"
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    corpus_dir, corpus_mb = make_corpus(books, pages)
+    run_dir = prepare_run(corpus_dir, label)
+    total_pages = books * pages
+
+    server = fake_gemini.start(port=0, **server_options)
+    os.environ[BASE_URL_ENV] = server.url
+    print(f"Benchmark '{label}' ({mode}): {total_pages} pages, Gemini stand-in on {server.url}, working in {run_dir}")
+
+    home = os.getcwd()
+    os.chdir(run_dir) # the scripts' paths (processed_data, keys.txt, llm_cache) are relative
+    os.environ.pop(telemetry.RUN_ENV, None)
+    telemetry_run = telemetry.start("benchmark")
+    started = time.perf_counter()
+    stages = {}
+    try:
+        with open("run.log", "w", encoding="utf-8") as log:
+            for stage, run in stage_runs(mode, repo_dir):
+                stages[stage] = measure(stage, run, total_pages, server, log)
+    finally:
+        telemetry.stop()
+        os.chdir(home)
+        server.shutdown()
+        del os.environ[BASE_URL_ENV]
+    seconds = time.perf_counter() - started
+
+    api = server.snapshot()
+    report = {
+        "label": label, "commit": commit, "mode": mode, "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+        "corpus": {**corpus_settings(books, pages), "pdf_mb": round(corpus_mb, 1)},
+        "server": {"latency": server.latency, "jitter": server.jitter, "error_rate": server.error_rate,
+                   "malformed_rate": server.malformed_rate, "quota_rpm": server.quota_rpm},
+        "stages": stages,
+        "telemetry": telemetry.summarise(telemetry.load_run(telemetry_run)) if telemetry_run else None,
+        "total": {"seconds": round(seconds, 3), "pages": total_pages, "pages_per_s": round(total_pages / seconds, 3),
+                  "peak_rss_mb": max((s["peak_rss_mb"] or 0 for s in stages.values()), default=None),
+                  "api": api, "api_calls_per_page": round(api["requests"] / total_pages, 3),
+                  "failed_stages": [name for name, s in stages.items() if s["error"]]},
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = os.path.join(RESULTS_DIR, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=1)
+    if not keep:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    t = report["total"]
+    print(f"Done in {t['seconds']:.1f}s: {t['pages_per_s']:.2f} pages/s, {t['api_calls_per_page']:.2f} API calls per page, "
+          f"peak RSS {t['peak_rss_mb']} MB. Report: {out_path}")
+    return report
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def change(a, b):
+        return f"{(b - a) / a * 100:+6.1f}%" if a and b is not None else "     -"
+
+    print(f"{'':<10}{old['label']:>24}{new['label']:>24}")
+    for stage in list(old["stages"]) + [s for s in new["stages"] if s not in old["stages"]] + ["total"]:
+        a = old["total"] if stage == "total" else old["stages"].get(stage)
+        b = new["total"] if stage == "total" else new["stages"].get(stage)
+        if not a or not b:
+            print(f"{stage:<10}{'only in one run':>48}")
+            continue
+        print(f"{stage:<10}{a['seconds']:>14.1f}s{b['seconds']:>23.1f}s  {change(a['seconds'], b['seconds'])}"
+              f"   calls/page {a['api_calls_per_page']} -> {b['api_calls_per_page']}"
+              f"   RSS {a['peak_rss_mb']} -> {b['peak_rss_mb']} MB")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline on a synthetic corpus")
+    parser.add_argument("--mode", choices=["scripts", "pipeline"], default="scripts")
+    parser.add_argument("--books", type=int, default=BOOKS)
+    parser.add_argument("--pages", type=int, default=PAGES_PER_BOOK, help="Pages per book")
+    parser.add_argument("--label", help="Name for the report (default: the git commit)")
+    parser.add_argument("--keep", action="store_true", help="Keep the run folder (processed_data, run.log)")
+    parser.add_argument("--latency", type=float, default=fake_gemini.LATENCY, help="Seconds per Gemini answer")
+    parser.add_argument("--jitter", type=float, default=fake_gemini.LATENCY_JITTER)
+    parser.add_argument("--error-rate", type=float, default=fake_gemini.ERROR_RATE, help="Share of requests answered 500")
+    parser.add_argument("--malformed-rate", type=float, default=fake_gemini.MALFORMED_RATE, help="Share of garbled answers")
+    parser.add_argument("--quota-rpm", type=int, default=fake_gemini.QUOTA_RPM, help="Requests per key per minute before 429")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two reports instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run_benchmark(args.mode, args.books, args.pages, args.label, args.keep, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, malformed_rate=args.malformed_rate, quota_rpm=args.quota_rpm)
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+from array import array
+
+# Compact per-book store for the Tesseract word boxes: processed_data/<collection>/<book>/coords.bin
+#
+# One file per book instead of one verbose JSON list per page. Geometry is stored as
+# struct-of-arrays, word text goes into a de-duplicated string table, and a per-page offset
+# index says which slice of the arrays belongs to which page. Everything is little-endian.
+#
+#   header    MAGIC, version u16, reserved u16, page_count u32, word_count u32, string_count u32, string_bytes u32
+#   pages     u32[page_count]          page numbers (page_007.json -> 7), ascending
+#   offsets   u32[page_count + 1]      first word of each page; the last entry is word_count
+#   text_id   u32[word_count]          index into the string table
+#   str_offs  u32[string_count + 1]    byte offset of each string in the blob
+#   x, y      int16[word_count]
+#   w, h      uint16[word_count]
+#   strings   utf-8 blob
+#
+# The 4-byte arrays come first so every array starts on its natural alignment.
+#
+# coords.bin is the stored form of the coords stage. The Tesseract workers spool each page to
+# coords/page_NNN.json (one writer per file, no locking); pack_book() merges the spool into the
+# pack and deletes it, once per book at the end of a run. Readers go through load_words(), which
+# sees a spooled page before it is packed. export_page_json() writes per-page JSON on request.
+
+MAGIC = b"IPHC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIII")
+PACK_NAME = "coords.bin"
+
+def page_number(filename):
+    # page_007.json -> 7 (None for anything that is not a page map)
+    stem = filename.rsplit('.', 1)[0]
+    if not stem.startswith("page_") or not stem[5:].isdigit():
+        return None
+    return int(stem[5:])
+
+def _clamp(value, low, high):
+    return max(low, min(high, int(value)))
+
+def write_pack(pack_path, pages):
+    """
+    pages: {page_number: [{"text", "x", "y", "w", "h"}, ...]}
+    Written to a temp file and swapped in, so readers never see a half-written pack.
+    """
+    page_numbers = sorted(pages)
+    offsets = array("I", [0])
+    text_id = array("I")
+    xs, ys = array("h"), array("h")
+    ws, hs = array("H"), array("H")
+    string_index = {}
+    blob = bytearray()
+    str_offs = array("I", [0])
+
+    for page_num in page_numbers:
+        for word in pages[page_num]:
+            text = word.get("text", "")
+            if text not in string_index:
+                string_index[text] = len(string_index)
+                blob += text.encode("utf-8")
+                str_offs.append(len(blob))
+            text_id.append(string_index[text])
+            xs.append(_clamp(word["x"], -32768, 32767))
+            ys.append(_clamp(word["y"], -32768, 32767))
+            ws.append(_clamp(word["w"], 0, 65535))
+            hs.append(_clamp(word["h"], 0, 65535))
+        offsets.append(len(text_id))
+
+    arrays = [array("I", page_numbers), offsets, text_id, str_offs, xs, ys, ws, hs]
+    if sys.byteorder != "little":
+        for arr in arrays:
+            arr.byteswap()
+
+    _forget(pack_path) # an open map would stop the swap on Windows
+    tmp_path = pack_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(page_numbers), len(text_id), len(string_index), len(blob)))
+        for arr in arrays:
+            f.write(arr.tobytes())
+        f.write(blob)
+    os.replace(tmp_path, pack_path)
+
+class CoordsPack:
+    """
+    Read-only view of a coords.bin file.
+    The file is memory-mapped and the arrays are memoryviews straight into the map, so opening a
+    pack costs nothing beyond reading the header. as_numpy() gives the same arrays as numpy views.
+
+        with CoordsPack("processed_data/IPG/1869/coords.bin") as pack:
+            for word in pack.words(12):
+                ...
+    """
+
+    def __init__(self, pack_path):
+        self.path = pack_path
+        self._file = open(pack_path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, page_count, word_count, string_count, string_bytes = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{pack_path} is not a version {VERSION} coords pack")
+
+        self.page_count = page_count
+        self.word_count = word_count
+        view = memoryview(self._map)
+        pos = HEADER.size
+
+        def take(code, count, size):
+            nonlocal pos
+            chunk = view[pos:pos + count * size]
+            pos += count * size
+            if sys.byteorder != "little":
+                swapped = array(code, chunk.tobytes())
+                swapped.byteswap()
+                return memoryview(swapped)
+            return chunk.cast(code)
+
+        self.pages = take("I", page_count, 4)
+        self.offsets = take("I", page_count + 1, 4)
+        self.text_id = take("I", word_count, 4)
+        self.str_offs = take("I", string_count + 1, 4)
+        self.x = take("h", word_count, 2)
+        self.y = take("h", word_count, 2)
+        self.w = take("H", word_count, 2)
+        self.h = take("H", word_count, 2)
+        self.strings = view[pos:pos + string_bytes]
+        self._page_slot = {page_num: slot for slot, page_num in enumerate(self.pages)}
+
+    def close(self):
+        # Drop every view first, otherwise the map refuses to close
+        for name in ("pages", "offsets", "text_id", "str_offs", "x", "y", "w", "h", "strings"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass # numpy views from as_numpy() are still alive; the map is freed along with them
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def page_numbers(self):
+        return list(self.pages)
+
+    def has_page(self, page_num):
+        return page_num in self._page_slot
+
+    def page_range(self, page_num):
+        # (start, end) slice of the word arrays for one page; (0, 0) if the page is not in the pack
+        slot = self._page_slot.get(page_num)
+        if slot is None:
+            return 0, 0
+        return self.offsets[slot], self.offsets[slot + 1]
+
+    def text(self, word_index):
+        string = self.text_id[word_index]
+        return bytes(self.strings[self.str_offs[string]:self.str_offs[string + 1]]).decode("utf-8")
+
+    def words(self, page_num):
+        # Same shape as the per-page coords JSON
+        start, end = self.page_range(page_num)
+        return [{
+            "text": self.text(i),
+            "x": self.x[i],
+            "y": self.y[i],
+            "w": self.w[i],
+            "h": self.h[i]
+        } for i in range(start, end)]
+
+    def as_numpy(self):
+        # Zero-copy numpy views of the geometry (numpy is only needed if you call this)
+        import numpy as np
+        return {
+            "pages": np.frombuffer(self.pages, dtype=np.uint32),
+            "offsets": np.frombuffer(self.offsets, dtype=np.uint32),
+            "text_id": np.frombuffer(self.text_id, dtype=np.uint32),
+            "x": np.frombuffer(self.x, dtype=np.int16),
+            "y": np.frombuffer(self.y, dtype=np.int16),
+            "w": np.frombuffer(self.w, dtype=np.uint16),
+            "h": np.frombuffer(self.h, dtype=np.uint16),
+        }
+
+_packs = {} # pack path -> (mtime, CoordsPack), kept open by load_words() for the life of the process
+
+def _forget(pack_path):
+    cached = _packs.pop(pack_path, None)
+    if cached:
+        cached[1].close()
+
+def _open_pack(pack_path):
+    # (pack, mtime) of a book's pack, reopened only when the file changes; (None, 0) if there is none
+    try:
+        mtime = os.stat(pack_path).st_mtime_ns
+    except OSError:
+        return None, 0
+    cached = _packs.get(pack_path)
+    if cached and cached[0] == mtime:
+        return cached[1], mtime
+    _forget(pack_path)
+    try:
+        pack = CoordsPack(pack_path)
+    except (OSError, ValueError):
+        return None, 0
+    _packs[pack_path] = (mtime, pack)
+    return pack, mtime
+
+def page_words(coords_path):
+    """
+    Word boxes of one page, given its coords/page_NNN.json path, in the same shape as that file.
+    A page map the Tesseract stage has spooled there and that is not packed yet wins; otherwise
+    the page comes from the book's coords.bin. None if neither has the page.
+    Other files in coords/ (the *_clean.json overlays) are plain JSON.
+    """
+    coords_dir, file = os.path.split(coords_path)
+    try:
+        with open(coords_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass # not spooled (or packed and removed a moment ago)
+    page_num = page_number(file) if file.endswith(".json") else None
+    if page_num is not None:
+        pack, _ = _open_pack(os.path.join(os.path.dirname(coords_dir), PACK_NAME))
+        if pack and pack.has_page(page_num):
+            return pack.words(page_num)
+    return None
+
+def load_words(coords_path):
+    # page_words(), with [] for a page that has no word boxes anywhere
+    words = page_words(coords_path)
+    return words if words is not None else []
+
+def words_sha256(words):
+    # Same bytes write_word_boxes() spools, so a page hashes the same before and after packing
+    return hashlib.sha256(json.dumps(words).encode("utf-8")).hexdigest()
+
+def spooled_pages(book_dir):
+    # {page number: path} of the raw page maps in coords/ still waiting to be packed
+    coords_dir = os.path.join(book_dir, "coords")
+    try:
+        files = os.listdir(coords_dir)
+    except OSError:
+        return {}
+    return {page_number(file): os.path.join(coords_dir, file) for file in files
+            if file.endswith(".json") and page_number(file) is not None}
+
+def pack_is_current(book_dir):
+    # Only the raw page maps count; the _clean.json overlays repair_json.py writes next to them do not
+    return not spooled_pages(book_dir)
+
+def pack_book(book_dir):
+    """
+    Merges the spooled coords/page_NNN.json maps into coords.bin and removes them.
+    Returns the page numbers that were merged. *_clean.json files are left to repair_json.py.
+    """
+    pack_path = os.path.join(book_dir, PACK_NAME)
+    spooled = spooled_pages(book_dir)
+    if not spooled:
+        return []
+    pages = {}
+    if os.path.exists(pack_path):
+        with CoordsPack(pack_path) as pack:
+            pages = {page_num: pack.words(page_num) for page_num in pack.page_numbers()}
+    merged = []
+    for page_num, path in spooled.items():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                pages[page_num] = json.load(f)
+            merged.append(page_num)
+        except ValueError:
+            continue # unreadable map - left where it is; it will be regenerated
+    write_pack(pack_path, pages)
+    for page_num in merged:
+        os.remove(spooled[page_num])
+    return sorted(merged)
+
+def export_page_json(book_dir, out_dir=None, overwrite=False):
+    """
+    Writes page_NNN.json for every page in the book's pack, for other tools (the viewer reads the
+    pack itself). Goes to <book>/coords_json unless out_dir is given; never into coords/, where a
+    page map would count as spooled. Existing files are kept unless overwrite is set.
+    """
+    out_dir = out_dir or os.path.join(book_dir, "coords_json")
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    with CoordsPack(os.path.join(book_dir, PACK_NAME)) as pack:
+        for page_num in pack.page_numbers():
+            json_path = os.path.join(out_dir, f"page_{page_num:03d}.json")
+            if os.path.exists(json_path) and not overwrite:
+                continue
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(pack.words(page_num), f)
+            written += 1
+    return written
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or export per-book coords packs")
+    parser.add_argument("command", choices=["pack", "export"])
+    parser.add_argument("book_dir", help="e.g. processed_data/IPG/1869")
+    parser.add_argument("--out", help="export: folder for the page JSON files (default <book>/coords_json)")
+    parser.add_argument("--overwrite", action="store_true", help="export: replace existing page JSON files")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        print(f"Packed {len(pack_book(args.book_dir))} page maps into {os.path.join(args.book_dir, PACK_NAME)}")
+    else:
+        print(f"Exported {export_page_json(args.book_dir, args.out, args.overwrite)} page maps.")
@@ -0,0 +1,226 @@
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import generate_html
+import site_index
+import gazetteer
+from pipeline_state import PipelineState
+from coords_pack import page_words
+
+# Deployable static bundle of the viewer: python export_site.py  ->  site/
+#
+#   site/index.html                          the viewer (same file; it spots site.json and switches mode)
+#   site/site.json                           collections, books and where each book's pack is
+#   site/assets/replica.<hash>.css           CSS_TEMPLATE, once, instead of inlined in every page
+#   site/books/<col>/<book>/book.<hash>.pack the book's HTML fragments and word boxes, plus its index
+#   site/books/<col>/<book>/{images,tiles,thumbs}/...
+#   site/search/...                          search_index.py's shards, as they are
+#   site/gazetteer.json.gz                   gazetteer.py's export, as it is
+#
+# A pack is every page's part gzipped on its own, back to back, then one JSON index:
+#   {"pages": [...pages.json rows...], "tiles": {...}, "v": {page: image version},
+#    "parts": {page: {"html": [offset, length], "coords": [...], "clean": [...]}}}
+# site.json says where the index sits in the pack, so a reader's browser gets a book with one
+# Range request for the index and one per page turn, instead of a file per page; each part is
+# inflated in the browser. Hosts that ignore Range just send the whole pack once.
+#
+# Content-hashed names mean the assets can be cached forever; only site.json and index.html need
+# revalidating. Text files also get .gz (and .br, with the brotli package) next to them for hosts
+# that serve precompressed files. Packs are not precompressed: a Range over Content-Encoding
+# would be a range of the compressed bytes.
+#
+# Books whose site_index version has not changed since the last export are left alone.
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+EXPORT_DIR = "site"
+VIEWER = "index.html"
+HASH_LEN = 10
+STATE_FILE = ".export.json" # what the last export wrote, inside EXPORT_DIR
+MEDIA_FOLDERS = ["images", "tiles", "thumbs"]
+PACK_PARTS = {"html": "html", "coords": "coords", "clean": "clean"} # pack part -> pipeline stage
+PRECOMPRESS = (".html", ".css", ".json")
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LEN]
+
+def gz(data):
+    # mtime=0: same input, same bytes, same hash
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def precompress(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    write_file(path + ".gz", gz(data))
+    if HAS_BROTLI:
+        write_file(path + ".br", brotli.compress(data, quality=11))
+
+def link_or_copy(src, dst):
+    # Hard links cost no space when site/ is on the same drive; a copy otherwise
+    if os.path.exists(dst):
+        if os.path.getsize(dst) == os.path.getsize(src) and os.path.getmtime(dst) >= os.path.getmtime(src):
+            return False
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return True
+
+def sync_folder(src_dir, dst_dir):
+    # Mirrors src_dir into dst_dir (files that are gone upstream are removed). Returns files written.
+    written = 0
+    if not os.path.isdir(src_dir):
+        shutil.rmtree(dst_dir, ignore_errors=True)
+        return 0
+    os.makedirs(dst_dir, exist_ok=True)
+    src_names = set()
+    for entry in os.scandir(src_dir):
+        if entry.name.endswith(".tmp"):
+            continue
+        src_names.add(entry.name)
+        dst = os.path.join(dst_dir, entry.name)
+        if entry.is_dir():
+            written += sync_folder(entry.path, dst)
+        else:
+            written += link_or_copy(entry.path, dst)
+    for entry in os.scandir(dst_dir):
+        if entry.name not in src_names:
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+    return written
+
+def replica_css():
+    # CSS_TEMPLATE without its <style> wrapper
+    return re.sub(r"</?style>", "", generate_html.CSS_TEMPLATE).strip().encode("utf-8") + b"\n"
+
+def build_pack(state, collection, book, book_dir):
+    """Returns (pack bytes, [index offset, index length]) for one book."""
+    with open(os.path.join(book_dir, site_index.BOOK_FILE), "r") as f:
+        manifest = json.load(f)
+    flags = manifest["flags"]
+
+    blob = bytearray()
+    parts, versions = {}, {}
+    for page, page_flags, _, _ in manifest["pages"]:
+        key = (collection, book, page)
+        page_parts = {}
+        for part, stage in PACK_PARTS.items():
+            path = state.path(*key, stage)
+            if part in flags and not page_flags & flags[part]:
+                continue
+            if stage == "coords":
+                words = page_words(path) # from coords.bin
+                if words is None:
+                    continue
+                data = json.dumps(words).encode("utf-8")
+            elif not os.path.exists(path):
+                continue
+            elif part == "html":
+                data = generate_html.html_body(path).encode("utf-8")
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+            packed = gz(data)
+            page_parts[part] = [len(blob), len(packed)]
+            blob += packed
+        if page_parts:
+            parts[str(page)] = page_parts
+        image_hash = state.file_hash(*key, "image")
+        if image_hash:
+            versions[str(page)] = image_hash[:8]
+
+    index = json.dumps({"pages": manifest["pages"], "flags": flags, "tiles": manifest.get("tiles"),
+                        "v": versions, "parts": parts}, separators=(",", ":")).encode("utf-8")
+    return bytes(blob) + index, [len(blob), len(index)]
+
+def export_site(out_dir=EXPORT_DIR, data_dir=DATA_DIR, full=False):
+    site_index.build_index(data_dir)
+    with open(os.path.join(data_dir, site_index.INDEX_FILE), "r") as f:
+        index = json.load(f)
+
+    state_path = os.path.join(out_dir, STATE_FILE)
+    previous = {}
+    if not full and os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            previous = json.load(f)
+    os.makedirs(out_dir, exist_ok=True)
+    state = PipelineState(data_dir)
+
+    # Shared stylesheet
+    css = replica_css()
+    css_name = f"assets/replica.{content_hash(css)}.css"
+    if not os.path.exists(os.path.join(out_dir, css_name)):
+        write_file(os.path.join(out_dir, css_name), css)
+        precompress(os.path.join(out_dir, css_name))
+
+    books, exported, reused, media = {}, {}, 0, 0
+    for collection in sorted(index):
+        for book, entry in sorted(index[collection].items()):
+            book_key = f"{collection}/{book}"
+            book_dir = os.path.join(data_dir, collection, book)
+            out_book = os.path.join(out_dir, "books", collection, book)
+            old = previous.get("books", {}).get(book_key)
+            if old and old["version"] == entry["version"] and os.path.exists(os.path.join(out_dir, old["pack"])):
+                exported[book_key] = old
+                reused += 1
+            else:
+                pack, index_range = build_pack(state, collection, book, book_dir)
+                pack_name = f"books/{collection}/{book}/book.{content_hash(pack)}.pack"
+                write_file(os.path.join(out_dir, pack_name), pack)
+                if old and old["pack"] != pack_name and os.path.exists(os.path.join(out_dir, old["pack"])):
+                    os.remove(os.path.join(out_dir, old["pack"]))
+                for folder in MEDIA_FOLDERS:
+                    media += sync_folder(os.path.join(book_dir, folder), os.path.join(out_book, folder))
+                exported[book_key] = {"version": entry["version"], "pack": pack_name, "index": index_range}
+                print(f"   -> {book_key}: {len(pack) / 1024:.0f} KB pack")
+            books.setdefault(collection, {})[book] = {**entry, "pack": exported[book_key]["pack"],
+                                                      "index": exported[book_key]["index"]}
+    state.close()
+
+    # Books that are no longer in the index
+    for book_key in set(previous.get("books", {})) - set(exported):
+        shutil.rmtree(os.path.join(out_dir, "books", *book_key.split("/")), ignore_errors=True)
+
+    # Search shards are already gzipped and content-versioned by meta.json
+    search_dir = os.path.join(data_dir, "search")
+    if os.path.isdir(search_dir):
+        sync_folder(search_dir, os.path.join(out_dir, "search"))
+    gazetteer_file = os.path.join(data_dir, gazetteer.EXPORT_FILE)
+    if os.path.exists(gazetteer_file):
+        link_or_copy(gazetteer_file, os.path.join(out_dir, gazetteer.EXPORT_FILE))
+
+    write_file(os.path.join(out_dir, "site.json"), json.dumps({"css": css_name, "books": books}, separators=(",", ":")).encode("utf-8"))
+    shutil.copyfile(VIEWER, os.path.join(out_dir, "index.html"))
+    for name in ["site.json", "index.html"]:
+        precompress(os.path.join(out_dir, name))
+    write_file(state_path, json.dumps({"books": exported}, indent=1).encode("utf-8"))
+
+    if not HAS_BROTLI:
+        print("   (brotli package not installed: only .gz copies were written)")
+    print(f"Site exported to {out_dir}/: {len(exported) - reused} books packed, {reused} unchanged, {media} media files copied.")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a deployable static copy of the viewer and its data")
+    parser.add_argument("--out", default=EXPORT_DIR)
+    parser.add_argument("--full", action="store_true", help="Re-pack every book, not just the ones that changed")
+    args = parser.parse_args()
+    export_site(args.out, full=args.full)
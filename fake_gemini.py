@@ -0,0 +1,178 @@
+import re
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Gemini generateContent endpoint, for benchmark.py and offline testing.
+#
+#   python fake_gemini.py --latency 2 --quota-rpm 10
+#   set GEMINI_BASE_URL=http://127.0.0.1:8765   (then run any of the scripts as usual)
+#
+# It answers what the scripts ask for, in the shape they expect: an HTML page with an office
+# table for HTML_PROMPT, the same as Markdown for TEXT_PROMPT, one section per page between
+# "===== PAGE page_NNN =====" lines for batches, and the dirty JSON handed back for repair prompts.
+# The content is made up (seeded by the page name); the image is never looked at.
+#
+# Knobs: latency (with jitter), a share of 500 errors, a share of garbled answers (batch markers
+# dropped, JSON cut short) and a per-key requests-per-minute quota answered with 429 like the
+# real API. Everything it served is counted in `stats` for the benchmark report.
+
+# --- CONFIGURATION ---
+HOST = "127.0.0.1"
+PORT = 8765
+LATENCY = 2.0         # seconds per answer, on average
+LATENCY_JITTER = 0.5  # each answer takes LATENCY * (1 +/- this)
+ERROR_RATE = 0.0      # share of requests answered 500
+MALFORMED_RATE = 0.0  # share of answers that are garbled
+QUOTA_RPM = 0         # requests per key per minute before 429; 0 = no quota
+
+OFFICES = ["Mooltan", "Shujabad", "Cawnpore", "Futtehpore", "Allahabad", "Benares", "Mirzapore", "Ghazeepore",
+           "Jounpore", "Azimgurh", "Goruckpore", "Bustee", "Fyzabad", "Sultanpore", "Lucknow", "Oonao",
+           "Hurdui", "Shahjehanpore", "Bareilly", "Moradabad", "Bijnour", "Meerut", "Mozuffernuggur",
+           "Saharunpore", "Dehra", "Umballa", "Loodiana", "Jullundur", "Hooshyarpore", "Umritsur",
+           "Lahore", "Goojranwala", "Sealkote", "Jhelum", "Rawul Pindee", "Peshawur", "Kohat", "Dera Ghazee Khan"]
+DISTRICTS = ["Punjab", "N.W.P.", "Oudh", "Bengal", "Bombay", "Madras", "Central Provinces", "Sind"]
+
+BATCH_NAMES = re.compile(r"in order: ([^\n]*?)\.\s*$", re.MULTILINE)
+DIRTY_JSON = re.compile(r"--- DIRTY JSON[^\n]*\n(.*?)\n\s*--- CLEAN TEXT", re.DOTALL)
+
+def page_rows(name):
+    rng = random.Random(name)
+    return [(rng.choice(OFFICES), rng.choice(DISTRICTS), rng.randint(1, 300)) for _ in range(rng.randint(12, 30))]
+
+def page_html(name):
+    rows = "".join(f"<tr><td>{o}</td><td>{d}</td><td class='right'>{m}</td></tr>" for o, d, m in page_rows(name))
+    return (f"<h2 class='center'>LIST OF POST OFFICES</h2>\n"
+            f"<table><tr><th>Name of Office</th><th>District</th><th>Distance in Miles</th></tr>{rows}</table>")
+
+def page_text(name):
+    rows = "\n".join(f"| {o} | {d} | {m} |" for o, d, m in page_rows(name))
+    return f"## LIST OF POST OFFICES\n\n| Name of Office | District | Distance in Miles |\n|---|---|---|\n{rows}\n"
+
+def answer(prompt, rng, malformed_rate=MALFORMED_RATE):
+    """(kind, text) for one request's text parts."""
+    dirty = DIRTY_JSON.search(prompt)
+    if dirty:
+        text = dirty.group(1).strip()
+        return "repair", text[:len(text) // 2] if rng.random() < malformed_rate else text
+
+    kind = "html" if "HTML" in prompt else "text"
+    make = page_html if kind == "html" else page_text
+    batch = BATCH_NAMES.search(prompt)
+    if not batch:
+        return kind, make(str(rng.random()))
+    names = [n.strip() for n in batch.group(1).split(",")]
+    if rng.random() < malformed_rate:
+        names = names[:-1] # the last page's marker goes missing; page_batches.py re-sends it alone
+    return f"{kind}_batch", "\n".join(f"===== PAGE {n} =====\n{make(n)}" for n in names)
+
+class FakeGemini(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host=HOST, port=PORT, latency=LATENCY, jitter=LATENCY_JITTER,
+                 error_rate=ERROR_RATE, malformed_rate=MALFORMED_RATE, quota_rpm=QUOTA_RPM):
+        super().__init__((host, port), Handler)
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.malformed_rate, self.quota_rpm = error_rate, malformed_rate, quota_rpm
+        self.lock = threading.Lock()
+        self.recent = {}  # key -> request times in the last minute
+        self.stats = {"requests": 0, "status": {}, "kinds": {}, "keys": {}, "bytes_in": 0, "bytes_out": 0}
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def over_quota(self, key):
+        if not self.quota_rpm:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            times = [t for t in self.recent.get(key, []) if now - t < 60]
+            self.recent[key] = times
+            if len(times) >= self.quota_rpm:
+                return True
+            times.append(now)
+            return False
+
+    def count(self, key, kind, status, bytes_in, bytes_out):
+        with self.lock:
+            s = self.stats
+            s["requests"] += 1
+            s["status"][str(status)] = s["status"].get(str(status), 0) + 1
+            s["kinds"][kind] = s["kinds"].get(kind, 0) + 1
+            s["keys"][key] = s["keys"].get(key, 0) + 1
+            s["bytes_in"] += bytes_in
+            s["bytes_out"] += bytes_out
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass # the scripts print enough as it is
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
+
+    def do_POST(self):
+        server = self.server
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        key = self.headers.get("x-goog-api-key", "?")[-6:]
+        if not self.path.split("?")[0].endswith(":generateContent"):
+            server.count(key, "unknown", 404, len(raw), self.reply(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}}))
+            return
+
+        request = json.loads(raw or b"{}")
+        prompt = "\n".join(part["text"] for content in request.get("contents", [])
+                           for part in content.get("parts", []) if "text" in part)
+        rng = random.Random()
+        time.sleep(max(0.0, server.latency * (1 + rng.uniform(-server.jitter, server.jitter))))
+
+        if server.over_quota(key):
+            kind, status = "quota", 429
+            body = {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}}
+        elif rng.random() < server.error_rate:
+            kind, status = "error", 500
+            body = {"error": {"code": 500, "message": "Internal error encountered.", "status": "INTERNAL"}}
+        else:
+            kind, text = answer(prompt, rng, server.malformed_rate)
+            status = 200
+            body = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+                    "usageMetadata": {"promptTokenCount": len(raw) // 4, "candidatesTokenCount": len(text) // 4,
+                                      "totalTokenCount": (len(raw) + len(text)) // 4}}
+        server.count(key, kind, status, len(raw), self.reply(status, body))
+
+def start(**options):
+    """Starts a FakeGemini on a background thread (port 0 picks a free one) and returns it."""
+    server = FakeGemini(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini API (point GEMINI_BASE_URL at it)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="Seconds per answer")
+    parser.add_argument("--jitter", type=float, default=LATENCY_JITTER)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE, help="Share of requests answered 500")
+    parser.add_argument("--malformed-rate", type=float, default=MALFORMED_RATE, help="Share of answers that are garbled")
+    parser.add_argument("--quota-rpm", type=int, default=QUOTA_RPM, help="Requests per key per minute before 429 (0 = none)")
+    args = parser.parse_args()
+    server = FakeGemini(port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        malformed_rate=args.malformed_rate, quota_rpm=args.quota_rpm)
+    print(f"Fake Gemini listening on {server.url} - set GEMINI_BASE_URL={server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats, indent=1))
@@ -0,0 +1,329 @@
+import os
+import re
+import json
+import time
+import gzip
+import hashlib
+import sqlite3
+from html_markdown import html_tables, is_placeholder
+from search_index import normalise, sound_key, TOKEN
+from pipeline_state import PipelineState, DONE
+
+# Post-office gazetteer: every row of every office table in htmls/*.html, in one SQLite file.
+#
+#   processed_data/gazetteer.db        entries (office, district, year, book, page, the whole row)
+#                                      with indexes on name and year, and an FTS5 table with
+#                                      prefix indexes over office and district names
+#   processed_data/gazetteer.json.gz   {name: [office, district, [[book, page], ...]]} for index.html
+#
+# A table counts if one of its first HEADER_ROWS rows has a cell that looks like an office column
+# (COLUMNS below). Tables without a header that are as wide as the book's last office table are
+# read with that table's header, since a list running over several pages usually only has its
+# header on the first. "Do." / "ditto" in the district column means the row above's district.
+#
+# An edition's year comes from its book name ("1869", "1870-2"). Offices are compared across years
+# by a normalised name (lower case, no accents or punctuation) or, with fuzzy, by the sound key of
+# each word, so "Mooltan" in 1859 and "Multan" in 1873 are the same office.
+#
+#   python gazetteer.py                               extract changed books and write the export
+#   python gazetteer.py --search mool                 offices and districts starting with "mool"
+#   python gazetteer.py --history Mooltan --fuzzy     every listing of one office
+#   python gazetteer.py --only-in 1859 --not-in 1873  offices listed in 1859 but gone by 1873
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+DB_FILE = "gazetteer.db"
+EXPORT_FILE = "gazetteer.json.gz"
+HEADER_ROWS = 3 # how far down a table its header may start, below one-cell title rows
+COLUMNS = {     # column -> header pattern; district is tried first ("Name of District" is not an office)
+    "district": re.compile(r"\b(districts?|zil+ah|zila|collectorate|division|circle|province|presidency)\b", re.I),
+    "office": re.compile(r"\b(offices?|stations?|names?|places?)\b", re.I),
+}
+DITTO = re.compile(r"^(do\.?|ditto|[\"“”〃]+)$", re.I)
+YEAR = re.compile(r"1[6-9]\d\d")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    collection TEXT, book TEXT, year INTEGER, version TEXT,
+    PRIMARY KEY (collection, book)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    collection TEXT, book TEXT, year INTEGER, page INTEGER, row INTEGER,
+    office TEXT, name_key TEXT, sound TEXT, district TEXT,
+    cells TEXT -- the whole row as {header: cell}
+);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name_key, year);
+CREATE INDEX IF NOT EXISTS entries_sound ON entries (sound, year);
+CREATE INDEX IF NOT EXISTS entries_year ON entries (year, name_key);
+CREATE INDEX IF NOT EXISTS entries_book ON entries (collection, book, page);
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    office, district, content='entries', content_rowid='id',
+    prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+def clean_cell(cell):
+    return re.sub(r"\s+", " ", cell.replace("*", "")).strip()
+
+def name_key(name):
+    return " ".join(TOKEN.findall(normalise(name)))
+
+def name_sound(key):
+    return " ".join(sound_key(word) or word for word in key.split())
+
+def book_year(book):
+    match = YEAR.search(book)
+    return int(match.group()) if match else None
+
+def header_columns(row):
+    # {column: cell index} if the row looks like an office table's header, else None
+    columns = {}
+    for i, cell in enumerate(row):
+        for column, pattern in COLUMNS.items():
+            if column not in columns and pattern.search(cell):
+                columns[column] = i
+                break
+    return columns if "office" in columns else None
+
+def table_rows(table, carried):
+    """
+    Yields {"office", "district", "cells": {header: cell}} for the office rows of one table.
+    `carried` is [header row, columns] of the book's last office table, updated in place.
+    """
+    table = [[clean_cell(c) for c in row] for row in table]
+    body = None
+    for i, row in enumerate(table[:HEADER_ROWS]):
+        columns = header_columns(row)
+        if columns:
+            carried[:] = [row, columns]
+            body = table[i + 1:]
+            break
+        if sum(1 for c in row if c) > 1:
+            break # a data row: this table has no header of its own
+    if body is None:
+        if not carried or len(carried[0]) != max(len(r) for r in table):
+            return
+        body = table
+    header, columns = carried
+
+    district = ""
+    for row in body:
+        row = row + [""] * (len(header) - len(row))
+        office = row[columns["office"]]
+        if not office or not name_key(office) or DITTO.match(office) or office == header[columns["office"]]:
+            continue # blank, ditto, or the header repeated part way down
+        if "district" in columns:
+            value = row[columns["district"]]
+            if value and not DITTO.match(value):
+                district = value
+        yield {"office": office, "district": district,
+               "cells": {h or str(i): c for i, (h, c) in enumerate(zip(header, row)) if c}}
+
+class Gazetteer:
+    """
+        gaz = Gazetteer()
+        gaz.update()                          # re-extract the books that changed
+        gaz.search("mool")                    # prefix search over office and district names
+        gaz.history("Mooltan", fuzzy=True)    # every listing of one office
+        gaz.only_in(1859, 1873)               # offices listed in 1859 but not in 1873
+
+    Results are dicts with office, district, year, collection, book, page and cells.
+    """
+
+    def __init__(self, data_dir=DATA_DIR, db_path=None):
+        self.data_dir = data_dir
+        self.db_path = db_path or os.path.join(data_dir, DB_FILE)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            self.has_fts = False # SQLite built without FTS5: search() uses a prefix range on the name index
+
+    def close(self):
+        self.db.close()
+
+    # --- extraction ---
+    def extract_book(self, state, collection, book):
+        rows, carried = [], []
+        for page, stages in sorted(state.book_pages(collection, book).items()):
+            if stages.get("html") != DONE:
+                continue
+            path = state.path(collection, book, page, "html")
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    html = f.read()
+            except OSError:
+                continue
+            if is_placeholder(html):
+                continue
+            for table in html_tables(html):
+                for row in table_rows(table, carried):
+                    rows.append((page, row))
+        return rows
+
+    def update(self, state=None, force=False):
+        """Re-extracts every book whose html rows changed since it was last read. Returns the books re-read."""
+        own_state = state is None
+        if own_state:
+            state = PipelineState(self.data_dir)
+        # Only the HTML is read, so new tiles, thumbnails or word boxes leave a book alone
+        versions = {key: json.dumps(list(v)) for key, v in state.book_versions(("html",)).items()}
+        known = {(r["collection"], r["book"]): r["version"] for r in self.db.execute("SELECT collection, book, version FROM books")}
+
+        changed = [key for key, version in versions.items() if force or known.get(key) != version]
+        with self.db:
+            for collection, book in set(known) - set(versions):
+                self._drop_book(collection, book)
+            for collection, book in sorted(changed):
+                year = book_year(book)
+                rows = self.extract_book(state, collection, book)
+                self._drop_book(collection, book)
+                self.db.executemany("""
+                    INSERT INTO entries (collection, book, year, page, row, office, name_key, sound, district, cells)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    [(collection, book, year, page, i, r["office"], name_key(r["office"]), name_sound(name_key(r["office"])),
+                      r["district"], json.dumps(r["cells"], ensure_ascii=False)) for i, (page, r) in enumerate(rows)])
+                if self.has_fts:
+                    self.db.execute("""
+                        INSERT INTO entries_fts (rowid, office, district)
+                        SELECT id, office, district FROM entries WHERE collection = ? AND book = ?""", (collection, book))
+                self.db.execute("INSERT INTO books (collection, book, year, version) VALUES (?, ?, ?, ?)",
+                                (collection, book, year, versions[(collection, book)]))
+                print(f"   -> {collection}/{book}: {len(rows)} offices")
+        if own_state:
+            state.close()
+        return len(changed)
+
+    def _drop_book(self, collection, book):
+        if self.has_fts:
+            self.db.execute("""
+                INSERT INTO entries_fts (entries_fts, rowid, office, district)
+                SELECT 'delete', id, office, district FROM entries WHERE collection = ? AND book = ?""", (collection, book))
+        self.db.execute("DELETE FROM entries WHERE collection = ? AND book = ?", (collection, book))
+        self.db.execute("DELETE FROM books WHERE collection = ? AND book = ?", (collection, book))
+
+    # --- queries ---
+    def _results(self, rows):
+        return [{"office": r["office"], "district": r["district"], "year": r["year"], "collection": r["collection"],
+                 "book": r["book"], "page": r["page"], "cells": json.loads(r["cells"])} for r in rows]
+
+    def years(self):
+        """{year: distinct offices listed}"""
+        return dict(self.db.execute(
+            "SELECT year, COUNT(DISTINCT name_key) FROM entries WHERE year IS NOT NULL GROUP BY year ORDER BY year"))
+
+    def search(self, text, year=None, limit=100):
+        """Offices whose name or district has words starting with every word of `text`."""
+        words = name_key(text).split()
+        if not words:
+            return []
+        where, args = "", []
+        if year is not None:
+            where, args = " AND e.year = ?", [year]
+        if self.has_fts:
+            match = " ".join(f'"{w}"*' for w in words)
+            rows = self.db.execute(f"""
+                SELECT e.* FROM entries_fts f JOIN entries e ON e.id = f.rowid
+                WHERE entries_fts MATCH ?{where} ORDER BY e.year, e.collection, e.book, e.page, e.row LIMIT ?""",
+                [match, *args, limit])
+        else:
+            rows = self.db.execute(f"""
+                SELECT * FROM entries e WHERE e.name_key >= ? AND e.name_key < ?{where}
+                ORDER BY e.year, e.collection, e.book, e.page, e.row LIMIT ?""",
+                [" ".join(words), " ".join(words) + "￿", *args, limit])
+        return self._results(rows)
+
+    def history(self, name, fuzzy=False):
+        """Every listing of one office, oldest edition first."""
+        key = name_key(name)
+        column, value = ("sound", name_sound(key)) if fuzzy else ("name_key", key)
+        return self._results(self.db.execute(f"""
+            SELECT * FROM entries WHERE {column} = ? ORDER BY year, collection, book, page, row""", (value,)))
+
+    def only_in(self, year, missing_year, fuzzy=False):
+        """Offices listed in `year` but not in `missing_year` - one result (the first listing) per office."""
+        column = "sound" if fuzzy else "name_key"
+        return self._results(self.db.execute(f"""
+            SELECT * FROM entries WHERE id IN (
+                SELECT MIN(id) FROM entries
+                WHERE year = ? AND {column} NOT IN (SELECT {column} FROM entries WHERE year = ?)
+                GROUP BY {column})
+            ORDER BY name_key""", (year, missing_year)))
+
+    # --- export ---
+    def export(self, path=None):
+        """
+        Writes the viewer's copy: {"version", "books": [[collection, book, year]],
+        "offices": [[name key, office, district, [[book, page], ...]], ...]} sorted by name key.
+        Returns the number of offices.
+        """
+        path = path or os.path.join(self.data_dir, EXPORT_FILE)
+        books = [list(r) for r in self.db.execute("SELECT collection, book, year FROM books ORDER BY year, collection, book")]
+        book_idx = {(c, b): i for i, (c, b, _) in enumerate(books)}
+        offices = {}
+        for r in self.db.execute("SELECT name_key, office, district, collection, book, page FROM entries ORDER BY name_key, year, id"):
+            entry = offices.setdefault(r["name_key"], [r["name_key"], r["office"], r["district"], []])
+            listing = [book_idx[(r["collection"], r["book"])], r["page"]]
+            if listing not in entry[3]:
+                entry[3].append(listing)
+        versions = [list(r) for r in self.db.execute("SELECT collection, book, version FROM books ORDER BY collection, book")]
+        version = hashlib.sha256(json.dumps(versions).encode("utf-8")).hexdigest()[:12]
+        data = json.dumps({"version": version, "books": books, "offices": list(offices.values())},
+                          ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with open(path + ".tmp", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        os.replace(path + ".tmp", path)
+        return len(offices)
+
+def build_gazetteer(data_dir=DATA_DIR, state=None, force=False):
+    """Updates gazetteer.db and its export. Returns the number of books re-read."""
+    gaz = Gazetteer(data_dir)
+    changed = gaz.update(state, force)
+    if changed or not os.path.exists(os.path.join(data_dir, EXPORT_FILE)):
+        gaz.export()
+    gaz.close()
+    return changed
+
+def print_results(results, started):
+    for r in results:
+        where = f"{r['collection']}/{r['book']} page_{r['page']:03d}"
+        print(f"   {r['year'] or '----'}  {r['office']:<30} {r['district']:<20} {where}")
+    print(f"{len(results)} results in {(time.perf_counter() - started) * 1000:.1f} ms.")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or query the post-office gazetteer in processed_data/gazetteer.db")
+    parser.add_argument("--search", metavar="TEXT", help="Offices or districts starting with these words")
+    parser.add_argument("--year", type=int, help="Only this year's edition (with --search)")
+    parser.add_argument("--history", metavar="OFFICE", help="Every listing of one office")
+    parser.add_argument("--only-in", type=int, metavar="YEAR", help="Offices listed in this year...")
+    parser.add_argument("--not-in", type=int, metavar="YEAR", help="...but not in this one")
+    parser.add_argument("--fuzzy", action="store_true", help="Compare names by sound (Mooltan / Multan)")
+    parser.add_argument("--years", action="store_true", help="Offices per edition year")
+    parser.add_argument("--force", action="store_true", help="Re-read every book")
+    args = parser.parse_args()
+
+    if args.search or args.history or args.only_in or args.years:
+        gaz = Gazetteer()
+        started = time.perf_counter()
+        if args.years:
+            for year, count in gaz.years().items():
+                print(f"   {year}: {count} offices")
+        elif args.search:
+            print_results(gaz.search(args.search, args.year), started)
+        elif args.history:
+            print_results(gaz.history(args.history, args.fuzzy), started)
+        else:
+            if args.not_in is None:
+                parser.error("--only-in needs --not-in")
+            print_results(gaz.only_in(args.only_in, args.not_in, args.fuzzy), started)
+        gaz.close()
+    else:
+        changed = build_gazetteer(force=args.force)
+        print(f"Gazetteer saved to {os.path.join(DATA_DIR, DB_FILE)} ({changed} books re-read).")
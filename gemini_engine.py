@@ -0,0 +1,335 @@
+import os
+import time
+import asyncio
+import concurrent.futures
+from google import genai
+import telemetry
+from llm_cache import LLMCache, _part_bytes
+from rate_limit import KeyLimiter, backoff_delay, is_quota_error
+
+# Shared async request engine for every Gemini workload (texts, htmls, overlay repair).
+#
+# Instead of one blocking call + a fixed sleep per page, the engine keeps N requests in flight.
+# N starts at INITIAL_IN_FLIGHT and adapts: it grows while requests come back quickly and
+# halves whenever Gemini answers 429. Each API key still has its own token bucket (rate_limit.py),
+# so N never pushes a key past its RPM. Reading/encoding images and writing results happen in a
+# thread pool, so the event loop only ever waits on the network.
+# Every answer is stored in the response cache (llm_cache.py); a request whose inputs, prompt and
+# model were seen before is answered from disk without touching the API or a key's quota.
+
+INITIAL_IN_FLIGHT = 4
+MIN_IN_FLIGHT = 1
+MAX_IN_FLIGHT = 32
+TARGET_LATENCY = 30.0 # seconds; slower answers stop N from growing
+IO_WORKERS = 8
+MAX_ATTEMPTS = 4
+KEY_MAX_CONSECUTIVE_429 = 5
+BASE_URL_ENV = "GEMINI_BASE_URL" # set it to send every request elsewhere, e.g. benchmark.py's local stand-in
+
+def make_client(api_key):
+    base_url = os.environ.get(BASE_URL_ENV)
+    http_options = genai.types.HttpOptions(base_url=base_url) if base_url else None
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+def image_part(img_path):
+    # Send the JPEG bytes as they are on disk - no PIL decode/re-encode on our side
+    with open(img_path, "rb") as f:
+        data = f.read()
+    return genai.types.Part.from_bytes(data=data, mime_type="image/jpeg")
+
+def payload_size(contents):
+    # Bytes a request sends: image bytes plus prompt text, for telemetry
+    size = 0
+    for item in contents if isinstance(contents, list) else [contents]:
+        try:
+            size += len(_part_bytes(item))
+        except TypeError:
+            pass
+    return size
+
+class Job:
+    """
+    One request.
+      build()      -> contents for generate_content (runs in the thread pool)
+      handle(text) -> True when the result was saved, False to retry the job (runs in the thread pool),
+                      or a list of follow-up Jobs: this job is done, but those still have to run
+      config       -> optional GenerateContentConfig
+    """
+
+    def __init__(self, name, build, handle, config=None):
+        self.name = name
+        self.build = build
+        self.handle = handle
+        self.config = config
+        self.attempt = 0
+
+class AdaptiveConcurrency:
+    # Additive increase, multiplicative decrease - the same idea TCP uses for its window
+    def __init__(self, initial=INITIAL_IN_FLIGHT, minimum=MIN_IN_FLIGHT, maximum=MAX_IN_FLIGHT, target_latency=TARGET_LATENCY):
+        self.value = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.successes = 0
+
+    def on_success(self, latency):
+        self.successes += 1
+        if latency > 2 * self.target_latency:
+            self.value = max(self.minimum, self.value - 1)
+            self.successes = 0
+        elif latency <= self.target_latency and self.successes >= self.value:
+            self.value = min(self.maximum, self.value + 1)
+            self.successes = 0
+
+    def on_throttle(self):
+        self.value = max(self.minimum, self.value // 2)
+        self.successes = 0
+
+class ApiKey:
+    def __init__(self, index, api_key, rpm, rpd):
+        self.index = index
+        self.client = make_client(api_key)
+        self.limiter = KeyLimiter(f"key{index}", rpm, rpd)
+        self.consecutive_429 = 0
+        self.dead = False
+
+class GeminiEngine:
+    """
+    engine = GeminiEngine([(key, rpm, rpd), ...], MODEL_NAME)
+    engine.run(jobs)
+
+    Inside an event loop that produces jobs as it goes (run_pipeline.py), use
+    `await engine.run_async(feed=queue)` instead: jobs are taken from the queue only while there
+    is room in flight, so a full queue pushes back on whoever is filling it. Put None to close it.
+    """
+
+    def __init__(self, key_specs, model, label="Gemini", initial=INITIAL_IN_FLIGHT, maximum=MAX_IN_FLIGHT, use_cache=True):
+        self.model = model
+        self.label = label
+        self.cache = LLMCache() if use_cache else None
+        self.keys = []
+        for i, (api_key, rpm, rpd) in enumerate(key_specs):
+            try:
+                self.keys.append(ApiKey(i + 1, api_key, rpm, rpd))
+            except Exception as e:
+                print(f"   [{label}] Key {i + 1} Error: {e}")
+        self.concurrency = AdaptiveConcurrency(initial=initial, maximum=maximum)
+        self.sending = 0 # API calls actually awaiting an answer (concurrency.value is only the limit)
+        self.stats = {"requests": 0, "saved": 0, "failed": 0, "throttled": 0, "errors": 0, "latency": 0.0, "cache_hits": 0}
+
+    def run(self, jobs):
+        # Blocking entry point for the scripts. Returns the stats dict.
+        if not jobs:
+            return self.stats
+        return asyncio.run(self.run_async(jobs))
+
+    async def run_async(self, jobs=(), feed=None):
+        if not self.keys:
+            print(f"   [{self.label}] No usable API keys.")
+            return self.stats
+        await self._run(list(jobs), feed)
+        if self.cache is not None:
+            self.cache.save_stats()
+        return self.stats
+
+    def _live_keys(self):
+        return [k for k in self.keys if not k.dead]
+
+    async def _acquire_key(self):
+        # The live key whose token bucket frees up first; None once every key is dead or spent
+        while True:
+            waits = []
+            for key in self._live_keys():
+                wait = key.limiter.wait_time()
+                if wait is None:
+                    print(f"   [{self.label}] Key {key.index} used its daily budget. Retired.")
+                    key.dead = True
+                    telemetry.event("key_retired", label=self.label, key=key.index, reason="daily budget")
+                else:
+                    waits.append((wait, key.index, key))
+            if not waits:
+                return None
+            wait, _, key = min(waits)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if key.limiter.try_acquire():
+                return key
+
+    def _take(self, job):
+        # One job from the feed; None closes it
+        if job is None:
+            self.feed_open = False
+        else:
+            self.queue.put_nowait(job)
+            self.outstanding += 1
+
+    async def _run(self, jobs, feed=None):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        for job in jobs:
+            self.queue.put_nowait(job)
+        self.outstanding = len(jobs)
+        self.feed_open = feed is not None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=IO_WORKERS)
+        in_flight = set()
+        started = time.monotonic()
+
+        source = "fed as they arrive" if feed is not None else "queued"
+        print(f"   [{self.label}] {len(jobs)} requests {source} on {len(self.keys)} key(s), starting with {self.concurrency.value} in flight.")
+        try:
+            while (self.outstanding > 0 or self.feed_open) and self._live_keys():
+                # Pull from the feed only while there is room, so a slow API pushes back on the producers
+                while self.feed_open and self.queue.qsize() + len(in_flight) < self.concurrency.value and not feed.empty():
+                    self._take(feed.get_nowait())
+                while len(in_flight) < self.concurrency.value and not self.queue.empty():
+                    in_flight.add(asyncio.create_task(self._run_one(self.queue.get_nowait(), loop)))
+                if not in_flight:
+                    if self.feed_open and self.queue.empty():
+                        try:
+                            self._take(await asyncio.wait_for(feed.get(), timeout=0.5))
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        # Everything left is waiting out a backoff before it is re-queued
+                        await asyncio.sleep(0.2)
+                    continue
+                timeout = 0.2 if self.feed_open else 1.0
+                done, in_flight = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        # A bug in a handler must not leave the run waiting forever
+                        print(f"   [{self.label}] Request crashed: {task.exception()}")
+                        self.stats["failed"] += 1
+                        self.outstanding -= 1
+            if in_flight:
+                await asyncio.wait(in_flight)
+        finally:
+            self.executor.shutdown(wait=True)
+
+        elapsed = time.monotonic() - started
+        done = self.stats["saved"]
+        avg = self.stats["latency"] / max(self.stats["requests"], 1)
+        print(f"   [{self.label}] Saved {done} in {elapsed:.0f}s ({done / max(elapsed, 1e-9) * 60:.1f}/min), "
+              f"avg latency {avg:.1f}s, {self.stats['throttled']} x 429, {self.stats['errors']} errors, "
+              f"final concurrency {self.concurrency.value}.")
+        if self.cache is not None:
+            print(f"   [{self.label}] Cache: {self.stats['cache_hits']} answered from disk, {self.cache.misses} sent to the API.")
+        if self.outstanding > 0:
+            print(f"   [{self.label}] {self.outstanding} requests left for the next run (every key hit its quota).")
+
+    def _accepted(self, result):
+        # Queues any follow-up jobs a handler returned; True if the job itself is done
+        if isinstance(result, list):
+            for follow_up in result:
+                self.queue.put_nowait(follow_up)
+            self.outstanding += len(result)
+            return True
+        return bool(result)
+
+    def _retry_later(self, job, delay):
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, job)
+
+    def _prepare(self, job):
+        # Runs in the thread pool: load/encode the inputs and hash them for the cache
+        contents = job.build()
+        cache_key = self.cache.key(self.model, contents, job.config) if self.cache is not None else None
+        return contents, cache_key, payload_size(contents)
+
+    async def _run_one(self, job, loop):
+        try:
+            contents, cache_key, sent = await loop.run_in_executor(self.executor, self._prepare, job)
+        except Exception as e:
+            print(f"   [{self.label}] Could not prepare {job.name}: {e}")
+            self.stats["failed"] += 1
+            self.outstanding -= 1
+            return
+
+        if cache_key is not None:
+            cached = await loop.run_in_executor(self.executor, self.cache.get, cache_key)
+            if cached is not None:
+                try:
+                    saved = self._accepted(await loop.run_in_executor(self.executor, job.handle, cached))
+                except Exception as e:
+                    print(f"   [{self.label}] Could not save {job.name}: {e}")
+                    saved = False
+                if saved:
+                    telemetry.event("request", label=self.label, job=job.name, status="cache", sent=sent, received=len(cached))
+                    self.stats["cache_hits"] += 1
+                    self.stats["saved"] += 1
+                    self.outstanding -= 1
+                    return
+                # The handler rejected the stored answer - forget it and ask the API again
+                self.cache.discard(cache_key)
+
+        key = await self._acquire_key()
+        if key is None:
+            self.queue.put_nowait(job) # stays outstanding for the summary
+            return
+
+        print(f"   [{self.label}] Processing: {job.name}...")
+        self.stats["requests"] += 1
+        self.sending += 1
+        in_flight, limit = self.sending, self.concurrency.value # as this request went out
+        start = time.monotonic()
+        try:
+            response = await key.client.aio.models.generate_content(model=self.model, contents=contents, config=job.config)
+            text = response.text
+        except Exception as e:
+            request = {"label": self.label, "job": job.name, "key": key.index, "latency": round(time.monotonic() - start, 3),
+                       "sent": sent, "attempt": job.attempt, "in_flight": in_flight, "limit": limit, "error": type(e).__name__}
+            if is_quota_error(e):
+                telemetry.event("request", status="quota", **request)
+                self.stats["throttled"] += 1
+                self.concurrency.on_throttle()
+                key.consecutive_429 += 1
+                delay = backoff_delay(key.consecutive_429)
+                key.limiter.penalise(delay)
+                telemetry.event("throttle", label=self.label, key=key.index, consecutive=key.consecutive_429, delay=round(delay, 2))
+                if key.consecutive_429 >= KEY_MAX_CONSECUTIVE_429 and not key.dead:
+                    print(f"   [{self.label}] QUOTA HIT {key.consecutive_429}x in a row on key {key.index}. Key retired.")
+                    key.dead = True
+                    telemetry.event("key_retired", label=self.label, key=key.index, reason="429 in a row")
+                # The request never ran, so it does not use up an attempt
+                self._retry_later(job, 0)
+                return
+            telemetry.event("request", status="error", **request)
+            self.stats["errors"] += 1
+            print(f"   [{self.label}] Error on {job.name}: {e}")
+            self._fail_or_retry(job)
+            return
+        finally:
+            self.sending -= 1
+
+        latency = time.monotonic() - start
+        self.stats["latency"] += latency
+        key.consecutive_429 = 0
+        self.concurrency.on_success(latency)
+
+        handled = time.monotonic()
+        try:
+            saved = bool(text) and self._accepted(await loop.run_in_executor(self.executor, job.handle, text))
+        except Exception as e:
+            print(f"   [{self.label}] Could not save {job.name}: {e}")
+            saved = False
+        # "rejected": the API answered but the handler could not use it (bad JSON, garbled batch)
+        telemetry.event("request", label=self.label, job=job.name, key=key.index, status="ok" if saved else "rejected",
+                        latency=round(latency, 3), sent=sent, received=len(text or ""), attempt=job.attempt,
+                        in_flight=in_flight, limit=limit, handle_seconds=round(time.monotonic() - handled, 3))
+
+        if saved:
+            if cache_key is not None:
+                # Only answers the handler accepted are worth keeping
+                await loop.run_in_executor(self.executor, self.cache.put, cache_key, text, self.model)
+            self.stats["saved"] += 1
+            self.outstanding -= 1
+        else:
+            self._fail_or_retry(job)
+
+    def _fail_or_retry(self, job):
+        job.attempt += 1
+        if job.attempt < MAX_ATTEMPTS:
+            self._retry_later(job, backoff_delay(job.attempt))
+        else:
+            print(f"   [{self.label}] Giving up on {job.name} for this run.")
+            self.stats["failed"] += 1
+            self.outstanding -= 1
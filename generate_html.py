@@ -1,14 +1,21 @@
 import os
-import time
-import math
-import concurrent.futures
-from google import genai
-import PIL.Image
+import telemetry
+from gemini_engine import GeminiEngine, Job, image_part
+from rate_limit import load_key_specs
+from upload_variants import upload_image
+from page_batches import build_jobs
+from html_markdown import derive_text, is_placeholder
+from pipeline_state import PipelineState, PENDING
+from page_matches import PageMatcher, prior_page, revision_prompt
 
 # --- CONFIGURATION ---
 KEY_FILE = "keys.txt"
 DATA_DIR = "processed_data"
 MODEL_NAME = "gemini-3-flash-preview"
+UPLOAD_PROFILE = "original" # sends the scan as-is; switch to e.g. "gray_crop" once upload_variants.py --evaluate shows it is no worse
+BATCH_PAGES = 4 # consecutive pages per request; 1 = one page per request. Choose with page_batches.py
+WRITE_TEXTS = True # also fill empty texts/*.txt from the HTML, so the OCR script has nothing left to send
+USE_EARLIER_EDITIONS = True # copy / correct the matching page of an earlier edition, see page_matches.py
 
 # MASTER STYLESHEET (Same as before)
 CSS_TEMPLATE = """
@@ -39,33 +46,7 @@ CSS_TEMPLATE = """
 </style>
 """
 
-def load_keys(filepath):
-    keys = []
-    try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                parts = line.strip().split()
-                if parts:
-                    keys.append(parts[0])
-        return keys
-    except FileNotFoundError:
-        print("CRITICAL: keys.txt not found!")
-        exit()
-
-def process_batch(worker_id, api_key, file_list):
-    """
-    This function runs inside a separate thread.
-    It acts like an independent program using ONE specific key.
-    """
-    print(f"   [Worker {worker_id}] Started! Assigned {len(file_list)} pages.")
-    
-    try:
-        client = genai.Client(api_key=api_key)
-    except Exception as e:
-        print(f"   [Worker {worker_id}] Key Error: {e}")
-        return
-
-    prompt = """
+HTML_PROMPT = """
     Look at this image of a 19th-century postal guide.
     Reproduce it EXACTLY as an HTML web page.
     RULES:
@@ -76,40 +57,82 @@ def process_batch(worker_id, api_key, file_list):
     5. OUTPUT FORMAT: HTML code only.
     """
 
-    for img_path, html_path, filename in file_list:
-        # Double check if done (in case another thread somehow touched it, though unlikely)
-        if os.path.exists(html_path):
-            continue
-
-        print(f"   [Worker {worker_id}] Processing: {filename}...")
-        
-        try:
-            image = PIL.Image.open(img_path)
-            response = client.models.generate_content(
-                model=MODEL_NAME,
-                contents=[image, prompt]
-            )
-            
-            if response.text:
-                full_html = f"<!DOCTYPE html><html><head><meta charset='utf-8'>{CSS_TEMPLATE}</head><body>{response.text}</body></html>"
-                full_html = full_html.replace("```html", "").replace("```", "")
-                
-                with open(html_path, "w", encoding="utf-8") as f:
-                    f.write(full_html)
-                print(f"   [Worker {worker_id}] -> Saved HTML.")
-            
-            # Rate Limit Safety: Sleep 4s PER WORKER.
-            # Since workers run in parallel, this doesn't slow down the total throughput.
-            time.sleep(4) 
-            
-        except Exception as e:
-            err = str(e)
-            if "429" in err or "quota" in err.lower():
-                print(f"   [Worker {worker_id}] QUOTA HIT for this key. Worker stopping.")
-                break # This specific key is dead for the day. The worker retires.
-            else:
-                print(f"   [Worker {worker_id}] Error on {filename}: {e}")
-                time.sleep(5)
+def load_keys(filepath):
+    # Returns [(key, rpm, rpd)] - see rate_limit.py for the keys.txt format
+    try:
+        return load_key_specs(filepath)
+    except FileNotFoundError:
+        print("CRITICAL: keys.txt not found!")
+        exit()
+
+def save_html(html_path, text):
+    full_html = f"<!DOCTYPE html><html><head><meta charset='utf-8'>{CSS_TEMPLATE}</head><body>{text}</body></html>"
+    full_html = full_html.replace("```html", "").replace("```", "")
+    
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(full_html)
+
+state = None # the pipeline manifest, opened by main()
+
+def text_is_stale(txt_path):
+    key = state.key_for(txt_path, "text") if state is not None else None
+    return key is not None and state.status(*key, "text") == PENDING
+
+def save_page(html_path, text):
+    save_html(html_path, text)
+    if state is not None:
+        state.record_file(html_path, "html")
+    if not WRITE_TEXTS:
+        return
+    # Same page as Markdown, converted locally - never replaces a transcription that is already there,
+    # unless the manifest says it is stale (the page was rotated since, say)
+    txt_path = os.path.join(os.path.dirname(os.path.dirname(html_path)), "texts",
+                            os.path.basename(html_path).rsplit('.', 1)[0] + ".txt")
+    if not os.path.exists(txt_path) or os.path.getsize(txt_path) == 0 or text_is_stale(txt_path):
+        if derive_text(html_path, txt_path) and state is not None:
+            state.record_file(txt_path, "text")
+
+def html_is_pending(html_path):
+    # Missing, or still process_project.py's "[OCR Content Pending...]" placeholder
+    if not os.path.exists(html_path):
+        return True
+    with open(html_path, "r", encoding="utf-8") as f:
+        return is_placeholder(f.read())
+
+def html_is_valid(text):
+    # A batch section that lost its markup is re-sent rather than saved
+    return "<" in text and ">" in text
+
+def html_job(img_path, html_path, filename, save=None):
+    # save defaults to save_page; run_pipeline.py passes its own to hear about each saved page
+    def build():
+        return [image_part(upload_image(img_path, UPLOAD_PROFILE)), HTML_PROMPT]
+
+    def handle(text):
+        (save or save_page)(html_path, text)
+        return True
+
+    return Job(filename, build, handle)
+
+def html_body(html_path):
+    # The inner content save_html() wrapped, i.e. what Gemini answered
+    with open(html_path, "r", encoding="utf-8") as f:
+        html = f.read()
+    start, end = html.find("<body>"), html.rfind("</body>")
+    return html[start + len("<body>"):end] if start != -1 and end != -1 else html
+
+def revision_job(img_path, html_path, filename, prior_key, prior_path, save=None):
+    # The same page of an earlier edition, for Gemini to correct against this scan
+    prompt = revision_prompt(HTML_PROMPT, html_body(prior_path), prior_key)
+
+    def build():
+        return [image_part(upload_image(img_path, UPLOAD_PROFILE)), prompt]
+
+    def handle(text):
+        (save or save_page)(html_path, text)
+        return True
+
+    return Job(f"{filename} (from {prior_key[1]})", build, handle)
 
 def main():
     # 1. Load Keys
@@ -119,51 +142,54 @@ def main():
         print("No keys found in keys.txt")
         return
 
-    print(f"Found {num_workers} API Keys. Launching {num_workers} parallel threads.")
+    print(f"Found {num_workers} API Keys.")
 
-    # 2. Find all work to be done
+    # 2. Find all work to be done - one indexed query instead of walking processed_data
+    global state
+    state = PipelineState(DATA_DIR)
     all_tasks = []
-    print(f"Scanning {DATA_DIR} for pending images...")
-    
-    for root, dirs, files in os.walk(DATA_DIR):
-        for file in files:
-            if file.lower().endswith((".jpg", ".png")):
-                img_path = os.path.join(root, file)
-                html_dir = root.replace("images", "htmls")
-                os.makedirs(html_dir, exist_ok=True)
-                html_path = os.path.join(html_dir, file.rsplit('.', 1)[0] + ".html")
-                
-                if not os.path.exists(html_path):
-                    all_tasks.append((img_path, html_path, file))
-
-    total_files = len(all_tasks)
+    print("Looking up pages still waiting for HTML...")
+
+    made_dirs = set()
+    revisions = []
+    reused = 0
+    matcher = PageMatcher(state, DATA_DIR) if USE_EARLIER_EDITIONS else None
+    for col_name, book_id, page_num in state.pending("html"):
+        img_path = state.path(col_name, book_id, page_num, "image")
+        html_path = state.path(col_name, book_id, page_num, "html")
+        if os.path.dirname(html_path) not in made_dirs:
+            os.makedirs(os.path.dirname(html_path), exist_ok=True)
+            made_dirs.add(os.path.dirname(html_path))
+
+        prior = prior_page(state, matcher, (col_name, book_id, page_num), "html") if matcher else None
+        if prior is None:
+            all_tasks.append((img_path, html_path, os.path.basename(img_path)))
+        elif prior[0] == "identical":
+            save_page(html_path, html_body(prior[2])) # same page as last year's - nothing to send
+            reused += 1
+        else:
+            revisions.append(revision_job(img_path, html_path, os.path.basename(img_path), prior[1], prior[2]))
+    if matcher:
+        matcher.save()
+        print(f"Earlier editions: {reused} pages copied as they were, {len(revisions)} sent with the earlier page to correct.")
+
+    total_files = len(all_tasks) + len(revisions)
     print(f"Found {total_files} pages needing HTML generation.")
 
     if total_files == 0:
         print("All done! No pages left to process.")
         return
 
-    # 3. Split work evenly among keys
-    # If we have 100 files and 3 keys:
-    # Batch 1 gets 34, Batch 2 gets 33, Batch 3 gets 33.
-    chunk_size = math.ceil(total_files / num_workers)
-    batches = []
-    
-    for i in range(0, total_files, chunk_size):
-        batches.append(all_tasks[i : i + chunk_size])
-
-    # 4. Launch Threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = []
-        for i in range(num_workers):
-            if i < len(batches): # Safety check if we have more keys than files
-                # worker_id, api_key, file_list
-                futures.append(executor.submit(process_batch, i+1, keys[i], batches[i]))
-        
-        # Wait for all to finish
-        concurrent.futures.wait(futures)
-
-    print("\nAll workers finished (or hit quota limits).")
+    # 3. One shared queue drained by every key, each paced by its own token bucket.
+    # A page whose key dies simply goes back on the queue for the live keys.
+    # Pages go BATCH_PAGES to a request; any page a batch garbles is re-sent on its own.
+    engine = GeminiEngine(keys, MODEL_NAME, label="HTML")
+    jobs = build_jobs(all_tasks, BATCH_PAGES, HTML_PROMPT, save_page, html_job, UPLOAD_PROFILE, html_is_valid) + revisions
+    stats = engine.run(jobs)
+
+    print(f"\nAll done. {stats['saved']} requests saved for {total_files} pages.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    telemetry.start("generate_html")
+    with telemetry.phase("html"):
+        main()
\ No newline at end of file
@@ -1,65 +1,100 @@
 import os
 import json
-import cv2
+import concurrent.futures
 import pytesseract
+import telemetry
 from pytesseract import Output
+from coords_pack import PACK_NAME, pack_is_current
+from pipeline_state import PipelineState, FAILED
 
 # --- CONFIGURATION ---
 DATA_DIR = "processed_data"
+MAP_WORKERS = os.cpu_count() or 4
+WORDS_TIMEOUT = 120
 # If Tesseract is not in your PATH, uncomment and set the line below:
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 
-def generate_json_map():
-    print(f"Scanning {DATA_DIR} for images...")
+def extract_word_boxes(img_path, timeout=0):
+    """
+    Word-level bounding boxes for one page.
+    Tesseract reads the JPEG itself, so the page is not decoded and re-encoded in Python first.
+    Also used by the analysis stage in process_project.py right after the orientation check.
+    """
+    # Get word-level bounding boxes
+    with telemetry.stage("words", img_path):
+        d = pytesseract.image_to_data(img_path, output_type=Output.DICT, timeout=timeout)
+
+    word_list = []
+    n_boxes = len(d['text'])
+
+    for i in range(n_boxes):
+        # Filter out empty noise and low confidence garbage
+        if int(d['conf'][i]) > 0 and d['text'][i].strip() != "":
+            word_list.append({
+                "text": d['text'][i],
+                "x": d['left'][i],
+                "y": d['top'][i],
+                "w": d['width'][i],
+                "h": d['height'][i]
+            })
+    return word_list
+
+def write_word_boxes(json_path, word_list):
+    # The page is spooled here until pack_coords() merges it into the book's coords.bin.
+    # Write to a temp file first so a crash never leaves a truncated map behind
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(word_list, f)
+    os.replace(tmp_path, json_path)
+
+def map_page(img_path, json_path):
+    # Runs inside a worker process
+    word_list = extract_word_boxes(img_path, timeout=WORDS_TIMEOUT)
+    write_word_boxes(json_path, word_list)
+    return len(word_list)
+
+def generate_json_map(workers=MAP_WORKERS):
+    state = PipelineState(DATA_DIR)
+    print("Looking up pages without coordinate maps...")
     
+    jobs = []
+    made_dirs = set()
+    for col_name, book_id, page_num in state.pending("coords"):
+        # We save the JSON map in a 'coords' folder next to 'images'
+        # Example: processed_data/IPG/1869/coords/page_001.json
+        json_path = state.path(col_name, book_id, page_num, "coords")
+        if os.path.dirname(json_path) not in made_dirs:
+            os.makedirs(os.path.dirname(json_path), exist_ok=True)
+            made_dirs.add(os.path.dirname(json_path))
+        jobs.append((state.path(col_name, book_id, page_num, "image"), json_path, (col_name, book_id, page_num)))
+
     count = 0
-    for root, dirs, files in os.walk(DATA_DIR):
-        for file in files:
-            if file.lower().endswith((".jpg", ".png")):
-                img_path = os.path.join(root, file)
-                
-                # We save the JSON map in a 'coords' folder next to 'images'
-                # Example: processed_data/IPG/1869/coords/page_001.json
-                coords_dir = root.replace("images", "coords")
-                os.makedirs(coords_dir, exist_ok=True)
-                
-                json_path = os.path.join(coords_dir, file.rsplit('.', 1)[0] + ".json")
-                
-                # Skip if already exists to save time
-                if os.path.exists(json_path):
-                    continue
-                    
-                print(f"Mapping coordinates for: {file}...")
-                
+    if jobs:
+        print(f"Mapping coordinates for {len(jobs)} pages on {workers} workers...")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(map_page, img_path, json_path): (json_path, key) for img_path, json_path, key in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                json_path, key = futures[future]
+                file = os.path.basename(json_path)
                 try:
-                    img = cv2.imread(img_path)
-                    # Get word-level bounding boxes
-                    d = pytesseract.image_to_data(img, output_type=Output.DICT)
-                    
-                    word_list = []
-                    n_boxes = len(d['text'])
-                    
-                    for i in range(n_boxes):
-                        # Filter out empty noise and low confidence garbage
-                        if int(d['conf'][i]) > 0 and d['text'][i].strip() != "":
-                            word_list.append({
-                                "text": d['text'][i],
-                                "x": d['left'][i],
-                                "y": d['top'][i],
-                                "w": d['width'][i],
-                                "h": d['height'][i]
-                            })
-                    
-                    # Save to JSON
-                    with open(json_path, 'w', encoding='utf-8') as f:
-                        json.dump(word_list, f)
-                    
+                    future.result()
+                    state.record(*key, "coords", path=json_path)
                     count += 1
-                        
+                    if count % 25 == 0:
+                        print(f"   Mapped {count}/{len(jobs)} pages...")
                 except Exception as e:
                     print(f"Error processing {file}: {e}")
+                    state.record(*key, "coords", FAILED, error=str(e))
+
+    # Merge each book's spooled page maps into its compact coords.bin
+    for col_name, book_id in state.books():
+        book_dir = os.path.join(DATA_DIR, col_name, book_id)
+        if not pack_is_current(book_dir):
+            print(f"Packing {book_dir} -> {PACK_NAME} ({state.pack_coords(col_name, book_id)} pages)")
 
     print(f"Done! Generated coordinate maps for {count} pages.")
 
 if __name__ == "__main__":
-    generate_json_map()
\ No newline at end of file
+    telemetry.start("generate_overlays")
+    with telemetry.phase("coords"):
+        generate_json_map()
\ No newline at end of file
@@ -0,0 +1,211 @@
+import os
+import re
+from html.parser import HTMLParser
+
+# Deterministic HTML -> Markdown for the generate_html.py pages.
+#
+# Gemini's HTML already holds everything the Markdown transcription does (headings, paragraphs,
+# tables, rules), so texts/*.txt can be derived from htmls/*.html locally instead of sending the
+# same page to the API a second time. The output follows TEXT_PROMPT's conventions: Markdown
+# tables, "---" for dividers, original spelling untouched.
+
+PLACEHOLDER_MARKER = "[OCR Content Pending...]" # written by process_project.py before any OCR
+
+BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "li", "blockquote", "section", "article", "center"}
+SKIP_TAGS = {"style", "script", "head", "title"}
+
+def is_placeholder(html):
+    return PLACEHOLDER_MARKER in html
+
+class MarkdownConverter(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []      # finished Markdown blocks
+        self.inline = []      # text of the block being built
+        self.prefix = ""
+        self.skip = 0
+        self.list_stack = []  # "ul" / ["ol", counter]
+        self.table = None     # list of rows, each a list of cell strings
+        self.tables = []      # every finished table, for gazetteer.py
+        self.row = None
+        self.cell = None
+        self.cell_span = 1
+        self.emphasis = []    # (target list, index of the opening marker)
+        self.list_blocks = {} # block index -> which list it is an item of
+        self.lists_seen = 0
+
+    # --- text helpers ---
+    def _flush(self):
+        text = re.sub(r"[ \t\r\f\v]+", " ", "".join(self.inline))
+        text = "\n".join(line.strip() for line in text.split("\n")).strip()
+        if text:
+            if self.list_stack and self.prefix:
+                self.list_blocks[len(self.blocks)] = self.lists_seen
+            self.blocks.append(self.prefix + text)
+        self.inline = []
+        self.prefix = ""
+
+    def _target(self):
+        return self.cell if self.cell is not None else self.inline
+
+    def _write(self, text):
+        self._target().append(text)
+
+    def _open_emphasis(self, marker):
+        target = self._target()
+        self.emphasis.append((target, len(target)))
+        target.append(marker)
+
+    def _close_emphasis(self, marker):
+        if not self.emphasis:
+            return
+        target, start = self.emphasis.pop()
+        if target is not self._target() or start >= len(target):
+            return # the block was flushed in between
+        if not "".join(target[start + 1:]).strip():
+            del target[start] # <b> </b> around nothing - drop it
+        else:
+            target.append(marker)
+
+    # --- parser callbacks ---
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip += 1
+            return
+        if self.skip:
+            return
+
+        if tag == "table":
+            self._flush()
+            self.table = []
+        elif tag == "tr" and self.table is not None:
+            self.row = []
+        elif tag in ("td", "th") and self.row is not None:
+            self.cell = []
+            span = dict(attrs).get("colspan", "1")
+            self.cell_span = int(span) if span and span.isdigit() else 1
+        elif tag == "br":
+            self._write(" " if self.cell is not None else "\n")
+        elif tag == "hr":
+            self._flush()
+            self.blocks.append("---")
+        elif tag in ("b", "strong"):
+            self._open_emphasis("**")
+        elif tag in ("i", "em"):
+            self._open_emphasis("*")
+        elif tag in ("ul", "ol"):
+            self._flush()
+            if not self.list_stack:
+                self.lists_seen += 1
+            self.list_stack.append("ul" if tag == "ul" else ["ol", 0])
+        elif tag in BLOCK_TAGS:
+            self._flush()
+            if tag[0] == "h" and tag[1:].isdigit():
+                self.prefix = "#" * int(tag[1:]) + " "
+            elif tag == "li" and self.list_stack:
+                top = self.list_stack[-1]
+                if top == "ul":
+                    self.prefix = "  " * (len(self.list_stack) - 1) + "- "
+                else:
+                    top[1] += 1
+                    self.prefix = "  " * (len(self.list_stack) - 1) + f"{top[1]}. "
+            elif tag == "blockquote":
+                self.prefix = "> "
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+            return
+        if self.skip:
+            return
+
+        if tag in ("td", "th") and self.cell is not None:
+            text = re.sub(r"\s+", " ", "".join(self.cell)).strip()
+            self.row.append(text)
+            self.row.extend([""] * (self.cell_span - 1))
+            self.cell = None
+        elif tag == "tr" and self.row is not None:
+            if self.row:
+                self.table.append(self.row)
+            self.row = None
+        elif tag == "table" and self.table is not None:
+            if self.table:
+                self.tables.append(self.table)
+                self.blocks.append(format_table(self.table))
+            self.table = None
+        elif tag in ("b", "strong"):
+            self._close_emphasis("**")
+        elif tag in ("i", "em"):
+            self._close_emphasis("*")
+        elif tag in ("ul", "ol"):
+            self._flush()
+            if self.list_stack:
+                self.list_stack.pop()
+        elif tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self.skip:
+            self._write(data)
+
+    def markdown(self):
+        self._flush()
+        if self.table:
+            self.tables.append(self.table)
+            self.blocks.append(format_table(self.table))
+            self.table = None
+        # Blank line between blocks, but the items of one list stay together
+        out = []
+        for i, block in enumerate(self.blocks):
+            if out:
+                same_list = i in self.list_blocks and self.list_blocks.get(i - 1) == self.list_blocks[i]
+                out.append("\n" if same_list else "\n\n")
+            out.append(block)
+        return "".join(out) + "\n"
+
+def format_table(rows):
+    # The first row is the header, as in TEXT_PROMPT's Markdown tables
+    width = max(len(r) for r in rows)
+    rows = [[c.replace("|", "\\|") for c in r] + [""] * (width - len(r)) for r in rows]
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + "---|" * width]
+    lines += ["| " + " | ".join(r) + " |" for r in rows[1:]]
+    return "\n".join(lines)
+
+def html_to_markdown(html):
+    converter = MarkdownConverter()
+    converter.feed(html)
+    converter.close()
+    return converter.markdown()
+
+def html_tables(html):
+    """Every <table> of the page as a list of rows of cell strings (Markdown emphasis left in)."""
+    converter = MarkdownConverter()
+    converter.feed(html)
+    converter.close()
+    converter.markdown()
+    return converter.tables
+
+def derive_text(html_path, txt_path):
+    """
+    Writes txt_path from html_path. Returns False (and writes nothing) if the HTML is still
+    process_project.py's placeholder or converts to nothing.
+    """
+    with open(html_path, "r", encoding="utf-8") as f:
+        html = f.read()
+    if is_placeholder(html):
+        return False
+    text = html_to_markdown(html)
+    if not text.strip():
+        return False
+    os.makedirs(os.path.dirname(txt_path), exist_ok=True)
+    with open(txt_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return True
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 2:
+        print("Usage: python html_markdown.py processed_data/IPG/1869/htmls/page_007.html")
+        sys.exit(1)
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        print(html_to_markdown(f.read()))
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# Content-addressed cache for every Gemini response (texts, htmls, overlay repair).
+#
+# The key is a SHA-256 over the model name, the request config and every input part
+# (image bytes, prompt text), so a re-rendered page with identical pixels, an emptied .txt or a
+# deleted .html is answered from disk instead of the API. Change the prompt or the model and
+# the key changes with it.
+#
+# Layout: llm_cache/ab/abcdef....json  ({"model", "created", "text"})
+#         llm_cache/stats.json          running hit/miss totals
+# It lives next to processed_data/, not inside it, so no script ever mistakes it for a collection.
+
+CACHE_DIR = "llm_cache"
+
+def _part_bytes(item):
+    # Bytes that identify one element of a generate_content 'contents' list
+    if isinstance(item, str):
+        return b"text:" + item.encode("utf-8")
+    if isinstance(item, bytes):
+        return b"bytes:" + item
+    inline = getattr(item, "inline_data", None)
+    if inline is not None and inline.data is not None:
+        return f"blob:{inline.mime_type}:".encode("utf-8") + inline.data
+    text = getattr(item, "text", None)
+    if text is not None:
+        return b"text:" + text.encode("utf-8")
+    raise TypeError(f"Cannot cache a request containing {type(item).__name__}")
+
+class LLMCache:
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+
+    def key(self, model, contents, config=None):
+        """
+        Returns the cache key for one request, or None if it contains something we cannot hash.
+        """
+        digest = hashlib.sha256()
+        digest.update(f"model:{model}\n".encode("utf-8"))
+        if config is not None:
+            settings = config.model_dump_json(exclude_none=True) if hasattr(config, "model_dump_json") else repr(config)
+            digest.update(f"config:{settings}\n".encode("utf-8"))
+        items = contents if isinstance(contents, (list, tuple)) else [contents]
+        try:
+            for item in items:
+                data = _part_bytes(item)
+                digest.update(len(data).to_bytes(8, "little"))
+                digest.update(data)
+        except TypeError:
+            return None
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        # Raw response text, or None on a miss
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                text = json.load(f)["text"]
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return text
+
+    def put(self, key, text, model):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": model, "created": time.time(), "text": text}, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.stores += 1
+
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def save_stats(self):
+        # Adds this run's counters to the running totals in stats.json
+        totals = self.load_stats()
+        with self.lock:
+            totals["hits"] += self.hits
+            totals["misses"] += self.misses
+            totals["stores"] += self.stores
+            self.hits = self.misses = self.stores = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, "stats.json"), "w") as f:
+            json.dump(totals, f, indent=4)
+
+    def load_stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, "stats.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0, "stores": 0}
+
+    def entries(self):
+        # [(path, size, mtime)] for every cached response
+        found = []
+        if not os.path.isdir(self.cache_dir):
+            return found
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if name.endswith(".json"):
+                    path = os.path.join(shard_dir, name)
+                    st = os.stat(path)
+                    found.append((path, st.st_size, st.st_mtime))
+        return found
+
+    def evict(self, max_bytes=None, max_age_days=None):
+        """
+        Drops entries older than max_age_days, then the oldest entries until the cache fits in
+        max_bytes. Returns (entries_removed, bytes_freed).
+        """
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        removed, freed = 0, 0
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400
+            keep = []
+            for path, size, mtime in entries:
+                if mtime < cutoff:
+                    os.remove(path)
+                    removed, freed = removed + 1, freed + size
+                else:
+                    keep.append((path, size, mtime))
+            entries = keep
+        if max_bytes is not None:
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+                removed, freed = removed + 1, freed + size
+        return removed, freed
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect or trim the Gemini response cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="Show size and hit/miss totals")
+    evict_cmd = sub.add_parser("evict", help="Remove old entries or shrink the cache")
+    evict_cmd.add_argument("--max-mb", type=float, help="Keep at most this many megabytes (oldest go first)")
+    evict_cmd.add_argument("--max-age-days", type=float, help="Remove entries older than this")
+    args = parser.parse_args()
+
+    cache = LLMCache()
+    if args.command == "stats":
+        entries = cache.entries()
+        totals = cache.load_stats()
+        lookups = totals["hits"] + totals["misses"]
+        print(f"{len(entries)} responses, {sum(e[1] for e in entries) / 1e6:.1f} MB in {CACHE_DIR}/")
+        print(f"Hits: {totals['hits']}  Misses: {totals['misses']}  "
+              f"Hit rate: {totals['hits'] / lookups:.1%}" if lookups else "No lookups recorded yet.")
+    else:
+        max_bytes = int(args.max_mb * 1e6) if args.max_mb is not None else None
+        removed, freed = cache.evict(max_bytes=max_bytes, max_age_days=args.max_age_days)
+        print(f"Removed {removed} responses ({freed / 1e6:.1f} MB).")
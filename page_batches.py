@@ -0,0 +1,226 @@
+import os
+import re
+import time
+import shutil
+import difflib
+from gemini_engine import GeminiEngine, Job, image_part
+from upload_variants import upload_image
+from pipeline_state import parse_page, load_ocr_script
+
+# Batched transcription: K consecutive pages of one book in a single generate_content call.
+#
+# Under a per-minute request limit the number of round-trips, not the tokens, is what caps our
+# throughput, and every single-page request repeats the whole prompt. A batch sends the K images
+# (each preceded by its page name), one copy of the prompt, and asks for the answers between
+# delimiter lines:
+#
+#   ===== PAGE page_007 =====
+#   ...page 7...
+#   ===== PAGE page_008 =====
+#   ...page 8...
+#
+# The response is split on those lines; every page that is missing, duplicated or empty is
+# re-sent on its own as a normal single-page job, so a bad batch costs at most K extra requests.
+#
+# Pick K with:  python page_batches.py --mode text --sizes 1 2 4 8
+
+DATA_DIR = "processed_data"
+KEY_FILE = "keys.txt"
+BENCH_PAGES = 16
+BENCH_MAX_MALFORMED = 0.10 # a K that loses more pages than this is not worth it
+BENCH_MAX_AGREEMENT_DROP = 0.02 # ...or that agrees this much less with the existing output than K=1
+BENCH_DIR = "batch_benchmark"
+
+MARKER = re.compile(r"^\s*=+\s*PAGE\s+(\S+?)\s*=+\s*$", re.MULTILINE)
+
+def marker(name):
+    return f"===== PAGE {name} ====="
+
+def batch_prompt(prompt, names):
+    return f"""
+    You are given {len(names)} consecutive pages of the same book, in order: {", ".join(names)}.
+    Handle EACH page separately, following these instructions for every page:
+    {prompt}
+    OUTPUT FORMAT FOR THE BATCH:
+    Before each page's output write the line "{marker('<name>')}" with the page name given
+    above the image, e.g. "{marker(names[0])}". Output every page, in order, and nothing else.
+    """
+
+def split_batch(text, names):
+    """
+    Splits a batched response into {name: section}.
+    Returns (sections, malformed) where malformed lists the names that must be re-sent.
+    """
+    found = {}
+    duplicated = set()
+    matches = list(MARKER.finditer(text))
+    for i, match in enumerate(matches):
+        name = match.group(1)
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        if name in found:
+            duplicated.add(name)
+        found[name] = text[match.end():end].strip()
+
+    sections, malformed = {}, []
+    for name in names:
+        if name in duplicated or not found.get(name):
+            malformed.append(name)
+        else:
+            sections[name] = found[name]
+    return sections, malformed
+
+def batch_job(pages, prompt, save_page, single_job, upload_profile, validate=None, rejected=None):
+    """
+    pages:      [(img_path, out_path, filename)] - consecutive pages of one book
+    save_page:  save_page(out_path, section) writes one page's output
+    single_job: single_job(img_path, out_path, filename) -> Job, used to re-send bad pages
+    validate:   optional validate(section) -> bool for format checks beyond "not empty"
+    rejected:   optional list; the name of every page whose section was missing or failed
+                validate is appended to it (the benchmark counts them)
+    """
+    names = [filename.rsplit('.', 1)[0] for _, _, filename in pages]
+
+    def build():
+        contents = []
+        for name, (img_path, _, _) in zip(names, pages):
+            contents.append(f"Page {name}:")
+            contents.append(image_part(upload_image(img_path, upload_profile)))
+        contents.append(batch_prompt(prompt, names))
+        return contents
+
+    def handle(text):
+        sections, malformed = split_batch(text, names)
+        follow_ups = []
+        for name, (img_path, out_path, filename) in zip(names, pages):
+            section = sections.get(name)
+            if section is None or (validate is not None and not validate(section)):
+                follow_ups.append(single_job(img_path, out_path, filename))
+                if rejected is not None:
+                    rejected.append(name)
+            else:
+                save_page(out_path, section)
+        if follow_ups:
+            print(f"   -> {names[0]}..{names[-1]}: {len(follow_ups)}/{len(pages)} pages malformed, re-sending singly.")
+        # A list tells the engine the batch is done but these pages still need their own request
+        return follow_ups or True
+
+    return Job(f"{names[0]}..{names[-1]} ({len(pages)} pages)", build, handle)
+
+def make_batches(tasks, size):
+    """
+    Groups [(img_path, out_path, filename)] into runs of at most `size` consecutive pages of the
+    same book. A gap in the page numbers (pages already done) always starts a new batch.
+    size <= 1 gives one page per batch.
+    """
+    by_book = {}
+    for task in tasks:
+        by_book.setdefault(os.path.dirname(task[0]), []).append(task)
+    batches = []
+    for book in sorted(by_book):
+        previous = None
+        for task in sorted(by_book[book], key=lambda t: t[2]):
+            page = parse_page(task[2], os.path.splitext(task[2])[1])
+            if previous is None or page != previous + 1 or len(batches[-1]) >= max(size, 1):
+                batches.append([])
+            batches[-1].append(task)
+            previous = page
+    return batches
+
+def build_jobs(tasks, size, prompt, save_page, single_job, upload_profile, validate=None, rejected=None):
+    # Single pages keep using the normal job so their cache entries stay valid
+    jobs = []
+    for batch in make_batches(tasks, size):
+        if len(batch) == 1:
+            jobs.append(single_job(*batch[0]))
+        else:
+            jobs.append(batch_job(batch, prompt, save_page, single_job, upload_profile, validate, rejected))
+    return jobs
+
+def benchmark(mode, sizes, sample_size=BENCH_PAGES):
+    """
+    Re-transcribes the same run of already-finished pages with each batch size and reports
+    requests, wall time, malformed pages and agreement with the existing output. Results go to
+    a scratch folder; nothing in processed_data is touched. Caching is off so timings are real.
+    """
+    if mode == "html":
+        import generate_html as script
+        prompt, key_specs, model = script.HTML_PROMPT, script.load_keys(KEY_FILE), script.MODEL_NAME
+        folder, ext = "htmls", ".html"
+        save_page, single_job, validate = script.save_html, script.html_job, script.html_is_valid
+    else:
+        from rate_limit import load_key_specs
+        script = load_ocr_script()
+        prompt, key_specs, model = script.TEXT_PROMPT, load_key_specs(KEY_FILE), script.MODEL_NAME
+        folder, ext = "texts", ".txt"
+        save_page, single_job, validate = script.save_text, script.text_job, None
+
+    # The first finished pages of the first book that has enough of them
+    sample = []
+    for col_name in sorted(os.listdir(DATA_DIR)):
+        col_path = os.path.join(DATA_DIR, col_name)
+        if not os.path.isdir(col_path) or sample: continue
+        for book_id in sorted(os.listdir(col_path)):
+            out_dir = os.path.join(col_path, book_id, folder)
+            img_dir = os.path.join(col_path, book_id, "images")
+            if not os.path.isdir(out_dir): continue
+            done = [f for f in sorted(os.listdir(out_dir)) if f.endswith(ext) and os.path.getsize(os.path.join(out_dir, f)) > 0]
+            if mode == "html":
+                done = [f for f in done if not script.html_is_pending(os.path.join(out_dir, f))]
+            if len(done) >= sample_size:
+                sample = [(os.path.join(img_dir, f.replace(ext, ".jpg")), os.path.join(out_dir, f)) for f in done[:sample_size]]
+                break
+    if not sample:
+        print(f"Need a book with at least {sample_size} finished {folder} to benchmark.")
+        return
+
+    print(f"Benchmarking batch sizes {sizes} on {len(sample)} pages ({mode})...\n")
+    results = []
+    for size in sizes:
+        scratch = os.path.join(BENCH_DIR, f"k{size}")
+        shutil.rmtree(scratch, ignore_errors=True)
+        os.makedirs(scratch)
+        tasks = [(img_path, os.path.join(scratch, os.path.basename(ref_path)), os.path.basename(img_path))
+                 for img_path, ref_path in sample]
+        engine = GeminiEngine(key_specs, model, label=f"K={size}", use_cache=False)
+        rejected = []
+        jobs = build_jobs(tasks, size, prompt, save_page, single_job, script.UPLOAD_PROFILE, validate, rejected)
+        started = time.monotonic()
+        stats = engine.run(jobs)
+        elapsed = time.monotonic() - started
+
+        agreements = []
+        for (_, ref_path), (_, out_path, _) in zip(sample, tasks):
+            if os.path.exists(out_path):
+                with open(ref_path, "r", encoding="utf-8") as f:
+                    reference = f.read()
+                with open(out_path, "r", encoding="utf-8") as f:
+                    agreements.append(difflib.SequenceMatcher(None, reference, f.read(), autojunk=False).ratio())
+        # Sections the batch answer lost or that failed validation; 429/5xx retries are not malformed
+        results.append({
+            "size": size,
+            "requests": stats["requests"],
+            "seconds_per_page": elapsed / len(sample),
+            "malformed": len(rejected) / len(sample),
+            "agreement": sum(agreements) / max(len(agreements), 1)
+        })
+
+    print(f"\n   {'K':>3} {'requests':>9} {'s/page':>8} {'malformed':>10} {'agreement':>10}")
+    for r in results:
+        print(f"   {r['size']:>3} {r['requests']:>9} {r['seconds_per_page']:>8.1f} {r['malformed']:>10.0%} {r['agreement']:>10.1%}")
+
+    usable = [r for r in results if r["malformed"] <= BENCH_MAX_MALFORMED]
+    single = [r for r in results if r["size"] == 1]
+    if single:
+        usable = [r for r in usable if r["agreement"] >= single[0]["agreement"] - BENCH_MAX_AGREEMENT_DROP]
+    if usable:
+        best = min(usable, key=lambda r: (r["requests"], r["seconds_per_page"]))
+        print(f"\nSuggested BATCH_PAGES = {best['size']}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark batched transcription to choose BATCH_PAGES")
+    parser.add_argument("--mode", choices=["text", "html"], default="text")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--pages", type=int, default=BENCH_PAGES)
+    args = parser.parse_args()
+    benchmark(args.mode, args.sizes, args.pages)
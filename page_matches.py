@@ -0,0 +1,301 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from PIL import Image
+from pipeline_state import PipelineState, DONE, page_stem
+from search_index import terms_of
+from coords_pack import load_words
+
+# Cross-edition near-duplicates: processed_data/<collection>/<book>/matches.json
+#
+# The IPG guides are annual editions, and most pages of 1870 are the 1869 page with a few names
+# or dates changed. Every page gets two fingerprints:
+#   dhash    64-bit difference hash of the scan (layout: columns, tables, rules)
+#   simhash  64-bit SimHash of the Tesseract words in coords/ (content, robust to OCR noise)
+# A page is compared with every page of the *earlier* editions of the same collection: the
+# SHORTLIST nearest by simhash are re-ranked by the exact Jaccard overlap of their word sets.
+#
+#   identical  Jaccard >= IDENTICAL_JACCARD and dhash within IDENTICAL_IMAGE_BITS: the earlier
+#              transcription is copied, no API call (if REUSE_IDENTICAL is on). Two scans of the
+#              same page never OCR to exactly the same words, so this allows a stray misread in a
+#              hundred words - but a 400-word directory page with five new names (about 0.97)
+#              is still only similar.
+#   similar    Jaccard >= SIMILAR_JACCARD: Gemini gets the earlier transcription to correct
+#              against the new scan instead of transcribing from nothing
+#
+# Fingerprints are cached per book in fingerprints.json, keyed by the image and coords hashes,
+# so only new or rotated pages are read again.
+#
+#   python page_matches.py            fingerprint + match every page that has word boxes
+#   python page_matches.py --report   how many pages of each book could be reused
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+MATCH_FILE = "matches.json"
+FINGERPRINT_FILE = "fingerprints.json"
+SHORTLIST = 8
+IDENTICAL_JACCARD = 0.98
+IDENTICAL_IMAGE_BITS = 6
+SIMILAR_JACCARD = 0.6
+REUSE_IDENTICAL = True # False: identical pages are sent for correction like similar ones
+MIN_TOKENS = 20 # pages with fewer words (plates, blank versos) are never matched
+
+# Popcount of every byte value, for Hamming distances over uint64 arrays
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def edition_key(book):
+    # "1869" < "1870" < "1870-2"; numbers compare as numbers
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", book)]
+
+def dhash(img_path, size=8):
+    with Image.open(img_path) as im:
+        im.draft("L", (size * 16, size * 16)) # decode at reduced size, like the orientation pre-filter
+        gray = np.asarray(im.convert("L").resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+def simhash(tokens):
+    # Words and word pairs, so a reordered table is not the same page
+    features = tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+    if not features:
+        return 0
+    hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                       for f in features], dtype="<u8")
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(features) # +1 per feature with the bit set, -1 without
+    return int(np.packbits(votes > 0, bitorder="little").view("<u8")[0])
+
+def hamming(values, value):
+    # values: uint64 array; distance of each to value
+    xor = np.bitwise_xor(values, np.uint64(value))
+    return POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def page_tokens(coords_path):
+    tokens = []
+    for word in load_words(coords_path):
+        tokens.extend(terms_of(word.get("text", "")))
+    return tokens
+
+class PageMatcher:
+    """
+        matcher = PageMatcher(state)
+        match = matcher.match(("IPG", "1870", 12))   # {"collection", "book", "page", "kind", ...} or None
+        matcher.save()                                # fingerprints.json / matches.json of changed books
+    """
+
+    def __init__(self, state, data_dir=DATA_DIR):
+        self.state = state
+        self.data_dir = data_dir
+        self.books = {}      # (collection, book) -> {page stem: fingerprint}
+        self.dirty = set()   # books whose fingerprints.json needs writing
+        self.matches = {}    # (collection, book) -> {page stem: match}, loaded on first use
+        self.changed = set() # books whose matches.json needs writing
+        self.arrays = {}     # collection -> arrays over every fingerprinted page, rebuilt when stale
+
+    # --- fingerprints ---
+    def _book(self, collection, book):
+        if (collection, book) not in self.books:
+            path = os.path.join(self.data_dir, collection, book, FINGERPRINT_FILE)
+            try:
+                with open(path, "r") as f:
+                    self.books[(collection, book)] = json.load(f)
+            except (OSError, ValueError):
+                self.books[(collection, book)] = {}
+        return self.books[(collection, book)]
+
+    def fingerprint(self, key):
+        """Fingerprint of one page, computed only if its image or word boxes changed. None without word boxes."""
+        collection, book, page = key
+        if self.state.status(*key, "coords") != DONE:
+            return None
+        fingerprints = self._book(collection, book)
+        image_sha = (self.state.file_hash(*key, "image") or "")[:16]
+        coords_sha = (self.state.file_hash(*key, "coords") or "")[:16]
+        stem = page_stem(page)
+        cached = fingerprints.get(stem)
+        if cached and cached["image"] == image_sha and cached["coords"] == coords_sha:
+            return cached
+
+        tokens = page_tokens(self.state.path(*key, "coords"))
+        fp = {
+            "image": image_sha,
+            "coords": coords_sha,
+            "dhash": f"{dhash(self.state.path(*key, 'image')):016x}",
+            "simhash": f"{simhash(tokens):016x}",
+            "tokens": sorted(set(tokens)),
+        }
+        fingerprints[stem] = fp
+        self.dirty.add((collection, book))
+        self.arrays.pop(collection, None)
+        return fp
+
+    def load_collection(self, collection):
+        # Fingerprints every page of the collection that has word boxes (cached ones are free)
+        for c, book in self.state.books():
+            if c != collection:
+                continue
+            for page, stages in self.state.book_pages(c, book).items():
+                if stages.get("coords") == DONE:
+                    self.fingerprint((c, book, page))
+
+    def _arrays(self, collection):
+        if collection not in self.arrays:
+            self.load_collection(collection)
+            entries = []
+            for (c, book), fingerprints in self.books.items():
+                if c != collection:
+                    continue
+                for stem, fp in fingerprints.items():
+                    if len(fp["tokens"]) >= MIN_TOKENS:
+                        entries.append((book, stem, fp))
+            self.arrays[collection] = {
+                "entries": entries,
+                "order": [edition_key(book) for book, _, _ in entries],
+                "simhash": np.array([int(fp["simhash"], 16) for _, _, fp in entries], dtype=np.uint64),
+                "dhash": np.array([int(fp["dhash"], 16) for _, _, fp in entries], dtype=np.uint64),
+            }
+        return self.arrays[collection]
+
+    # --- matching ---
+    def match(self, key):
+        """
+        Closest page of an earlier edition, or None. The result is also kept for matches.json.
+        """
+        collection, book, page = key
+        fp = self.fingerprint(key)
+        result = None
+        if fp is not None and len(fp["tokens"]) >= MIN_TOKENS:
+            arrays = self._arrays(collection)
+            this_edition = edition_key(book)
+            earlier = np.array([order < this_edition for order in arrays["order"]], dtype=bool)
+            if earlier.any():
+                text_bits = hamming(arrays["simhash"], int(fp["simhash"], 16))
+                text_bits = np.where(earlier, text_bits, 65)
+                tokens = set(fp["tokens"])
+                best = None
+                for i in np.argsort(text_bits, kind="stable")[:SHORTLIST]:
+                    if text_bits[i] > 64:
+                        break
+                    other_book, other_stem, other = arrays["entries"][i]
+                    other_tokens = set(other["tokens"])
+                    jaccard = len(tokens & other_tokens) / max(len(tokens | other_tokens), 1)
+                    if best is None or jaccard > best[0]:
+                        best = (jaccard, i, other_book, other_stem)
+                if best is not None and best[0] >= SIMILAR_JACCARD:
+                    jaccard, i, other_book, other_stem = best
+                    image_bits = int(hamming(arrays["dhash"][i:i + 1], int(fp["dhash"], 16))[0])
+                    identical = jaccard >= IDENTICAL_JACCARD and image_bits <= IDENTICAL_IMAGE_BITS
+                    result = {
+                        "collection": collection,
+                        "book": other_book,
+                        "page": int(other_stem[5:]),
+                        "kind": "identical" if identical else "similar",
+                        "jaccard": round(jaccard, 3),
+                        "text_bits": int(text_bits[i]),
+                        "image_bits": image_bits,
+                    }
+
+        matches = self.book_matches(collection, book)
+        if matches.get(page_stem(page)) != result:
+            if result is None:
+                matches.pop(page_stem(page), None)
+            else:
+                matches[page_stem(page)] = result
+            self.changed.add((collection, book))
+        return result
+
+    def book_matches(self, collection, book):
+        if (collection, book) not in self.matches:
+            path = os.path.join(self.data_dir, collection, book, MATCH_FILE)
+            try:
+                with open(path, "r") as f:
+                    self.matches[(collection, book)] = json.load(f)
+            except (OSError, ValueError):
+                self.matches[(collection, book)] = {}
+        return self.matches[(collection, book)]
+
+    def save(self):
+        for collection, book in self.dirty:
+            write_json(os.path.join(self.data_dir, collection, book, FINGERPRINT_FILE), self.books[(collection, book)], compact=True)
+        for collection, book in self.changed:
+            write_json(os.path.join(self.data_dir, collection, book, MATCH_FILE), self.matches[(collection, book)])
+        self.dirty.clear()
+        self.changed.clear()
+
+def write_json(path, data, compact=False):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        if compact:
+            json.dump(data, f, separators=(",", ":"))
+        else:
+            json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def prior_page(state, matcher, key, stage):
+    """
+    (kind, prior_key, prior_path) when the page matches a page of an earlier edition whose
+    `stage` (html or text) is done, else None.
+    """
+    match = matcher.match(key)
+    if match is None:
+        return None
+    prior_key = (match["collection"], match["book"], match["page"])
+    if state.status(*prior_key, stage) != DONE:
+        return None
+    kind = match["kind"] if REUSE_IDENTICAL else "similar"
+    return kind, prior_key, state.path(*prior_key, stage)
+
+def revision_prompt(prompt, prior, prior_key):
+    return f"""
+    Below is the transcription of this same page from the {prior_key[1]} edition of the guide.
+    The page in the image is a later edition: names, dates, figures, rows or whole paragraphs may
+    differ. Correct the earlier transcription so that it matches THIS image exactly, and follow
+    these instructions for the result:
+    {prompt}
+    EARLIER TRANSCRIPTION:
+    {prior}
+    """
+
+def update_matches(data_dir=DATA_DIR):
+    """Fingerprints and matches every page with word boxes. Returns {kind: count}."""
+    state = PipelineState(data_dir)
+    matcher = PageMatcher(state, data_dir)
+    counts = {"identical": 0, "similar": 0, "none": 0}
+    for collection, book in sorted(state.books(), key=lambda cb: (cb[0], edition_key(cb[1]))):
+        for page, stages in sorted(state.book_pages(collection, book).items()):
+            if stages.get("coords") != DONE:
+                continue
+            match = matcher.match((collection, book, page))
+            counts[match["kind"] if match else "none"] += 1
+        matcher.save()
+    state.close()
+    return counts
+
+def report(data_dir=DATA_DIR):
+    state = PipelineState(data_dir)
+    for collection, book in sorted(state.books(), key=lambda cb: (cb[0], edition_key(cb[1]))):
+        path = os.path.join(data_dir, collection, book, MATCH_FILE)
+        if not os.path.exists(path):
+            continue
+        with open(path, "r") as f:
+            matches = json.load(f)
+        kinds = {}
+        for match in matches.values():
+            kinds[match["kind"]] = kinds.get(match["kind"], 0) + 1
+        sources = sorted({m["book"] for m in matches.values()}, key=edition_key)
+        print(f"   {collection}/{book}: {kinds.get('identical', 0)} identical, {kinds.get('similar', 0)} similar"
+              f" (from {', '.join(sources) or '-'})")
+    state.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Link every page to its closest page in an earlier edition")
+    parser.add_argument("--report", action="store_true", help="Only summarise the existing matches.json files")
+    args = parser.parse_args()
+    if args.report:
+        report()
+    else:
+        counts = update_matches()
+        print(f"Matched pages: {counts['identical']} identical, {counts['similar']} similar, {counts['none']} without a match.")
@@ -0,0 +1,527 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from html_markdown import PLACEHOLDER_MARKER
+from coords_pack import PACK_NAME, CoordsPack, pack_book, page_words, words_sha256
+
+# One manifest for every stage of every page: processed_data/pipeline_state.db
+#
+# Each script used to find its work with a full os.walk over processed_data plus an exists() or
+# getsize() per file - thousands of stat calls on the G: drive before the first page was touched.
+# Now each stage records its result here as it writes its output, and "what is left to do" is an
+# indexed query. The tree is walked only once, the first time the database is created (or when
+# you run `python pipeline_state.py sync` after moving files around by hand).
+#
+# Stages, keyed by (collection, book, page):
+#   image   images/page_NNN.jpg          rendered by process_project.py
+#   audit   audit_log.json entry         orientation check, process_project.py
+#   coords  coords.bin (per book)        Tesseract word boxes, spooled to coords/page_NNN.json until packed
+#   html    htmls/page_NNN.html          generate_html.py ("[OCR Content Pending...]" counts as pending)
+#   text    texts/page_NNN.txt           run_gemini_ocr_v2.py.py or derived from the HTML (empty = pending)
+#   clean   coords/page_NNN_clean.json   repair_json.py
+#   tiles   tiles/page_NNN.dzi           DZI pyramid for the viewer, tiles.py
+#   thumb   thumbs/page_NNN.jpg          thumbnail, tiles.py
+#
+# Every derived result also stores `inputs`: the SHA-256 of what it was built from (INPUTS below).
+# When a page is rotated after its coords, html or text were made, those hashes stop matching;
+# `python pipeline_state.py rebuild --stale` marks exactly those results (and what was built from
+# them) pending again and re-runs the stages, instead of rebuilding the whole corpus.
+
+DATA_DIR = "processed_data"
+STATE_DB = os.path.join(DATA_DIR, "pipeline_state.db")
+
+DONE = "done"
+PENDING = "pending"
+FAILED = "failed"
+
+STAGE_FILES = {
+    "image": ("images", ".jpg"),
+    "coords": ("coords", ".json"),
+    "html": ("htmls", ".html"),
+    "text": ("texts", ".txt"),
+    "clean": ("coords", "_clean.json"),
+    "tiles": ("tiles", ".dzi"),
+    "thumb": ("thumbs", ".jpg"),
+}
+
+# What each derived stage is built from, in the order the stages run
+INPUTS = {
+    "coords": ("image",),
+    "html": ("image",),
+    "text": ("image",), # directly, or through the html it was derived from
+    "clean": ("coords", "text"),
+    "tiles": ("image",),
+    "thumb": ("image",),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    collection TEXT NOT NULL,
+    book       TEXT NOT NULL,
+    page       INTEGER NOT NULL,
+    stage      TEXT NOT NULL,
+    status     TEXT NOT NULL,
+    path       TEXT,
+    size       INTEGER,
+    sha256     TEXT,
+    created    REAL,
+    updated    REAL,
+    error      TEXT,
+    inputs     TEXT,
+    PRIMARY KEY (collection, book, page, stage)
+);
+CREATE INDEX IF NOT EXISTS pages_by_stage ON pages (stage, status);
+"""
+
+def page_stem(page):
+    return f"page_{page:03d}"
+
+def parse_page(filename, suffix):
+    # page_007.json -> 7 for suffix ".json"; None for anything else (page_007_clean.json included)
+    if not filename.startswith("page_") or not filename.endswith(suffix):
+        return None
+    digits = filename[5:-len(suffix)]
+    return int(digits) if digits.isdigit() else None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class PipelineState:
+    """
+        state = PipelineState()
+        for collection, book, page in state.pending("coords"):
+            ...
+            state.record(collection, book, page, "coords", path=json_path)
+
+    Safe to share between the threads of one process; worker processes should hand their
+    results back to the parent and let it record them.
+    """
+
+    def __init__(self, data_dir=DATA_DIR, db_path=None):
+        self.data_dir = data_dir
+        self.db_path = db_path or os.path.join(data_dir, os.path.basename(STATE_DB))
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(pages)")}
+        if "inputs" not in columns: # manifest made before input hashes were tracked
+            self.db.execute("ALTER TABLE pages ADD COLUMN inputs TEXT")
+        if self.db.execute("SELECT 1 FROM pages LIMIT 1").fetchone() is None:
+            print(f"   Building the pipeline manifest from {data_dir} (first run only)...")
+            self.sync()
+
+    def close(self):
+        self.db.close()
+
+    def path(self, collection, book, page, stage):
+        folder, suffix = STAGE_FILES[stage]
+        return os.path.join(self.data_dir, collection, book, folder, page_stem(page) + suffix)
+
+    def record(self, collection, book, page, stage, status=DONE, path=None, error=None, with_hash=True):
+        """
+        Upserts one stage result. Size (and the SHA-256, unless with_hash is off) are read from
+        `path` when it exists. A finished derived stage also stores the hash of its inputs as
+        they are right now, so record it after the output is written, not before.
+        """
+        size, sha = None, None
+        if path is not None and os.path.exists(path):
+            size = os.path.getsize(path)
+            sha = self._output_sha(collection, book, page, stage, path) if with_hash else None
+        inputs = self.input_hash(collection, book, page, stage) if status == DONE and stage in INPUTS else None
+        now = time.time()
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO pages (collection, book, page, stage, status, path, size, sha256, created, updated, error, inputs)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (collection, book, page, stage) DO UPDATE SET
+                    status = excluded.status, path = excluded.path, size = excluded.size,
+                    sha256 = excluded.sha256, updated = excluded.updated, error = excluded.error,
+                    inputs = excluded.inputs
+            """, (collection, book, page, stage, status, path, size, sha, now, now, error, inputs))
+            self.db.commit()
+
+    def file_hash(self, collection, book, page, stage):
+        # Stored SHA-256 of a stage's output; hashed (and stored) now if the row has none yet
+        with self.lock:
+            row = self.db.execute("SELECT sha256, path FROM pages WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                  (collection, book, page, stage)).fetchone()
+        if row is None:
+            return None
+        sha, path = row
+        if sha is None and path is not None and os.path.exists(path):
+            sha = self._output_sha(collection, book, page, stage, path)
+            with self.lock:
+                self.db.execute("UPDATE pages SET sha256 = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                (sha, collection, book, page, stage))
+                self.db.commit()
+        return sha
+
+    def _output_sha(self, collection, book, page, stage, path):
+        # Word boxes are hashed as the page's words, wherever they are (spooled JSON or coords.bin)
+        if stage == "coords":
+            words = page_words(self.path(collection, book, page, "coords"))
+            return words_sha256(words) if words is not None else None
+        return file_sha256(path)
+
+    def pack_coords(self, collection, book):
+        """
+        Merges a book's spooled page maps into its coords.bin (coords_pack.pack_book) and points
+        their rows at the pack. Returns the number of pages merged.
+        """
+        book_dir = os.path.join(self.data_dir, collection, book)
+        merged = pack_book(book_dir)
+        pack_path = os.path.join(book_dir, PACK_NAME)
+        with self.lock:
+            self.db.executemany("UPDATE pages SET path = ?, size = NULL WHERE collection = ? AND book = ? AND page = ? AND stage = 'coords'",
+                                [(pack_path, collection, book, page) for page in merged])
+            self.db.commit()
+        return len(merged)
+
+    def input_hash(self, collection, book, page, stage):
+        # One hash over the current outputs of every stage `stage` is built from; None if one is missing
+        hashes = [self.file_hash(collection, book, page, source) for source in INPUTS[stage]]
+        if None in hashes:
+            return None
+        if len(hashes) == 1:
+            return hashes[0]
+        return hashlib.sha256("\n".join(hashes).encode("ascii")).hexdigest()
+
+    def find_stale(self, mark=True):
+        """
+        Finished derived results whose inputs changed since they were built, plus everything
+        built from those. With mark set they go back to 'pending' so the normal stage scripts
+        pick them up. Returns [(collection, book, page, stage)].
+
+        Results from before input hashes were tracked have no `inputs` yet: they count as stale
+        if an input file is newer than they are (e.g. a rotation after the fact), otherwise the
+        current input hash is adopted for them.
+        """
+        stale = []
+        stale_keys = set()
+        for stage, sources in INPUTS.items():
+            with self.lock:
+                rows = self.db.execute("SELECT collection, book, page, path, inputs FROM pages WHERE stage = ? AND status = 'done'",
+                                       (stage,)).fetchall()
+            for collection, book, page, path, inputs in rows:
+                key = (collection, book, page)
+                current = self.input_hash(collection, book, page, stage)
+                if any((*key, source) in stale_keys for source in sources):
+                    is_stale = True # built from something that is itself being rebuilt
+                elif inputs is None:
+                    output_time = os.path.getmtime(path) if path and os.path.exists(path) else 0
+                    is_stale = any(os.path.getmtime(self.path(*key, source)) > output_time
+                                   for source in sources if os.path.exists(self.path(*key, source)))
+                    if not is_stale and current is not None:
+                        with self.lock:
+                            self.db.execute("UPDATE pages SET inputs = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                            (current, *key, stage))
+                else:
+                    is_stale = current != inputs
+                if is_stale:
+                    stale.append((*key, stage))
+                    stale_keys.add((*key, stage))
+
+        with self.lock:
+            if mark:
+                for key in stale:
+                    self.db.execute("UPDATE pages SET status = ?, error = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                    (PENDING, "stale: inputs changed", *key))
+            self.db.commit()
+        return stale
+
+    def mark_downstream(self, collection, book, page, stage, reason):
+        """
+        Puts every finished result of one page that was built, directly or not, from `stage`
+        back to 'pending'. Returns the stages it looked at.
+        """
+        derived = []
+        for target, sources in INPUTS.items(): # in run order, so chains are caught in one pass
+            if stage in sources or any(source in derived for source in sources):
+                derived.append(target)
+        with self.lock:
+            self.db.executemany("UPDATE pages SET status = ?, error = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ? AND status = 'done'",
+                                [(PENDING, reason, collection, book, page, target) for target in derived])
+            self.db.commit()
+        return derived
+
+    def key_for(self, path, stage):
+        """
+        (collection, book, page) of a file at its usual place in processed_data, or None for
+        anything outside it (benchmark scratch output, say).
+        """
+        if not os.path.abspath(path).startswith(os.path.abspath(self.data_dir) + os.sep):
+            return None
+        folder_dir, filename = os.path.split(path)
+        book_dir = os.path.dirname(folder_dir)
+        page = parse_page(filename, STAGE_FILES[stage][1])
+        if page is None:
+            raise ValueError(f"{path} is not a {stage} file")
+        return os.path.basename(os.path.dirname(book_dir)), os.path.basename(book_dir), page
+
+    def record_file(self, path, stage, status=DONE, error=None, with_hash=True):
+        # Same as record() for a file that sits at its usual place; anything else is ignored
+        key = self.key_for(path, stage)
+        if key is not None:
+            self.record(*key, stage, status, path, error, with_hash)
+
+    def status(self, collection, book, page, stage):
+        with self.lock:
+            row = self.db.execute("SELECT status FROM pages WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                  (collection, book, page, stage)).fetchone()
+        return row[0] if row else None
+
+    def pending(self, stage, after=("image",), collection=None, book=None):
+        """
+        [(collection, book, page)] where every stage in `after` is done but `stage` is not
+        (missing, pending or failed), in page order.
+        """
+        after = (after,) if isinstance(after, str) else tuple(after)
+        sql = ["SELECT a.collection, a.book, a.page FROM pages a WHERE a.stage = ? AND a.status = 'done'"]
+        args = [after[0]]
+        for other in after[1:]:
+            sql.append("""AND EXISTS (SELECT 1 FROM pages b WHERE b.collection = a.collection AND b.book = a.book
+                          AND b.page = a.page AND b.stage = ? AND b.status = 'done')""")
+            args.append(other)
+        sql.append("""AND NOT EXISTS (SELECT 1 FROM pages c WHERE c.collection = a.collection AND c.book = a.book
+                      AND c.page = a.page AND c.stage = ? AND c.status = 'done')""")
+        args.append(stage)
+        if collection is not None:
+            sql.append("AND a.collection = ?")
+            args.append(collection)
+        if book is not None:
+            sql.append("AND a.book = ?")
+            args.append(book)
+        sql.append("ORDER BY a.collection, a.book, a.page")
+        with self.lock:
+            return self.db.execute(" ".join(sql), args).fetchall()
+
+    def with_status(self, stage, status):
+        # [(collection, book, page)] whose `stage` row has exactly this status
+        with self.lock:
+            return self.db.execute("SELECT collection, book, page FROM pages WHERE stage = ? AND status = ? "
+                                   "ORDER BY collection, book, page", (stage, status)).fetchall()
+
+    def books(self):
+        with self.lock:
+            return self.db.execute("SELECT DISTINCT collection, book FROM pages WHERE stage = 'image' "
+                                   "ORDER BY collection, book").fetchall()
+
+    def book_versions(self, stages=None):
+        """
+        {(collection, book): (rows, last update)} - changes whenever any stage of any page of
+        the book is recorded, which is all site_index.py needs to know to skip a book.
+        With `stages`, only those stages' rows count (books with none of them are left out).
+        """
+        sql, args = "SELECT collection, book, COUNT(*), MAX(updated) FROM pages", []
+        if stages:
+            sql += f" WHERE stage IN ({', '.join('?' * len(stages))})"
+            args = list(stages)
+        with self.lock:
+            return {(c, b): (rows, updated) for c, b, rows, updated in self.db.execute(
+                sql + " GROUP BY collection, book", args)}
+
+    def book_pages(self, collection, book):
+        # {page: {stage: status}} for one book
+        pages = {}
+        with self.lock:
+            for page, stage, status in self.db.execute(
+                    "SELECT page, stage, status FROM pages WHERE collection = ? AND book = ?", (collection, book)):
+                pages.setdefault(page, {})[stage] = status
+        return pages
+
+    def summary(self):
+        # {stage: {status: count}}
+        counts = {}
+        with self.lock:
+            for stage, status, count in self.db.execute("SELECT stage, status, COUNT(*) FROM pages GROUP BY stage, status"):
+                counts.setdefault(stage, {})[status] = count
+        return counts
+
+    def sync(self):
+        """
+        Walks processed_data once and brings the manifest in line with the files on disk:
+        new files get rows, finished rows whose file has gone are dropped. Statuses, errors and
+        input hashes the pipeline recorded are kept (see _apply_scan). Hashes of new files are
+        not computed here (that is what makes it cheap); they are filled in on first use.
+        """
+        seen = {}
+        if os.path.isdir(self.data_dir):
+            for col_entry in os.scandir(self.data_dir):
+                if not col_entry.is_dir() or col_entry.name.startswith('.'): continue
+                for book_entry in os.scandir(col_entry.path):
+                    if not book_entry.is_dir(): continue
+                    self._scan_book(col_entry.name, book_entry.name, book_entry.path, seen)
+        with self.lock:
+            existing = {row[:4]: row[4:] for row in self.db.execute(
+                "SELECT collection, book, page, stage, status, path, size FROM pages")}
+            self._apply_scan(seen, existing)
+        return len(seen)
+
+    def sync_book(self, collection, book):
+        # sync() for a single book, e.g. after files were copied into it by hand
+        seen = {}
+        book_dir = os.path.join(self.data_dir, collection, book)
+        if os.path.isdir(book_dir):
+            self._scan_book(collection, book, book_dir, seen)
+        with self.lock:
+            existing = {row[:4]: row[4:] for row in self.db.execute(
+                "SELECT collection, book, page, stage, status, path, size FROM pages WHERE collection = ? AND book = ?",
+                (collection, book))}
+            self._apply_scan(seen, existing)
+        return len(seen)
+
+    def _apply_scan(self, seen, existing):
+        """
+        Caller holds the lock. The disk only says which files exist; the status of a row the
+        pipeline already tracks is its business. So:
+          - a file with no row gets one
+          - a finished row whose file is gone is dropped; pending and failed rows stay (with their error)
+          - a finished row whose file is now empty or a placeholder goes back to pending
+          - a file whose size changed behind the pipeline's back gets its hash redone, so
+            find_stale() sees the change; its status and input hash are left alone
+        """
+        now = time.time()
+        for key in existing.keys() - seen.keys():
+            if existing[key][0] == DONE:
+                self.db.execute("DELETE FROM pages WHERE collection = ? AND book = ? AND page = ? AND stage = ?", key)
+        for key, (status, path, size) in seen.items():
+            if key not in existing:
+                self.db.execute("""
+                    INSERT INTO pages (collection, book, page, stage, status, path, size, created, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (*key, status, path, size, now, now))
+                continue
+            old_status, old_path, old_size = existing[key]
+            if old_status == DONE and status == PENDING:
+                self.db.execute("UPDATE pages SET status = ?, updated = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                (PENDING, now, *key))
+            if size is not None and size != old_size:
+                self.db.execute("UPDATE pages SET path = ?, size = ?, sha256 = ?, updated = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                (path, size, self._output_sha(*key, path), now, *key))
+            elif path is not None and path != old_path:
+                # e.g. a spooled page map that has since been packed: same words, new home
+                self.db.execute("UPDATE pages SET path = ?, size = ? WHERE collection = ? AND book = ? AND page = ? AND stage = ?",
+                                (path, size, *key))
+        self.db.commit()
+
+    def _scan_book(self, collection, book, book_dir, seen):
+        for stage, (folder, suffix) in STAGE_FILES.items():
+            folder_dir = os.path.join(book_dir, folder)
+            if not os.path.isdir(folder_dir): continue
+            for entry in os.scandir(folder_dir):
+                page = parse_page(entry.name, suffix)
+                if page is None:
+                    continue
+                size = entry.stat().st_size
+                status = DONE
+                if stage == "text" and size == 0:
+                    status = PENDING
+                elif stage == "html":
+                    with open(entry.path, "r", encoding="utf-8", errors="replace") as f:
+                        if PLACEHOLDER_MARKER in f.read():
+                            status = PENDING
+                seen[(collection, book, page, stage)] = (status, entry.path, size)
+
+        # Packed word boxes: one coords.bin per book; a page still spooled in coords/ counts as that file
+        pack_path = os.path.join(book_dir, PACK_NAME)
+        if os.path.exists(pack_path):
+            try:
+                with CoordsPack(pack_path) as pack:
+                    for page in pack.page_numbers():
+                        seen.setdefault((collection, book, page, "coords"), (DONE, pack_path, None))
+            except ValueError:
+                pass # not a pack this version can read; its pages get mapped again
+
+        # Orientation checks live in the audit log (plus any journal a crashed run left)
+        audited = set()
+        audit_file = os.path.join(book_dir, "audit_log.json")
+        if os.path.exists(audit_file):
+            try:
+                with open(audit_file, "r") as f:
+                    audited.update(json.load(f))
+            except ValueError:
+                pass
+        journal_file = os.path.join(book_dir, "audit_log.jsonl")
+        if os.path.exists(journal_file):
+            with open(journal_file, "r") as f:
+                for line in f:
+                    try:
+                        audited.add(json.loads(line)["page"])
+                    except (ValueError, KeyError):
+                        continue
+        for img_file in audited:
+            page = parse_page(img_file, ".jpg")
+            if page is not None:
+                seen[(collection, book, page, "audit")] = (DONE, None, None)
+
+def load_ocr_script():
+    """run_gemini_ocr_v2.py.py as a module. Its file name has an extra '.py', so it has to be loaded by path."""
+    import sys
+    import importlib.util
+    if "run_gemini_ocr_v2" not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_gemini_ocr_v2.py.py")
+        spec = importlib.util.spec_from_file_location("run_gemini_ocr_v2", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules["run_gemini_ocr_v2"] = module
+    return sys.modules["run_gemini_ocr_v2"]
+
+def rebuild(stale=False):
+    """
+    Runs every stage over whatever the manifest says is pending, in dependency order:
+    word boxes, HTML (which also fills texts), texts, overlay repair, then viewer tiles.
+    With stale set, results built from inputs that have since changed are marked pending first.
+    """
+    state = PipelineState()
+    if stale:
+        found = state.find_stale()
+        by_stage = {}
+        for *_, stage in found:
+            by_stage[stage] = by_stage.get(stage, 0) + 1
+        if not found:
+            print("Nothing is stale.")
+            return
+        print("Stale results marked for rebuild: " + ", ".join(f"{stage} {count}" for stage, count in by_stage.items()))
+    state.close()
+
+    # The stage scripts open the manifest themselves
+    import generate_overlays
+    generate_overlays.generate_json_map()
+    import generate_html
+    generate_html.main()
+    load_ocr_script().run_smart_ocr()
+    import repair_json
+    repair_json.repair_overlays()
+    import tiles
+    tiles.generate_tiles()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect or rebuild the pipeline manifest")
+    parser.add_argument("command", choices=["summary", "sync", "stale", "rebuild"],
+                        help="stale: list results whose inputs changed; rebuild: run every pending stage")
+    parser.add_argument("--stale", action="store_true", help="rebuild: first mark stale results pending")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild(stale=args.stale)
+        raise SystemExit
+
+    state = PipelineState()
+    if args.command == "stale":
+        for collection, book, page, stage in state.find_stale(mark=False):
+            print(f"   {collection}/{book} {page_stem(page)}: {stage}")
+    elif args.command == "sync":
+        print(f"Manifest now tracks {state.sync()} stage results.")
+    for stage, counts in sorted(state.summary().items()):
+        print(f"   {stage:<7} " + ", ".join(f"{status}: {count}" for status, count in sorted(counts.items())))
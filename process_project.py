@@ -1,34 +1,156 @@
 import os
 import json
-import shutil
-from PIL import Image
-from pdf2image import convert_from_path
+import hashlib
+import subprocess
+import tempfile
+import concurrent.futures
+import numpy as np
+from PIL import Image, JpegImagePlugin
+from pdf2image import convert_from_path, pdfinfo_from_path
+import tiles
+import site_index
+import search_index
+import gazetteer
+import telemetry
+from pipeline_state import PipelineState, DONE, FAILED
 
 # --- CONFIGURATION ---
 OUTPUT_ROOT = "processed_data"
 POPPLER_PATH = r"G:\STAMP\Indian Postal History OCR Project\poppler-25.12.0\Library\bin"
 
+# RENDER CONFIG
+# Pages are rendered in small page ranges so memory stays flat no matter how big the book is.
+# Each range is one job for the process pool; books and ranges are spread across all workers.
+RENDER_DPI = 150
+RENDER_QUALITY = 80
+RENDER_CHUNK_PAGES = 16
+RENDER_WORKERS = os.cpu_count() or 4
+
+# ANALYSIS CONFIG
+# Phase 2 is a single Tesseract pass per page: orientation check, then word boxes for coords/.
+# A page whose OSD runs past OSD_TIMEOUT seconds is killed and logged as 'timeout' instead of
+# stalling the whole run; WORDS_TIMEOUT does the same for the word-box extraction.
+AUDIT_WORKERS = os.cpu_count() or 4
+OSD_TIMEOUT = 30
+WORDS_TIMEOUT = 120
+
+# JPEGTRAN CONFIG (ships with libjpeg-turbo; used for lossless 90/180/270 rotations)
+# If it is missing, rotated pages fall back to a single re-encode with the original quality tables.
+JPEGTRAN_PATH = "jpegtran"
+
+# PRE-FILTER CONFIG
+# Most pages are upright, so a cheap projection-profile check on a half-size grayscale thumbnail
+# decides first. Only pages that fail either threshold are sent to Tesseract OSD.
+# Tune these with: python process_project.py --tune-prefilter
+PREFILTER_SCALE = 2
+PREFILTER_LINE_RATIO = 1.5
+PREFILTER_ASYMMETRY = 0.08
+
+# Top-level folders that are never collections of PDFs
+EXCLUDE_DIRS = {OUTPUT_ROOT, '.git', '.github', 'scripts', 'poppler-25.12.0'}
+
 # TESSERACT CONFIG (Update this if your path is different)
 TESSERACT_PATH = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
 # Check for Tesseract availability
 try:
     import pytesseract
+    from generate_overlays import extract_word_boxes, write_word_boxes
     pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
     HAS_TESSERACT = True
 except ImportError:
     HAS_TESSERACT = False
     print("Warning: 'pytesseract' library not found. Orientation checks will be skipped.")
 
-def process_project():
-    root_dir = os.getcwd()
-    exclude = {OUTPUT_ROOT, '.git', '.github', 'scripts', 'poppler-25.12.0'}
-    
-    # ==========================================
-    # PHASE 1: PROCESS NEW PDFS (THE WORKER)
-    # ==========================================
-    print(f"--- Step 1: Checking for new PDFs to process ---")
-    
+def page_filename(page_num, ext="jpg"):
+    return f"page_{page_num:03d}.{ext}"
+
+def book_id_from_pdf(file):
+    # Determine Book ID (IPG-1869.pdf -> 1869)
+    if "-" in file:
+        return file.split("-")[-1].replace(".pdf", "")
+    return file.replace(".pdf", "")
+
+def missing_page_ranges(img_out, page_count, chunk_size):
+    """
+    Returns (first, last) page ranges for every page that has no JPEG yet.
+    Runs of missing pages are cut into chunks of at most chunk_size pages.
+    """
+    existing = set(os.listdir(img_out)) if os.path.isdir(img_out) else set()
+    ranges = []
+    run_start = None
+    for page_num in range(1, page_count + 2):
+        missing = page_num <= page_count and page_filename(page_num) not in existing
+        if missing and run_start is None:
+            run_start = page_num
+        elif not missing and run_start is not None:
+            for first in range(run_start, page_num, chunk_size):
+                ranges.append((first, min(first + chunk_size - 1, page_num - 1)))
+            run_start = None
+    return ranges
+
+def clear_scratch_dirs(img_out):
+    # Scratch folders left behind by a killed run hold partial pages; they are never trusted.
+    if not os.path.isdir(img_out):
+        return
+    for name in os.listdir(img_out):
+        scratch = os.path.join(img_out, name)
+        if name.startswith(".render_") and os.path.isdir(scratch):
+            for leftover in os.listdir(scratch):
+                os.remove(os.path.join(scratch, leftover))
+            os.rmdir(scratch)
+
+def write_placeholder_html(html_out, page_num):
+    html_path = os.path.join(html_out, page_filename(page_num, "html"))
+    if os.path.exists(html_path):
+        return # Never clobber a real transcription on resume
+    html_content = f"""
+                    <html>
+                    <body style="font-family: courier; color: #555; padding: 20px; background: #f4f4f4;">
+                        <h3>Page {page_num}</h3>
+                        <p>[OCR Content Pending...]</p>
+                    </body>
+                    </html>
+                    """
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(html_content)
+
+def render_page_range(pdf_path, img_out, html_out, first_page, last_page):
+    """
+    Runs inside a worker process.
+    Poppler writes the JPEGs straight to a scratch folder (nothing is held in memory as PIL images),
+    then each page is moved into place with an atomic rename so a crash never leaves a half-written page.
+    """
+    scratch = tempfile.mkdtemp(prefix=f".render_{first_page:03d}_", dir=img_out)
+    try:
+        with telemetry.stage("render", img_out, first=first_page, last=last_page):
+            paths = convert_from_path(
+                pdf_path,
+                dpi=RENDER_DPI,
+                first_page=first_page,
+                last_page=last_page,
+                output_folder=scratch,
+                fmt="jpeg",
+                jpegopt={"quality": RENDER_QUALITY},
+                paths_only=True,
+                poppler_path=POPPLER_PATH
+            )
+        for i, rendered in enumerate(sorted(paths)):
+            page_num = first_page + i
+            os.replace(rendered, os.path.join(img_out, page_filename(page_num)))
+            write_placeholder_html(html_out, page_num)
+        return len(paths)
+    finally:
+        for leftover in os.listdir(scratch):
+            os.remove(os.path.join(scratch, leftover))
+        os.rmdir(scratch)
+
+def find_render_jobs(root_dir, exclude, chunk_size=RENDER_CHUNK_PAGES):
+    """
+    [(label, pdf_path, img_out, html_out, first, last)] for every page range not rendered yet.
+    """
+    jobs = []
+
     for collection_name in os.listdir(root_dir):
         collection_path = os.path.join(root_dir, collection_name)
 
@@ -36,171 +158,554 @@ def process_project():
             continue
 
         pdf_files = [f for f in os.listdir(collection_path) if f.lower().endswith(".pdf")]
-        
+
         for file in pdf_files:
-            # Determine Book ID
-            if "-" in file:
-                book_id = file.split("-")[-1].replace(".pdf", "")
-            else:
-                book_id = file.replace(".pdf", "")
-            
+            book_id = book_id_from_pdf(file)
+            pdf_path = os.path.join(collection_path, file)
+
             # Define output paths
             img_out = os.path.join(OUTPUT_ROOT, collection_name, book_id, "images")
             html_out = os.path.join(OUTPUT_ROOT, collection_name, book_id, "htmls") # Changed to htmls
 
-            # SKIP if output already exists (Idempotency)
-            if os.path.exists(img_out) and len(os.listdir(img_out)) > 0:
-                continue 
+            try:
+                page_count = int(pdfinfo_from_path(pdf_path, poppler_path=POPPLER_PATH)["Pages"])
+            except Exception as e:
+                print(f"   [SKIP] Could not read {file}: {e}")
+                continue
 
-            print(f"   [NEW] Found {file} -> Processing...")
+            # RESUME: only render pages that are not on disk yet (Idempotency)
+            clear_scratch_dirs(img_out)
+            ranges = missing_page_ranges(img_out, page_count, chunk_size)
+            if not ranges:
+                continue
+
+            todo = sum(last - first + 1 for first, last in ranges)
+            state = "NEW" if todo == page_count else "RESUME"
+            print(f"   [{state}] Found {file} -> Rendering {todo}/{page_count} pages...")
             os.makedirs(img_out, exist_ok=True)
             os.makedirs(html_out, exist_ok=True)
 
+            for first, last in ranges:
+                jobs.append((f"{collection_name}/{book_id}", pdf_path, img_out, html_out, first, last))
+    return jobs
+
+def record_rendered(state, label, first, count):
+    # The parent records what a render worker wrote; returns the (collection, book, page) keys
+    collection_name, book_id = label.split("/")
+    keys = []
+    for page_num in range(first, first + count):
+        state.record(collection_name, book_id, page_num, "image", path=state.path(collection_name, book_id, page_num, "image"))
+        keys.append((collection_name, book_id, page_num))
+    return keys
+
+def render_new_pdfs(root_dir, exclude, workers=RENDER_WORKERS, chunk_size=RENDER_CHUNK_PAGES):
+    jobs = find_render_jobs(root_dir, exclude, chunk_size)
+    if not jobs:
+        return
+
+    print(f"   Rendering {len(jobs)} page ranges on {workers} workers...")
+    state = PipelineState(OUTPUT_ROOT)
+    failed_books = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(render_page_range, *job[1:]): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            label, _, _, _, first, last = futures[future]
             try:
-                pages = convert_from_path(
-                    os.path.join(collection_path, file), 
-                    dpi=150, 
-                    poppler_path=POPPLER_PATH
-                )
-
-                for i, page in enumerate(pages):
-                    page_num = i + 1
-                    base_fname = f"page_{page_num:03d}"
-                    
-                    # 1. Save Image
-                    page.save(os.path.join(img_out, f"{base_fname}.jpg"), 'JPEG', quality=80)
-                    
-                    # 2. Save HTML Placeholder
-                    html_content = f"""
-                    <html>
-                    <body style="font-family: courier; color: #555; padding: 20px; background: #f4f4f4;">
-                        <h3>Page {page_num}</h3>
-                        <p>[OCR Content Pending...]</p>
-                    </body>
-                    </html>
-                    """
-                    with open(os.path.join(html_out, f"{base_fname}.html"), "w", encoding="utf-8") as f:
-                        f.write(html_content)
+                count = future.result()
+                record_rendered(state, label, first, count)
+                print(f"      -> {label}: pages {first}-{last} done ({count} pages).")
+            except Exception as e:
+                # Pages already written are kept; the next run resumes from the first missing page.
+                print(f"      -> ERROR {label} pages {first}-{last}: {e}")
+                failed_books.add(label)
+
+    for label in sorted(failed_books):
+        print(f"   [INCOMPLETE] {label} - re-run to resume from the first missing page.")
+
+def load_audit_log(book_dir):
+    """
+    Loads audit_log.json and replays any entries from the append-only journal
+    (audit_log.jsonl) that a crashed run left behind.
+    """
+    audit_file = os.path.join(book_dir, "audit_log.json")
+    journal_file = os.path.join(book_dir, "audit_log.jsonl")
+    audit_log = {}
+    if os.path.exists(audit_file):
+        try:
+            with open(audit_file, 'r') as f:
+                audit_log = json.load(f)
+        except:
+            audit_log = {} # corrupted log, start over
+
+    if os.path.exists(journal_file):
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # torn last line from a crash
+                audit_log[record["page"]] = record.get("entry", record.get("status"))
+    return audit_log
+
+def append_audit_entry(book_dir, img_file, entry):
+    # One line per page, flushed straight to disk so a crash loses at most the page in flight.
+    journal_file = os.path.join(book_dir, "audit_log.jsonl")
+    with open(journal_file, 'a') as f:
+        f.write(json.dumps({"page": img_file, "entry": entry}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def compact_audit_log(book_dir, audit_log):
+    # Fold the journal back into audit_log.json (atomic replace), then drop the journal.
+    audit_file = os.path.join(book_dir, "audit_log.json")
+    journal_file = os.path.join(book_dir, "audit_log.jsonl")
+    tmp_file = audit_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(dict(sorted(audit_log.items())), f, indent=4)
+    os.replace(tmp_file, audit_file)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+
+def init_audit_worker():
+    # Tesseract spawns its own OpenMP threads; one per process avoids oversubscribing the cores.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def rotate_jpeg(full_img_path, rotation):
+    """
+    Rotates a JPEG clockwise by 90/180/270 in place. Returns "lossless" or "reencode".
+    jpegtran transposes the DCT blocks directly, so there is no decode and no quality loss.
+    -perfect makes it refuse pages whose size is not a whole number of blocks rather than trim
+    their edges, so no pixel is ever dropped and undo_rotation() can check the original hash.
+    Those pages (or a machine without jpegtran) are decoded and re-encoded once with the
+    original quality tables.
+    """
+    tmp_path = full_img_path + ".rot.tmp"
+    try:
+        result = subprocess.run(
+            [JPEGTRAN_PATH, "-copy", "all", "-perfect", "-rotate", str(rotation), "-outfile", tmp_path, full_img_path],
+            capture_output=True, timeout=60
+        )
+        if result.returncode == 0:
+            os.replace(tmp_path, full_img_path)
+            return "lossless"
+    except (OSError, subprocess.TimeoutExpired):
+        pass # jpegtran not installed
+
+    # Fallback: odd-sized edge blocks, or no jpegtran
+    with Image.open(full_img_path) as im:
+        rotated = im.rotate(-rotation, expand=True)
+        rotated.save(tmp_path, "JPEG", qtables=im.quantization, subsampling=JpegImagePlugin.get_sampling(im))
+    os.replace(tmp_path, full_img_path)
+    return "reencode"
+
+def undo_rotation(book_dir, img_file):
+    """
+    Turns a page the auditor rotated back to how it was rendered and checks it against
+    the original hash in the audit log. The page is then logged as 'rotation_undone' so the
+    auditor leaves it alone.
+    """
+    audit_log = load_audit_log(book_dir)
+    entry = audit_log.get(img_file)
+    status = (audit_status(entry) or "") if entry else ""
+    if not status.startswith("rotated_"):
+        print(f"{img_file} was not rotated by the auditor (status: {status or 'none'}).")
+        return False
+
+    full_img_path = os.path.join(book_dir, "images", img_file)
+    rotation = int(status.split("_")[1])
+    method = rotate_jpeg(full_img_path, (360 - rotation) % 360)
+    restored = file_sha256(full_img_path)
+
+    original = entry.get("original_sha256") if isinstance(entry, dict) else None
+    if original is None:
+        print(f"   -> Rotated {img_file} back ({method}). No original hash on record to verify against.")
+    elif restored == original:
+        print(f"   -> Rotated {img_file} back ({method}). Matches the original file exactly.")
+    else:
+        print(f"   -> Rotated {img_file} back ({method}). WARNING: hash differs from the original.")
+
+    undone = dict(entry) if isinstance(entry, dict) else {}
+    undone.update({"status": "rotation_undone", "undone_from": status, "sha256": restored})
+    audit_log[img_file] = undone
+    compact_audit_log(book_dir, audit_log)
+    state = PipelineState(OUTPUT_ROOT)
+    state.record_file(full_img_path, "image")
+    state.mark_downstream(*state.key_for(full_img_path, "image"), "image", "rotation undone")
+    print("   -> Its coords, HTML and text are marked pending. Redo them with: python pipeline_state.py rebuild")
+    return True
+
+def audit_status(entry):
+    # Older audit logs store a bare status string; newer ones store a dict with the details.
+    return entry if isinstance(entry, str) else entry.get("status")
 
-                print(f"      -> Done. Extracted {len(pages)} pages.")
+def load_thumbnail(full_img_path, scale=PREFILTER_SCALE, rotation=0):
+    with Image.open(full_img_path) as im:
+        # draft() lets libjpeg decode straight at reduced size, which is far cheaper than a full decode
+        im.draft("L", (im.width // scale, im.height // scale))
+        thumb = im.convert("L")
+    if rotation:
+        thumb = thumb.rotate(-rotation, expand=True)
+    return np.asarray(thumb, dtype=np.float32)
 
+def orientation_features(gray):
+    """
+    Projection-profile features of a grayscale page.
+    line_ratio: how much more the row profile alternates than the column profile.
+                Horizontal text lines make it well above 1; a page on its side drops below 1.
+    asymmetry:  within each text line the baseline is a sharper edge than the top of the line
+                (ascenders are common, descenders rare). Positive means upright, negative upside down.
+    """
+    # Ignore the outer 5% where scan borders and page edges live
+    h, w = gray.shape
+    gray = gray[h // 20:h - h // 20, w // 20:w - w // 20]
+
+    # Otsu threshold separates ink from the (yellowed) paper
+    hist = np.bincount(gray.astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    prob = hist / max(hist.sum(), 1)
+    omega = np.cumsum(prob)
+    mu = np.cumsum(prob * np.arange(256))
+    between = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega) + 1e-12)
+    ink = (gray < np.argmax(between)).astype(np.float32)
+
+    rows = ink.mean(axis=1)
+    cols = ink.mean(axis=0)
+    row_stripes = np.abs(np.diff(rows)).sum() / (rows.sum() + 1e-6)
+    col_stripes = np.abs(np.diff(cols)).sum() / (cols.sum() + 1e-6)
+    line_ratio = row_stripes / (col_stripes + 1e-6)
+
+    steps = np.diff(rows)
+    fall = (steps[steps < 0] ** 2).sum()
+    rise = (steps[steps > 0] ** 2).sum()
+    asymmetry = (fall - rise) / (fall + rise + 1e-12)
+    return float(line_ratio), float(asymmetry)
+
+def prefilter_confidence(line_ratio, asymmetry, min_ratio=PREFILTER_LINE_RATIO, min_asymmetry=PREFILTER_ASYMMETRY):
+    # >= 1.0 means the page cleared both thresholds and can skip OSD
+    return min(line_ratio / max(min_ratio, 1e-6), asymmetry / max(min_asymmetry, 1e-6))
+
+def audit_page(full_img_path, timeout=OSD_TIMEOUT):
+    """
+    Runs inside a worker process. Returns the audit entry for one page.
+    pytesseract kills the Tesseract process itself once the timeout expires.
+    """
+    entry = {}
+    try:
+        with telemetry.stage("prefilter", full_img_path):
+            line_ratio, asymmetry = orientation_features(load_thumbnail(full_img_path))
+        confidence = prefilter_confidence(line_ratio, asymmetry)
+        entry = {"confidence": round(confidence, 3), "line_ratio": round(line_ratio, 3), "asymmetry": round(asymmetry, 3)}
+        if confidence >= 1.0:
+            return {"status": "checked_ok", "method": "prefilter", **entry}
+    except Exception:
+        pass # unreadable thumbnail - let Tesseract have a go
+
+    try:
+        # Tesseract OSD Check
+        with telemetry.stage("osd", full_img_path):
+            osd = pytesseract.image_to_osd(full_img_path, config='--psm 0 -c min_characters_to_try=5', timeout=timeout)
+    except RuntimeError as e:
+        if "timeout" in str(e).lower():
+            return {"status": "timeout", "method": "osd", **entry}
+        return {"status": "skipped_error", "method": "osd", **entry}
+    except Exception:
+        # If Tesseract fails, we log it and move on
+        return {"status": "skipped_error", "method": "osd", **entry}
+
+    rotation = 0
+    for line in osd.split("\n"):
+        try:
+            if "Rotate" in line:
+                rotation = int(line.split(":")[1].strip())
+            elif "Orientation confidence" in line:
+                entry["osd_confidence"] = float(line.split(":")[1].strip())
+        except: pass
+
+    if rotation == 0:
+        return {"status": "checked_ok", "method": "osd", **entry}
+
+    try:
+        # Keep the hash of the scan as rendered so the rotation can be undone and verified later
+        entry["original_sha256"] = file_sha256(full_img_path)
+        with telemetry.stage("rotate", full_img_path, degrees=rotation):
+            entry["rotation_method"] = rotate_jpeg(full_img_path, rotation)
+        entry["sha256"] = file_sha256(full_img_path)
+    except Exception:
+        return {"status": "skipped_error", "method": "osd", **entry}
+    return {"status": f"rotated_{rotation}", "method": "osd", **entry}
+
+def tune_prefilter(sample_per_book=40):
+    """
+    Threshold-tuning report for the pre-filter, using the existing audit labels as ground truth.
+    Every labelled page is upright on disk now (rotated_N pages were already fixed), so:
+      - the page as stored is a positive (should skip OSD),
+      - the original scan of a rotated_N page, plus a 90/180/270 turn of every page, are negatives.
+    Prints the skip rate and false skips for a grid of thresholds and saves prefilter_report.json.
+    """
+    positives, negatives = [], []
+
+    for col_name in sorted(os.listdir(OUTPUT_ROOT)):
+        col_path = os.path.join(OUTPUT_ROOT, col_name)
+        if not os.path.isdir(col_path): continue
+
+        for book_id in sorted(os.listdir(col_path)):
+            book_dir = os.path.join(col_path, book_id)
+            img_path = os.path.join(book_dir, "images")
+            if not os.path.isdir(img_path): continue
+
+            audit_log = load_audit_log(book_dir)
+            labelled = [(f, audit_status(e) or "") for f, e in sorted(audit_log.items())]
+            labelled = [(f, status) for f, status in labelled if status == "checked_ok" or status.startswith("rotated_")]
+            # Keep every rotated page (they are rare) and a spread of the upright ones
+            rotated = [x for x in labelled if x[1] != "checked_ok"]
+            upright = [x for x in labelled if x[1] == "checked_ok"]
+            step = max(1, len(upright) // sample_per_book)
+            print(f"   Sampling {col_name}/{book_id}...")
+
+            for img_file, status in rotated + upright[::step]:
+                full_img_path = os.path.join(img_path, img_file)
+                if not os.path.exists(full_img_path): continue
+                positives.append(orientation_features(load_thumbnail(full_img_path)))
+                turns = [90, 180, 270]
+                if status != "checked_ok":
+                    # Undo the fix to get back what the scanner produced
+                    original = (360 - int(status.split("_")[1])) % 360
+                    turns = [original] + [t for t in turns if t != original]
+                for turn in turns:
+                    negatives.append(orientation_features(load_thumbnail(full_img_path, rotation=turn)))
+
+    if not positives:
+        print("No labelled pages found. Run the orientation audit first.")
+        return
+
+    rows = []
+    for min_ratio in (1.0, 1.25, 1.5, 2.0, 2.5):
+        for min_asymmetry in (0.0, 0.02, 0.04, 0.08, 0.12, 0.16, 0.2):
+            def passes(f):
+                return prefilter_confidence(f[0], f[1], min_ratio, min_asymmetry) >= 1.0
+            skipped = sum(1 for f in positives if passes(f))
+            false_skips = sum(1 for f in negatives if passes(f))
+            rows.append({
+                "line_ratio": min_ratio,
+                "asymmetry": min_asymmetry,
+                "skip_rate": round(skipped / len(positives), 4),
+                "false_skips": false_skips
+            })
+
+    print(f"\n   {len(positives)} upright samples, {len(negatives)} rotated samples")
+    print(f"   {'line_ratio':>10} {'asymmetry':>10} {'skip_rate':>10} {'false_skips':>12}")
+    for row in rows:
+        print(f"   {row['line_ratio']:>10} {row['asymmetry']:>10} {row['skip_rate']:>10.1%} {row['false_skips']:>12}")
+
+    safe = [row for row in rows if row["false_skips"] == 0]
+    # Among equally good settings prefer the strictest one, it leaves the most margin
+    best = max(safe, key=lambda row: (row["skip_rate"], row["line_ratio"], row["asymmetry"])) if safe else None
+    if best:
+        print(f"\n   Best safe setting: PREFILTER_LINE_RATIO = {best['line_ratio']}, "
+              f"PREFILTER_ASYMMETRY = {best['asymmetry']} (skips {best['skip_rate']:.1%} of OSD calls)")
+    else:
+        print("\n   No setting avoided every false skip - keep OSD on all pages.")
+
+    report_path = os.path.join(OUTPUT_ROOT, "prefilter_report.json")
+    with open(report_path, "w") as f:
+        json.dump({"positives": len(positives), "negatives": len(negatives), "best": best, "grid": rows}, f, indent=4)
+    print(f"   Report saved to {report_path}")
+
+def analyse_page(full_img_path, coords_path, needs_audit, needs_words, timeout=OSD_TIMEOUT, words_timeout=WORDS_TIMEOUT):
+    """
+    Runs inside a worker process. The single Tesseract pass for one page:
+    orientation first (rotating the JPEG on disk if needed), then word boxes on the page as it
+    now sits on disk, so the coords can never describe the pre-rotation image.
+    needs_words comes from the manifest (coords missing, pending or failed), not from whether
+    a coords file exists: a map marked stale is still on disk but has to be redone.
+    """
+    result = {"entry": None, "words": None, "error": None}
+    if needs_audit:
+        result["entry"] = audit_page(full_img_path, timeout)
+
+    rotated = result["entry"] is not None and result["entry"]["status"].startswith("rotated_")
+    if not needs_words and not rotated:
+        return result
+
+    try:
+        word_list = extract_word_boxes(full_img_path, timeout=words_timeout)
+        write_word_boxes(coords_path, word_list)
+        result["words"] = len(word_list)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def died_result(needs_audit, needs_words, error):
+    # analyse_page() result for a worker process that died: only what the job was meant to produce fails
+    return {"entry": {"status": "skipped_error"} if needs_audit else None, "words": None,
+            "error": error if needs_words else None}
+
+def record_analysis(state, audit_log, book_dir, img_file, key, full_img_path, coords_path, result):
+    """
+    Files one analyse_page() result: audit journal, manifest rows, console messages.
+    Runs in the parent process. Returns the audit entry (None if the page needed no audit).
+    """
+    entry = result["entry"]
+    if entry is not None:
+        audit_log[img_file] = entry
+        append_audit_entry(book_dir, img_file, entry)
+        state.record(*key, "audit", DONE)
+        status = entry["status"]
+
+        if status.startswith("rotated_"):
+            state.record(*key, "image", path=full_img_path) # new pixels, new hash
+            # Everything made from the old pixels is redone: coords right below, tiles, HTML and text by their stages
+            state.mark_downstream(*key, "image", "image rotated")
+            print(f"      -> Rotated {book_dir}/{img_file} by {status.split('_')[1]}°")
+        elif status == "timeout":
+            print(f"      -> Timed out on {book_dir}/{img_file}")
+
+    if result["error"]:
+        print(f"      -> No word boxes for {book_dir}/{img_file}: {result['error']}")
+        state.record(*key, "coords", FAILED, error=result["error"])
+    elif result["words"] is not None:
+        state.record(*key, "coords", path=coords_path)
+    return entry
+
+def analyse_pages(workers=AUDIT_WORKERS, timeout=OSD_TIMEOUT):
+    state = PipelineState(OUTPUT_ROOT)
+    pending = {} # book_dir -> number of pages still in flight
+    audit_logs = {}
+    jobs = []
+
+    # Pending work comes from the manifest: pages with no orientation check, or no word boxes
+    todo_by_book = {} # (collection, book) -> {page: [needs_audit, needs_words]}
+    for col_name, book_id, page_num in state.pending("audit"):
+        todo_by_book.setdefault((col_name, book_id), {})[page_num] = [True, False]
+    for col_name, book_id, page_num in state.pending("coords"):
+        todo_by_book.setdefault((col_name, book_id), {}).setdefault(page_num, [False, False])[1] = True
+
+    for col_name, book_id in state.books():
+        book_dir = os.path.join(OUTPUT_ROOT, col_name, book_id)
+        todo = todo_by_book.get((col_name, book_id))
+        if not todo:
+            # A crashed run may have left a journal behind for a book that is otherwise finished
+            if os.path.exists(os.path.join(book_dir, "audit_log.jsonl")):
+                compact_audit_log(book_dir, load_audit_log(book_dir))
+            continue
+
+        audit_logs[book_dir] = load_audit_log(book_dir)
+        coords_dir = os.path.join(book_dir, "coords")
+        audits = sum(1 for needs_audit, _ in todo.values() if needs_audit)
+        print(f"   Analysing {col_name}/{book_id} ({audits} orientation checks, {len(todo)} pages in total)...")
+        os.makedirs(coords_dir, exist_ok=True)
+        pending[book_dir] = len(todo)
+        for page_num, (needs_audit, needs_words) in sorted(todo.items()):
+            img_file = page_filename(page_num)
+            jobs.append((book_dir, img_file, state.path(col_name, book_id, page_num, "image"),
+                         state.path(col_name, book_id, page_num, "coords"), needs_audit, needs_words, (col_name, book_id, page_num)))
+
+    if not jobs:
+        print("   All pages already analysed.")
+        return
+
+    print(f"   Analysing {len(jobs)} pages on {workers} workers (timeout {timeout}s per page)...")
+    done = 0
+    skipped_osd = 0
+    rotated = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_audit_worker) as executor:
+        futures = {executor.submit(analyse_page, full_img_path, coords_path, needs_audit, needs_words, timeout):
+                   (book_dir, img_file, full_img_path, coords_path, needs_audit, needs_words, key)
+                   for book_dir, img_file, full_img_path, coords_path, needs_audit, needs_words, key in jobs}
+
+        for future in concurrent.futures.as_completed(futures):
+            book_dir, img_file, full_img_path, coords_path, needs_audit, needs_words, key = futures[future]
+            try:
+                result = future.result()
             except Exception as e:
-                print(f"      -> ERROR: {e}")
-                # Cleanup failed attempt to allow retry
-                shutil.rmtree(os.path.join(OUTPUT_ROOT, collection_name, book_id))
+                result = died_result(needs_audit, needs_words, str(e))
+
+            entry = record_analysis(state, audit_logs[book_dir], book_dir, img_file, key, full_img_path, coords_path, result)
+            if entry is not None:
+                skipped_osd += entry.get("method") == "prefilter"
+                rotated += entry["status"].startswith("rotated_")
+
+            done += 1
+            # Print progress every 10 images so you know it's alive
+            if done % 10 == 0:
+                print(f"      Analysed {done}/{len(jobs)} pages...", end="\r")
+
+            pending[book_dir] -= 1
+            if pending[book_dir] == 0:
+                compact_audit_log(book_dir, audit_logs[book_dir])
+                state.pack_coords(*key[:2])
+                print(f"      Done with {book_dir}.                  ") # Newline after progress bar
+
+    print(f"   Pre-filter cleared {skipped_osd} pages without running OSD.")
+    if rotated:
+        # Coords were redone above; tiles follow below. HTML, text and repaired overlays are marked pending.
+        print(f"   {rotated} pages were rotated. Redo their HTML, text and overlays with: python pipeline_state.py rebuild")
+
+def process_project():
+    root_dir = os.getcwd()
+    exclude = EXCLUDE_DIRS
+    
+    # ==========================================
+    # PHASE 1: PROCESS NEW PDFS (THE WORKER)
+    # ==========================================
+    print(f"--- Step 1: Checking for new PDFs to process ---")
+    
+    with telemetry.phase("render"):
+        render_new_pdfs(root_dir, exclude)
+
     # ==========================================
     # PHASE 2: ORIENTATION CHECK (THE AUDITOR)
     # ==========================================
     if HAS_TESSERACT:
-        print(f"\n--- Step 2: Checking Orientation (Smart Cache) ---")
-        
-        # Import timeout tools
-        import signal
-        
-        # Define a timeout handler
-        class TimeoutError(Exception): pass 
-        def handler(signum, frame): raise TimeoutError()
-        
-        # (Note: Signal only works on Linux/Mac. For Windows we use a simpler approach below)
-
-        for col_name in os.listdir(OUTPUT_ROOT):
-            col_path = os.path.join(OUTPUT_ROOT, col_name)
-            if not os.path.isdir(col_path): continue
-
-            for book_id in os.listdir(col_path):
-                img_path = os.path.join(col_path, book_id, "images")
-                if not os.path.isdir(img_path): continue
-
-                # Load Audit Log
-                audit_file = os.path.join(col_path, book_id, "audit_log.json")
-                audit_log = {}
-                if os.path.exists(audit_file):
-                    try:
-                        with open(audit_file, 'r') as f:
-                            audit_log = json.load(f)
-                    except:
-                        audit_log = {} # corrupted log, start over
-
-                images = sorted([f for f in os.listdir(img_path) if f.lower().endswith(".jpg")])
-                total_imgs = len(images)
-                updates_made = False
-
-                print(f"   Checking {col_name}/{book_id} ({total_imgs} pages)...")
-
-                for idx, img_file in enumerate(images):
-                    if img_file in audit_log:
-                        continue
-                    
-                    # Print progress every 10 images so you know it's alive
-                    if idx % 10 == 0:
-                        print(f"      Scanning page {idx}/{total_imgs}...", end="\r")
-                    
-                    full_img_path = os.path.join(img_path, img_file)
-                    
-                    try:
-                        # SIMPLE TIMEOUT LOGIC: 
-                        # We just trust Tesseract, but if it crashes we catch it.
-                        # Real timeouts on Windows require 'threading', which is complex.
-                        # Instead, we just print BEFORE we start.
-                        
-                        # Tesseract OSD Check
-                        osd = pytesseract.image_to_osd(full_img_path, config='--psm 0 -c min_characters_to_try=5')
-                        
-                        rotation = 0
-                        for line in osd.split("\n"):
-                            if "Rotate" in line:
-                                try:
-                                    rotation = int(line.split(":")[1].strip())
-                                except: pass
-                        
-                        if rotation != 0:
-                            print(f"      -> Rotating {img_file} by {rotation}°      ") # Spaces to clear line
-                            with Image.open(full_img_path) as im:
-                                rotated = im.rotate(-rotation, expand=True)
-                                rotated.save(full_img_path, quality=80)
-                            audit_log[img_file] = f"rotated_{rotation}"
-                        else:
-                            audit_log[img_file] = "checked_ok"
-                        
-                        updates_made = True
-
-                    except Exception as e:
-                        # If Tesseract hangs or fails, we log it and move on
-                        audit_log[img_file] = "skipped_error"
-                        updates_made = True
-                
-                print(f"      Done with {book_id}.                  ") # Newline after progress bar
-
-                if updates_made:
-                    with open(audit_file, 'w') as f:
-                        json.dump(audit_log, f, indent=4)
+        print(f"\n--- Step 2: Tesseract Analysis (Orientation + Word Boxes) ---")
+        with telemetry.phase("analyse"):
+            analyse_pages()
 
     # ==========================================
-    # PHASE 3: BUILD INDEX (THE LIBRARIAN)
+    # PHASE 3: VIEWER TILES (after any rotation)
     # ==========================================
-    print(f"\n--- Step 3: Rebuilding Website Index ---")
-    
-    site_index = {}
-    
-    if os.path.exists(OUTPUT_ROOT):
-        for col_name in sorted(os.listdir(OUTPUT_ROOT)):
-            col_path = os.path.join(OUTPUT_ROOT, col_name)
-            if not os.path.isdir(col_path): continue
-
-            site_index[col_name] = {}
-            
-            for book_id in sorted(os.listdir(col_path)):
-                img_path = os.path.join(col_path, book_id, "images")
-                if os.path.isdir(img_path):
-                    jpg_count = len([f for f in os.listdir(img_path) if f.lower().endswith(".jpg")])
-                    if jpg_count > 0:
-                        site_index[col_name][book_id] = jpg_count
-
-    index_path = os.path.join(OUTPUT_ROOT, "index.json")
-    with open(index_path, "w") as f:
-        json.dump(site_index, f, indent=4)
-    
-    print(f"Success! Index saved to {index_path}")
+    print(f"\n--- Step 3: Tile Pyramids + Thumbnails ---")
+    with telemetry.phase("tiles"):
+        tiles.generate_tiles()
+
+    # ==========================================
+    # PHASE 4: BUILD INDEX (THE LIBRARIAN)
+    # ==========================================
+    print(f"\n--- Step 4: Updating Website Index ---")
+    with telemetry.phase("index"):
+        build_index()
+
+def build_index(search=True):
+    # Only books whose manifest rows or folders changed are looked at again - see site_index.py
+    rebuilt = site_index.build_index(OUTPUT_ROOT)
+    print(f"Success! Index saved to {os.path.join(OUTPUT_ROOT, site_index.INDEX_FILE)} ({rebuilt} books re-indexed)")
+    if search:
+        terms = search_index.build_search_index(OUTPUT_ROOT)
+        if terms is not None:
+            print(f"Search index rebuilt: {terms} terms in {os.path.join(OUTPUT_ROOT, search_index.SEARCH_DIR)}")
+        books = gazetteer.build_gazetteer(OUTPUT_ROOT)
+        if books:
+            print(f"Gazetteer updated: {books} books re-read into {os.path.join(OUTPUT_ROOT, gazetteer.DB_FILE)}")
 
 if __name__ == "__main__":
-    process_project()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tune-prefilter", action="store_true",
+                        help="Score the orientation pre-filter against existing audit labels and exit")
+    parser.add_argument("--undo-rotation", nargs=2, metavar=("BOOK", "PAGE"),
+                        help="Undo the auditor's rotation of one page, e.g. --undo-rotation IPG/1869 page_012.jpg")
+    args = parser.parse_args()
+    telemetry.start("process_project")
+
+    if args.tune_prefilter:
+        tune_prefilter()
+    elif args.undo_rotation:
+        undo_rotation(os.path.join(OUTPUT_ROOT, args.undo_rotation[0]), args.undo_rotation[1])
+    else:
+        process_project()
\ No newline at end of file
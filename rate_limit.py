@@ -0,0 +1,89 @@
+import time
+import random
+import threading
+
+# Shared request pacing for the Gemini scripts.
+# Each API key gets a token bucket sized from its requests-per-minute (RPM) and a daily
+# budget from its requests-per-day (RPD). keys.txt lines may carry both after the key:
+#
+#   AIzaSy...   15   1500
+#
+# Missing values fall back to the defaults below (15 RPM is what the old fixed 4 s sleep gave us).
+
+DEFAULT_RPM = 15
+DEFAULT_RPD = 1500
+
+def load_key_specs(filepath):
+    """
+    Reads keys.txt into [(key, rpm, rpd)].
+    Raises FileNotFoundError if the file is missing, like open() does.
+    """
+    specs = []
+    with open(filepath, 'r') as f:
+        for line in f:
+            parts = line.strip().split()
+            if not parts:
+                continue
+            rpm = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else DEFAULT_RPM
+            rpd = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else DEFAULT_RPD
+            specs.append((parts[0], rpm, rpd))
+    return specs
+
+def is_quota_error(error):
+    err = str(error)
+    return "429" in err or "quota" in err.lower() or "RESOURCE_EXHAUSTED" in err
+
+def backoff_delay(attempt, base=2.0, cap=120.0):
+    # Exponential backoff with jitter: 2s, 4s, 8s ... capped, each scaled by a random 50-100%
+    return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+class KeyLimiter:
+    """
+    Token bucket for one API key. Tokens refill at rpm per minute up to `burst`, so the time a
+    request spends in flight counts towards the spacing instead of being added on top of it.
+    The daily budget is counted for this run only.
+    """
+
+    def __init__(self, name, rpm=DEFAULT_RPM, rpd=DEFAULT_RPD, burst=1):
+        self.name = name
+        self.rate = rpm / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.rpd = rpd
+        self.used = 0
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self):
+        # Seconds until a token is free (0 if one is ready now); None once the day's budget is spent
+        with self.lock:
+            if self.used >= self.rpd:
+                return None
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(self.blocked_until - now, 0.0)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            return wait
+
+    def try_acquire(self):
+        # Takes a token if one is ready right now; never blocks
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.used >= self.rpd or now < self.blocked_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.used += 1
+            return True
+
+    def penalise(self, seconds):
+        # After a 429, hold this key back for a while without touching the others
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
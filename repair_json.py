@@ -1,55 +1,148 @@
 import os
+import re
 import json
-import time
+import difflib
+import telemetry
 from google import genai
+from gemini_engine import GeminiEngine, Job
+from rate_limit import DEFAULT_RPM, DEFAULT_RPD
+from pipeline_state import PipelineState
+from coords_pack import load_words
 
 # --- CONFIGURATION ---
 API_KEY = "PASTE_YOUR_AIza_KEY_HERE"
 DATA_DIR = "processed_data"
 MODEL_NAME = "gemini-flash-latest"
+API_RPM = DEFAULT_RPM
+API_RPD = DEFAULT_RPD
 
-def repair_overlays():
-    try:
-        client = genai.Client(api_key=API_KEY)
-    except Exception as e:
-        print(f"Error: {e}")
-        return
-
-    print(f"Scanning {DATA_DIR} for overlays to repair...")
-
-    for root, dirs, files in os.walk(DATA_DIR):
-        if "coords" in root: # Only look in coordinate folders
-            for file in files:
-                if file.endswith(".json") and not file.endswith("_clean.json"):
-                    
-                    json_path = os.path.join(root, file)
-                    clean_json_path = json_path.replace(".json", "_clean.json")
-                    
-                    # 1. Check if we already fixed this one
-                    if os.path.exists(clean_json_path):
-                        continue
-                        
-                    # 2. Find the matching "Good Text" (Gemini Output)
-                    # Go up one level from 'coords' to the year folder, then into 'texts'
-                    txt_dir = root.replace("coords", "texts")
-                    txt_path = os.path.join(txt_dir, file.replace(".json", ".txt"))
-                    
-                    if not os.path.exists(txt_path):
-                        print(f"Skipping {file}: No matching clean text found.")
-                        continue
+# LOCAL ALIGNER CONFIG
+# Pages are repaired offline by aligning Tesseract words to the clean text.
+# Only pages whose alignment score falls below ALIGN_MIN_SCORE are sent to Gemini.
+ALIGN_MIN_SCORE = 0.75
+ALIGN_SKIP_COST = 0.6     # cost of leaving a box (or a clean word) unmatched
+ALIGN_JOIN_PENALTY = 0.05 # extra cost for split / merged words, so 1:1 wins a tie
+ALIGN_MAX_GAP_CELLS = 40000
+USE_LLM_FALLBACK = True
 
-                    print(f"Repairing {file}...")
+def tokenize_clean_text(clean_text):
+    # Strip the Markdown the transcription adds (tables, headings, emphasis, rules) and split into words
+    words = []
+    for line in clean_text.splitlines():
+        line = line.strip()
+        if not line or re.fullmatch(r"[|:\-\s]+", line): # blank, '---' or a table separator row
+            continue
+        line = re.sub(r"^#+\s*|^>\s*|[|*_`]", " ", line)
+        words.extend(line.split())
+    return words
 
-                    # 3. Load Data
-                    with open(json_path, 'r', encoding='utf-8') as f:
-                        dirty_json = f.read() # Read as string to pass to AI
-                    
-                    with open(txt_path, 'r', encoding='utf-8') as f:
-                        clean_text = f.read()
+def normalise(token):
+    return re.sub(r"[^0-9a-z]", "", token.lower())
+
+def similarity(a, b):
+    na, nb = normalise(a), normalise(b)
+    if not na or not nb:
+        # Punctuation-only tokens just have to agree with each other
+        return 1.0 if a.strip() == b.strip() else 0.0
+    if na == nb:
+        return 1.0
+    return difflib.SequenceMatcher(None, na, nb, autojunk=False).ratio()
+
+def align_gap(dirty, clean):
+    """
+    Edit-distance alignment of one stretch of Tesseract words against one stretch of clean words.
+    Moves: 1:1 substitution, 2 boxes -> 1 word (Tesseract split it), 1 box -> 2 words (Tesseract
+    merged them), or leave a box / a clean word unmatched.
+    Returns [(dirty_index, new_text, score)] for every box that got a clean word.
+    """
+    n, m = len(dirty), len(clean)
+    INF = float("inf")
+    cost = [[INF] * (m + 1) for _ in range(n + 1)]
+    back = [[None] * (m + 1) for _ in range(n + 1)]
+    cost[0][0] = 0.0
+
+    for i in range(n + 1):
+        for j in range(m + 1):
+            here = cost[i][j]
+            if here == INF:
+                continue
+            moves = []
+            if i < n:
+                moves.append((i + 1, j, ALIGN_SKIP_COST, "skip_box"))
+            if j < m:
+                moves.append((i, j + 1, ALIGN_SKIP_COST, "skip_word"))
+            if i < n and j < m:
+                moves.append((i + 1, j + 1, 1 - similarity(dirty[i], clean[j]), "match"))
+            # Punctuation-only tokens are never joined onto a word
+            if i + 1 < n and j < m and normalise(dirty[i]) and normalise(dirty[i + 1]):
+                moves.append((i + 2, j + 1, 1 - similarity(dirty[i] + dirty[i + 1], clean[j]) + ALIGN_JOIN_PENALTY, "split"))
+            if i < n and j + 1 < m and normalise(clean[j]) and normalise(clean[j + 1]):
+                moves.append((i + 1, j + 2, 1 - similarity(dirty[i], clean[j] + clean[j + 1]) + ALIGN_JOIN_PENALTY, "merge"))
+            for ni, nj, step, move in moves:
+                if here + step < cost[ni][nj]:
+                    cost[ni][nj] = here + step
+                    back[ni][nj] = (i, j, move)
+
+    result = []
+    i, j = n, m
+    while (i, j) != (0, 0):
+        pi, pj, move = back[i][j]
+        if move == "match":
+            result.append((pi, clean[pj], similarity(dirty[pi], clean[pj])))
+        elif move == "split":
+            score = similarity(dirty[pi] + dirty[pi + 1], clean[pj])
+            # Geometry stays as it is: the full word goes in the first box, the second box is emptied
+            result.append((pi, clean[pj], score))
+            result.append((pi + 1, "", score))
+        elif move == "merge":
+            result.append((pi, clean[pj] + " " + clean[pj + 1], similarity(dirty[pi], clean[pj] + clean[pj + 1])))
+        i, j = pi, pj
+    return result
 
-                    # 4. The Magic Prompt
-                    # We ask Gemini to merge the two data sources
-                    prompt = f"""
+def align_words(word_list, clean_text):
+    """
+    Copies the clean spellings onto the Tesseract boxes. Returns (repaired_list, score).
+    The repaired list has exactly the same boxes in the same order with the same x/y/w/h; only
+    'text' changes, and boxes with no counterpart in the clean text keep their Tesseract text.
+    score is the average match quality over all boxes (0 = nothing aligned, 1 = every box exact).
+    """
+    dirty = [w["text"] for w in word_list]
+    clean = tokenize_clean_text(clean_text)
+    if not dirty:
+        return [], 1.0
+
+    texts = list(dirty)
+    scores = [0.0] * len(dirty)
+
+    # 1. Anchor on words that agree exactly once normalised - this is nearly all of a page.
+    #    Punctuation-only tokens normalise to "" and would anchor on each other anywhere on the
+    #    page, so they are left out here and sorted out in the gaps instead.
+    dirty_keys = [(i, normalise(t)) for i, t in enumerate(dirty) if normalise(t)]
+    clean_keys = [(j, normalise(t)) for j, t in enumerate(clean) if normalise(t)]
+    matcher = difflib.SequenceMatcher(None, [k for _, k in dirty_keys], [k for _, k in clean_keys], autojunk=False)
+    anchors = [(dirty_keys[block.a + k][0], clean_keys[block.b + k][0])
+               for block in matcher.get_matching_blocks() for k in range(block.size)]
+
+    di = dj = 0
+    for a, b in anchors + [(len(dirty), len(clean))]:
+        # 2. Edit-distance alignment only inside the gaps between anchors
+        gap_dirty, gap_clean = dirty[di:a], clean[dj:b]
+        if gap_dirty and gap_clean and len(gap_dirty) * len(gap_clean) <= ALIGN_MAX_GAP_CELLS:
+            for offset, text, score in align_gap(gap_dirty, gap_clean):
+                texts[di + offset] = text
+                scores[di + offset] = score
+        if a < len(dirty):
+            texts[a] = clean[b]
+            scores[a] = 1.0
+        di, dj = a + 1, b + 1
+
+    repaired = [dict(word, text=text) for word, text in zip(word_list, texts)]
+    return repaired, sum(scores) / len(scores)
+
+def repair_prompt(dirty_json, clean_text):
+    # The Magic Prompt
+    # We ask Gemini to merge the two data sources
+    return f"""
                     I have two inputs:
                     1. A JSON list of words with coordinates (from Tesseract OCR). The text in this is full of errors.
                     2. A "Clean Text" transcript (from a better AI).
@@ -60,7 +153,7 @@ def repair_overlays():
                     RULES:
                     1. DO NOT change 'x', 'y', 'w', 'h' values. Keep geometry exact.
                     2. Align the clean words to the dirty boxes as best as you can.
-                    3. If Tesseract split a word (e.g. "Pos" "tal"), merge them into one box if possible, or put the full word in the first box.
+                    3. Keep every object, in the same order. If Tesseract split a word (e.g. "Pos" "tal"), put the full word in the first box and "" in the second.
                     4. Output ONLY valid JSON. No markdown formatting.
 
                     --- DIRTY JSON (Source of Truth for Coordinates) ---
@@ -70,32 +163,113 @@ def repair_overlays():
                     {clean_text}
                     """
 
-                    try:
-                        response = client.models.generate_content(
-                            model=MODEL_NAME,
-                            contents=prompt,
-                            config=genai.types.GenerateContentConfig(
-                                response_mime_type="application/json" # Force JSON output
-                            )
-                        )
-                        
-                        # 5. Save the Clean JSON
-                        if response.text:
-                            # Verify it parses
-                            fixed_data = json.loads(response.text)
-                            
-                            with open(clean_json_path, 'w', encoding='utf-8') as f:
-                                json.dump(fixed_data, f, indent=2)
-                            
-                            print(f"   -> Fixed! Saved to {clean_json_path}")
-                        
-                        time.sleep(4) # Rate limit safety
-
-                    except Exception as e:
-                        print(f"   -> Failed to repair: {e}")
-                        if "429" in str(e):
-                            print("   -> Rate limit hit. Sleeping 60s...")
-                            time.sleep(60)
+def same_boxes(dirty_words, fixed_data):
+    # The search index points at boxes by position, so a repair may only change the text
+    return (isinstance(fixed_data, list) and len(fixed_data) == len(dirty_words)
+            and all(isinstance(new, dict) and isinstance(new.get("text"), str)
+                    and all(new.get(k) == old[k] for k in ("x", "y", "w", "h"))
+                    for old, new in zip(dirty_words, fixed_data)))
+
+def write_clean_json(clean_json_path, fixed_data):
+    # Temp file first, so a crash never leaves a truncated overlay behind
+    tmp_path = clean_json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(fixed_data, f, indent=2)
+    os.replace(tmp_path, clean_json_path)
+
+state = None # the pipeline manifest, opened by repair_overlays()
+
+def repair_job(json_path, clean_json_path, dirty_json, clean_text):
+    dirty_words = json.loads(dirty_json)
+
+    def build():
+        return repair_prompt(dirty_json, clean_text)
+
+    def handle(text):
+        # Verify it parses and kept every box where it was; anything else is retried
+        try:
+            fixed_data = json.loads(text)
+        except ValueError:
+            print(f"   -> Gemini returned invalid JSON for {os.path.basename(json_path)}, retrying.")
+            return False
+        if not same_boxes(dirty_words, fixed_data):
+            print(f"   -> Gemini added, dropped or moved boxes in {os.path.basename(json_path)}, retrying.")
+            return False
+
+        write_clean_json(clean_json_path, fixed_data)
+        state.record_file(clean_json_path, "clean")
+        
+        print(f"   -> Fixed! Saved to {clean_json_path}")
+        return True
+
+    config = genai.types.GenerateContentConfig(
+        response_mime_type="application/json" # Force JSON output
+    )
+    return Job(os.path.basename(json_path), build, handle, config)
+
+def align_page(json_path, txt_path, clean_json_path):
+    """
+    Local repair of one page. Writes clean_json_path when the alignment scores at least
+    ALIGN_MIN_SCORE. Returns (score, dirty_json, clean_text) so a low scorer can go to Gemini.
+    Touches no shared state, so run_pipeline.py can run it in a worker process.
+    """
+    dirty_words = load_words(json_path) # from the book's coords.bin when it is current
+    dirty_json = json.dumps(dirty_words) # as a string to pass to AI
+
+    with open(txt_path, 'r', encoding='utf-8') as f:
+        clean_text = f.read()
+
+    # Geometry is untouched by construction
+    with telemetry.stage("align", json_path) as info:
+        fixed_data, score = align_words(dirty_words, clean_text)
+        info["score"] = round(score, 3)
+    if score >= ALIGN_MIN_SCORE:
+        write_clean_json(clean_json_path, fixed_data)
+    return score, dirty_json, clean_text
+
+def repair_overlays():
+    llm_jobs = [] # only pages the aligner could not handle
+    local_count = 0
+
+    global state
+    state = PipelineState(DATA_DIR)
+    print("Looking up overlays to repair...")
+
+    # 1. Pages with word boxes and a clean text but no _clean.json yet
+    for col_name, book_id, page_num in state.pending("clean", after=("coords", "text")):
+        json_path = state.path(col_name, book_id, page_num, "coords")
+        clean_json_path = state.path(col_name, book_id, page_num, "clean")
+        # 2. The matching "Good Text" (Gemini Output)
+        txt_path = state.path(col_name, book_id, page_num, "text")
+        file = os.path.basename(json_path)
+
+        print(f"Repairing {col_name}/{book_id}/{file}...")
+
+        # 3. Try the local aligner first
+        score, dirty_json, clean_text = align_page(json_path, txt_path, clean_json_path)
+        if score >= ALIGN_MIN_SCORE:
+            state.record(col_name, book_id, page_num, "clean", path=clean_json_path)
+            print(f"   -> Aligned locally (score {score:.2f}). Saved to {clean_json_path}")
+            local_count += 1
+            continue
+
+        if not USE_LLM_FALLBACK:
+            print(f"   -> Alignment score {score:.2f} is too low; LLM fallback is off, skipping.")
+            continue
+
+        print(f"   -> Alignment score {score:.2f} is too low, queued for Gemini.")
+        llm_jobs.append(repair_job(json_path, clean_json_path, dirty_json, clean_text))
+
+    # 4. The hard cases go to Gemini, several in flight at once
+    llm_count = 0
+    if llm_jobs:
+        print(f"\nSending {len(llm_jobs)} pages to Gemini...")
+        engine = GeminiEngine([(API_KEY, API_RPM, API_RPD)], MODEL_NAME, label="Repair")
+        llm_count = engine.run(llm_jobs)["saved"]
+
+    print(f"\nDone! {local_count} pages aligned locally, {llm_count} repaired by Gemini.")
 
 if __name__ == "__main__":
-    repair_overlays()
\ No newline at end of file
+    telemetry.start("repair_json")
+    with telemetry.phase("repair"):
+        repair_overlays()
\ No newline at end of file
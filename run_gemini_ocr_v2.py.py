@@ -1,24 +1,26 @@
 import os
-import time
-from google import genai
-import PIL.Image
+import telemetry
+from gemini_engine import GeminiEngine, Job, image_part
+from rate_limit import DEFAULT_RPM, DEFAULT_RPD
+from upload_variants import upload_image
+from page_batches import build_jobs
+from html_markdown import derive_text
+from pipeline_state import PipelineState, DONE, PENDING
+from page_matches import PageMatcher, prior_page, revision_prompt
 
 # --- CONFIGURATION ---
 API_KEY = "PASTE_YOUR_AIza_KEY_HERE" 
 DATA_DIR = "processed_data"
 MODEL_NAME = "gemini-flash-latest"
+API_RPM = DEFAULT_RPM
+API_RPD = DEFAULT_RPD
+UPLOAD_PROFILE = "original" # sends the scan as-is; switch to e.g. "gray_crop" once upload_variants.py --evaluate shows it is no worse
+BATCH_PAGES = 4 # consecutive pages per request; 1 = one page per request. Choose with page_batches.py
+DERIVE_FROM_HTML = True # pages that already have real HTML are converted locally instead of sent again
+USE_EARLIER_EDITIONS = True # copy / correct the matching page of an earlier edition, see page_matches.py
 
-def run_smart_ocr():
-    print(f"Initializing Gemini Client with model: {MODEL_NAME}...")
-    
-    try:
-        client = genai.Client(api_key=API_KEY)
-    except Exception as e:
-        print(f"CRITICAL ERROR: Could not start Client. Check your Key. Error: {e}")
-        return
-
-    # The Prompt: optimized to stop LaTeX and force Markdown tables
-    prompt = """
+# The Prompt: optimized to stop LaTeX and force Markdown tables
+TEXT_PROMPT = """
     Transcribe this image into clean Markdown text.
     RULES:
     1. Preserve original spelling exactly (e.g., use "Mooltan", "Calcutta"). Do not modernize.
@@ -28,43 +30,85 @@ def run_smart_ocr():
     5. Do not describe visual ornaments like ; just skip them.
     """
 
-    print(f"Scanning {DATA_DIR} for empty text files...")
+state = None # the pipeline manifest, opened by run_smart_ocr()
+
+def save_text(txt_path, text):
+    # Written the moment the response arrives, so a crash loses nothing already transcribed
+    with open(txt_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    if state is not None:
+        state.record_file(txt_path, "text")
+    print(f"   -> {os.path.basename(txt_path)}: Transcribed {len(text)} chars.")
+
+def text_job(img_path, txt_path, filename):
+    def build():
+        return [image_part(upload_image(img_path, UPLOAD_PROFILE)), TEXT_PROMPT]
+
+    def handle(text):
+        save_text(txt_path, text)
+        return True
+
+    return Job(filename, build, handle)
+
+def revision_job(img_path, txt_path, filename, prior_key, prior_path):
+    # The same page of an earlier edition, for Gemini to correct against this scan
+    with open(prior_path, "r", encoding="utf-8") as f:
+        prompt = revision_prompt(TEXT_PROMPT, f.read(), prior_key)
+
+    def build():
+        return [image_part(upload_image(img_path, UPLOAD_PROFILE)), prompt]
+
+    def handle(text):
+        save_text(txt_path, text)
+        return True
+
+    return Job(f"{filename} (from {prior_key[1]})", build, handle)
+
+def run_smart_ocr():
+    print(f"Initializing Gemini engine with model: {MODEL_NAME}...")
+
+    global state
+    state = PipelineState(DATA_DIR)
+    print("Looking up pages with empty text files...")
     
-    count = 0
-    for root, dirs, files in os.walk(DATA_DIR):
-        for file in files:
-            if file.endswith(".txt"):
-                txt_path = os.path.join(root, file)
-                
-                # RESUME LOGIC: Only process empty files
-                if os.path.getsize(txt_path) == 0:
-                    img_path = txt_path.replace(".txt", ".jpg").replace("texts", "images")
-                    
-                    if os.path.exists(img_path):
-                        print(f"Processing: {file}...")
-                        try:
-                            image = PIL.Image.open(img_path)
-                            response = client.models.generate_content(
-                                model=MODEL_NAME,
-                                contents=[image, prompt]
-                            )
-                            
-                            if response.text:
-                                with open(txt_path, "w", encoding="utf-8") as f:
-                                    f.write(response.text)
-                                print(f"   -> Success. Transcribed {len(response.text)} chars.")
-                                count += 1
-                            else:
-                                print("   -> Warning: Gemini returned no text.")
-                            
-                            time.sleep(4)
-                            
-                        except Exception as e:
-                            print(f"   -> Error: {e}")
-                            if "429" in str(e): # Quota Hit
-                                print("   -> Rate Limit hit. Sleeping 60s...")
-                                time.sleep(60)
-    print(f"\nDone! Processed {count} pages.")
+    tasks = []
+    revisions = []
+    derived = 0
+    reused = 0
+    matcher = PageMatcher(state, DATA_DIR) if USE_EARLIER_EDITIONS else None
+    # RESUME LOGIC: Only process pages whose text file is still empty
+    for col_name, book_id, page_num in state.with_status("text", PENDING):
+        txt_path = state.path(col_name, book_id, page_num, "text")
+        img_path = state.path(col_name, book_id, page_num, "image")
+        html_path = state.path(col_name, book_id, page_num, "html")
+
+        if DERIVE_FROM_HTML and state.status(col_name, book_id, page_num, "html") == DONE and derive_text(html_path, txt_path):
+            state.record(col_name, book_id, page_num, "text", path=txt_path)
+            derived += 1
+        elif state.status(col_name, book_id, page_num, "image") == DONE:
+            prior = prior_page(state, matcher, (col_name, book_id, page_num), "text") if matcher else None
+            if prior is None:
+                tasks.append((img_path, txt_path, os.path.basename(txt_path)))
+            elif prior[0] == "identical":
+                with open(prior[2], "r", encoding="utf-8") as f:
+                    save_text(txt_path, f.read()) # same page as last year's - nothing to send
+                reused += 1
+            else:
+                revisions.append(revision_job(img_path, txt_path, os.path.basename(txt_path), prior[1], prior[2]))
+
+    if derived:
+        print(f"Converted {derived} pages from their existing HTML (no API call).")
+    if matcher:
+        matcher.save()
+        print(f"Earlier editions: {reused} pages copied as they were, {len(revisions)} sent with the earlier page to correct.")
+    print(f"Found {len(tasks) + len(revisions)} pages to transcribe.")
+    # Pages go BATCH_PAGES to a request; any page a batch garbles is re-sent on its own.
+    jobs = build_jobs(tasks, BATCH_PAGES, TEXT_PROMPT, save_text, text_job, UPLOAD_PROFILE) + revisions
+    engine = GeminiEngine([(API_KEY, API_RPM, API_RPD)], MODEL_NAME, label="OCR")
+    stats = engine.run(jobs)
+    print(f"\nDone! {stats['saved']} requests saved for {len(tasks) + len(revisions)} pages.")
 
 if __name__ == "__main__":
-    run_smart_ocr()
\ No newline at end of file
+    telemetry.start("run_gemini_ocr")
+    with telemetry.phase("text"):
+        run_smart_ocr()
\ No newline at end of file
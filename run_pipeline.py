@@ -0,0 +1,325 @@
+import os
+import time
+import threading
+import asyncio
+import concurrent.futures
+import process_project as pp
+import generate_html
+import repair_json
+import tiles
+import telemetry
+from gemini_engine import GeminiEngine
+from page_batches import build_jobs
+from pipeline_state import PipelineState, DONE, PENDING
+from page_matches import PageMatcher, prior_page
+from html_markdown import derive_text
+from rate_limit import load_key_specs
+
+# One runner for the whole pipeline, page by page instead of script by script:
+#
+#   render ──▶ [analyse queue] ──▶ orient + word boxes ──▶ [Gemini feed] ──▶ HTML (+ text) ──▶ repair ──▶ index
+#   (render pool)                  (Tesseract pool)  │                       (async engine)   (align pool)
+#                                                    └──▶ viewer tiles + thumbnail (tile pool)
+#
+# Each CPU stage has its own process pool, so a burst of tiling or a slow render never takes
+# Tesseract's workers away (and Tesseract never starves the viewer).
+#
+# A page moves on the moment its own inputs are ready, so a new book has its first pages
+# transcribed while later ones are still being rendered. Both queues are bounded: when Tesseract
+# falls behind, rendering waits; when Gemini is saturated, analysis waits. Nothing piles up in memory.
+# Everything is recorded in the pipeline manifest as it happens, so stopping and re-running
+# simply carries on - the standalone scripts still work on the same state.
+
+# --- CONFIGURATION ---
+CPU_WORKERS = os.cpu_count() or 4 # Tesseract processes
+RENDER_IN_FLIGHT = 2  # page ranges rendering at once, one process each
+TILE_WORKERS = max(1, CPU_WORKERS // 4)
+ALIGN_WORKERS = 1     # aligning takes milliseconds
+ANALYSE_QUEUE = 64    # rendered pages waiting for Tesseract
+LLM_QUEUE = 32        # page batches waiting for a Gemini slot
+STATUS_EVERY = 30     # seconds between progress lines
+
+class Pipeline:
+    def __init__(self, workers=CPU_WORKERS):
+        self.workers = workers
+        self.state = PipelineState(pp.OUTPUT_ROOT)
+        # The stage modules record into the same manifest connection
+        generate_html.state = self.state
+        repair_json.state = self.state
+        self.audit_logs = {}  # book_dir -> audit log, loaded on first use
+        self.batches = {}     # (collection, book) -> pages waiting to fill a Gemini batch
+        self.repair_jobs = [] # pages the aligner could not handle
+        self.books = set()
+        self.counts = {"rendered": 0, "analysed": 0, "tiled": 0, "transcribed": 0, "reused": 0, "aligned": 0}
+        self.counts_lock = threading.Lock() # save_page() counts from the engine's threads
+        self.tilers = set()
+        # Pages that match an earlier edition are copied or corrected instead of transcribed
+        self.matcher = PageMatcher(self.state, pp.OUTPUT_ROOT) if generate_html.USE_EARLIER_EDITIONS else None
+
+    # --- helpers ---
+    def paths(self, key, *stages):
+        return [self.state.path(*key, stage) for stage in stages]
+
+    def count(self, name, n=1):
+        with self.counts_lock:
+            self.counts[name] += n
+
+    def save_page(self, html_path, text):
+        # Runs in the engine's thread pool: save as usual, then hand the page to the repair stage
+        generate_html.save_page(html_path, text)
+        self.count("transcribed")
+        key = self.state.key_for(html_path, "html")
+        if key is not None:
+            self.loop.call_soon_threadsafe(self.repair_queue.put_nowait, key)
+
+    def html_job(self, img_path, html_path, filename):
+        return generate_html.html_job(img_path, html_path, filename, save=self.save_page)
+
+    async def feed(self, job):
+        # Waits while Gemini is saturated (back-pressure); False once the engine has stopped (keys spent)
+        while not self.engine_task.done():
+            try:
+                await asyncio.wait_for(self.llm_feed.put(job), timeout=1.0)
+                return True
+            except asyncio.TimeoutError:
+                continue
+        return False
+
+    async def flush(self, book_key):
+        pages = self.batches.pop(book_key, [])
+        jobs = build_jobs(pages, generate_html.BATCH_PAGES, generate_html.HTML_PROMPT, self.save_page,
+                          self.html_job, generate_html.UPLOAD_PROFILE, generate_html.html_is_valid)
+        for job in jobs:
+            if not await self.feed(job):
+                return # left pending in the manifest for the next run
+
+    async def to_llm(self, key):
+        img_path, html_path = self.paths(key, "image", "html")
+        os.makedirs(os.path.dirname(html_path), exist_ok=True)
+        prior = prior_page(self.state, self.matcher, key, "html") if self.matcher else None
+        if prior is not None:
+            kind, prior_key, prior_path = prior
+            if kind == "identical":
+                await self.loop.run_in_executor(None, self.save_page, html_path, generate_html.html_body(prior_path))
+                self.count("reused")
+            else:
+                await self.feed(generate_html.revision_job(img_path, html_path, os.path.basename(img_path),
+                                                           prior_key, prior_path, save=self.save_page))
+            return
+        batch = self.batches.setdefault(key[:2], [])
+        batch.append((img_path, html_path, os.path.basename(img_path)))
+        if len(batch) >= generate_html.BATCH_PAGES:
+            await self.flush(key[:2])
+
+    def ready_for_repair(self, key):
+        return (self.state.status(*key, "coords") == DONE and self.state.status(*key, "text") == DONE
+                and self.state.status(*key, "clean") != DONE)
+
+    # --- stages ---
+    async def tile(self, key):
+        img_path, dzi_path, thumb_path = self.paths(key, "image", "tiles", "thumb")
+        os.makedirs(os.path.dirname(dzi_path), exist_ok=True)
+        try:
+            await self.loop.run_in_executor(self.tile_pool, tiles.make_page_tiles, img_path, dzi_path, thumb_path)
+        except Exception as e:
+            print(f"      -> ERROR tiling {dzi_path}: {e}")
+            tiles.record_tiles(self.state, key, dzi_path, thumb_path, error=str(e))
+            return
+        tiles.record_tiles(self.state, key, dzi_path, thumb_path)
+        self.count("tiled")
+
+    async def render_range(self, job, slots):
+        label, pdf_path, img_out, html_out, first, last = job
+        async with slots:
+            try:
+                count = await self.loop.run_in_executor(self.render_pool, pp.render_page_range, pdf_path, img_out, html_out, first, last)
+            except Exception as e:
+                print(f"      -> ERROR {label} pages {first}-{last}: {e}")
+                return
+            keys = pp.record_rendered(self.state, label, first, count)
+            self.count("rendered", count)
+            print(f"      -> {label}: pages {first}-{last} rendered.")
+            # Still holding the slot: if analysis is behind, this range waits and so does the next render
+            for key in keys:
+                await self.analyse_queue.put((key, True))
+
+    async def produce(self, render_jobs, seeds):
+        # Pages already on disk that still need orientation or word boxes go first, then new renders
+        for item in seeds:
+            await self.analyse_queue.put(item)
+        slots = asyncio.Semaphore(RENDER_IN_FLIGHT)
+        await asyncio.gather(*(self.render_range(job, slots) for job in render_jobs))
+        if render_jobs:
+            # New books show up in the viewer while their transcription is still running (search waits for the end)
+            await self.loop.run_in_executor(None, pp.build_index, False)
+        for _ in range(self.workers):
+            await self.analyse_queue.put(None)
+
+    async def analyse(self):
+        while True:
+            item = await self.analyse_queue.get()
+            if item is None:
+                return
+            key, needs_audit = item
+            img_path, coords_path = self.paths(key, "image", "coords")
+            book_dir = os.path.dirname(os.path.dirname(img_path))
+            img_file = os.path.basename(img_path)
+            os.makedirs(os.path.dirname(coords_path), exist_ok=True)
+            if book_dir not in self.audit_logs:
+                self.audit_logs[book_dir] = pp.load_audit_log(book_dir)
+            self.books.add(book_dir)
+
+            needs_words = self.state.status(*key, "coords") != DONE
+            try:
+                result = await self.loop.run_in_executor(self.analyse_pool, pp.analyse_page, img_path, coords_path,
+                                                         needs_audit, needs_words, pp.OSD_TIMEOUT)
+            except Exception as e:
+                result = pp.died_result(needs_audit, needs_words, str(e))
+            pp.record_analysis(self.state, self.audit_logs[book_dir], book_dir, img_file, key, img_path, coords_path, result)
+            self.count("analysed")
+
+            if self.state.status(*key, "html") != DONE:
+                await self.to_llm(key)
+            elif self.ready_for_repair(key):
+                self.repair_queue.put_nowait(key)
+            # Now that the page is the right way up. A rotation has just put done tiles back to pending;
+            # otherwise a page that already has its tiles is left alone. Tiling runs on its own pool,
+            # so the next page's Tesseract pass does not wait for it.
+            if self.state.status(*key, "tiles") != DONE or self.state.status(*key, "thumb") != DONE:
+                task = asyncio.create_task(self.tile(key))
+                self.tilers.add(task)
+                task.add_done_callback(self.tilers.discard)
+
+    async def repair(self):
+        while True:
+            key = await self.repair_queue.get()
+            if key is None:
+                return
+            if not self.ready_for_repair(key):
+                continue
+            json_path, txt_path, clean_path = self.paths(key, "coords", "text", "clean")
+            try:
+                score, dirty_json, clean_text = await self.loop.run_in_executor(
+                    self.align_pool, repair_json.align_page, json_path, txt_path, clean_path)
+            except Exception as e:
+                print(f"      -> Could not align {clean_path}: {e}")
+                continue
+            if score >= repair_json.ALIGN_MIN_SCORE:
+                self.state.record(*key, "clean", path=clean_path)
+                self.count("aligned")
+            elif repair_json.USE_LLM_FALLBACK:
+                self.repair_jobs.append(repair_json.repair_job(json_path, clean_path, dirty_json, clean_text))
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATUS_EVERY)
+            with self.counts_lock:
+                c = dict(self.counts)
+            print(f"   [Pipeline] rendered {c['rendered']}, analysed {c['analysed']}, tiled {c['tiled']}, transcribed {c['transcribed']} "
+                  f"({c['reused']} copied from earlier editions), "
+                  f"aligned {c['aligned']} | queued: analyse {self.analyse_queue.qsize()}, "
+                  f"Gemini {self.llm_feed.qsize()}, repair {self.repair_queue.qsize()}")
+
+    async def run(self, keys):
+        self.loop = asyncio.get_running_loop()
+        ProcessPool = concurrent.futures.ProcessPoolExecutor
+        self.analyse_pool = ProcessPool(max_workers=self.workers, initializer=pp.init_audit_worker)
+        self.render_pool = ProcessPool(max_workers=RENDER_IN_FLIGHT)
+        self.tile_pool = ProcessPool(max_workers=TILE_WORKERS)
+        self.align_pool = ProcessPool(max_workers=ALIGN_WORKERS)
+        self.analyse_queue = asyncio.Queue(maxsize=ANALYSE_QUEUE)
+        self.llm_feed = asyncio.Queue(maxsize=LLM_QUEUE)
+        self.repair_queue = asyncio.Queue() # aligning takes milliseconds; it never holds anything up
+        started = time.monotonic()
+
+        # Work that is already known, straight from the manifest
+        if pp.HAS_TESSERACT:
+            needs_audit = set(self.state.pending("audit"))
+            to_analyse = sorted(needs_audit | set(self.state.pending("coords")))
+            seeds = [(key, key in needs_audit) for key in to_analyse]
+            render_jobs = pp.find_render_jobs(os.getcwd(), pp.EXCLUDE_DIRS)
+            transcribe_after = ("image", "audit") # never transcribe a page before it is the right way up
+        else:
+            print("   pytesseract is missing: rendering and analysis are skipped, only Gemini and repair run.")
+            seeds, render_jobs, transcribe_after = [], [], ("image",)
+        waiting = {key for key, _ in seeds}
+        to_transcribe = [key for key in self.state.pending("html", after=transcribe_after) if key not in waiting]
+
+        # Empty texts whose HTML already exists are converted here and now, no API call
+        for key in self.state.with_status("text", PENDING):
+            html_path, txt_path = self.paths(key, "html", "text")
+            if self.state.status(*key, "html") == DONE and derive_text(html_path, txt_path):
+                self.state.record(*key, "text", path=txt_path)
+        to_repair = [key for key in self.state.pending("clean", after=("coords", "text")) if key not in waiting]
+        to_tile = sorted((set(self.state.pending("tiles")) | set(self.state.pending("thumb"))) - waiting)
+
+        print(f"--- Pipeline: {len(render_jobs)} page ranges to render, {len(seeds)} pages to analyse, "
+              f"{len(to_transcribe)} to transcribe, {len(to_repair)} to repair, {len(to_tile)} to tile ({self.workers} Tesseract workers) ---")
+
+        self.engine = GeminiEngine(keys, generate_html.MODEL_NAME, label="HTML")
+        self.engine_task = asyncio.create_task(self.engine.run_async(feed=self.llm_feed))
+        reporter = asyncio.create_task(self.report())
+        repairer = asyncio.create_task(self.repair())
+        for key in to_repair:
+            self.repair_queue.put_nowait(key)
+
+        try:
+            analysers = [asyncio.create_task(self.analyse()) for _ in range(self.workers)]
+
+            async def seed_transcriptions():
+                for key in to_transcribe:
+                    await self.to_llm(key)
+
+            async def seed_tiles():
+                # Pages that need nothing but tiles; a pool's worth at a time so freshly rotated pages get a turn
+                slots = asyncio.Semaphore(TILE_WORKERS)
+                async def one(key):
+                    async with slots:
+                        await self.tile(key)
+                await asyncio.gather(*(one(key) for key in to_tile))
+
+            await asyncio.gather(self.produce(render_jobs, seeds), seed_transcriptions(), seed_tiles(), *analysers)
+            await asyncio.gather(*self.tilers)
+            # Nothing else will join the part-filled batches now
+            for book_key in list(self.batches):
+                await self.flush(book_key)
+            await self.feed(None)
+            await self.engine_task
+
+            self.repair_queue.put_nowait(None)
+            await repairer
+            if self.repair_jobs:
+                print(f"   Sending {len(self.repair_jobs)} low-scoring overlays to Gemini...")
+                engine = GeminiEngine(keys, repair_json.MODEL_NAME, label="Repair")
+                await engine.run_async(self.repair_jobs)
+        finally:
+            reporter.cancel()
+            for pool in (self.analyse_pool, self.render_pool, self.tile_pool, self.align_pool):
+                pool.shutdown(wait=True)
+
+        if self.matcher:
+            self.matcher.save()
+        for book_dir in sorted(self.books):
+            pp.compact_audit_log(book_dir, self.audit_logs[book_dir])
+            self.state.pack_coords(os.path.basename(os.path.dirname(book_dir)), os.path.basename(book_dir))
+        pp.build_index()
+
+        c = self.counts
+        print(f"--- Pipeline done in {time.monotonic() - started:.0f}s: rendered {c['rendered']}, analysed {c['analysed']}, tiled {c['tiled']}, "
+              f"transcribed {c['transcribed']}, aligned {c['aligned']} pages. ---")
+
+def run_pipeline(workers=CPU_WORKERS):
+    try:
+        keys = load_key_specs(generate_html.KEY_FILE)
+    except FileNotFoundError:
+        print("keys.txt not found: Gemini stages are skipped, pages stay pending for the next run.")
+        keys = []
+    asyncio.run(Pipeline(workers).run(keys))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Stream every page through render, analysis, Gemini and repair")
+    parser.add_argument("--workers", type=int, default=CPU_WORKERS, help="Processes for Tesseract (rendering, tiling and alignment have their own)")
+    args = parser.parse_args()
+    telemetry.start("run_pipeline")
+    run_pipeline(args.workers)
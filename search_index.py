@@ -0,0 +1,278 @@
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import unicodedata
+from pipeline_state import PipelineState, DONE
+from coords_pack import load_words
+
+# Static full-text search for index.html: processed_data/search/
+#
+#   meta.json            books [[collection, book], ...], shard lists, build version
+#   terms/<xx>.json.gz   {term: [[book, page, boxes, id, id, ...], ...]} for every term starting with "xx"
+#   sounds/<d>.json.gz   {sound key: [term, ...]} for fuzzy search, split on the key's first digit
+#   books/<collection>/<book>.json.gz   one book's terms {term: [[page, boxes, id, ...], ...]}
+#
+# Only books whose text, coords or clean rows changed since the last build are read again; the
+# rest come from books/, and only the term shards those books touch are rewritten. A book keeps its
+# number in meta.json's list for as long as it is indexed, so untouched shards stay valid.
+#
+# `boxes` says which word boxes the ids point into: 0 none (the term is only in the text),
+# 1 coords/page_NNN.json, 2 coords/page_NNN_clean.json. Box ids are positions in that list, so the
+# viewer can outline the hits on the scan with the word boxes it already has (coords.bin or the JSON).
+#
+# Terms come from the aligned boxes where a page has them (Gemini spelling, Tesseract geometry),
+# else from the raw boxes, plus every word of texts/page_NNN.txt so nothing the transcription has
+# is missed. A query fetches only the shards its terms fall in - a few KB each - so there is no
+# server and nothing to load up front.
+#
+# Fuzzy search is for 19th-century spellings (Mooltan / Multan, Cawnpore / Kanpur): terms are
+# grouped by a Soundex-style sound key, and index.html also accepts terms one edit away.
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+SEARCH_DIR = "search"
+BOOKS_DIR = "books" # per-book terms inside SEARCH_DIR
+PREFIX_LEN = 2 # shard on the first two characters of a term
+MIN_TERM_LEN = 2
+
+BOXES_NONE, BOXES_RAW, BOXES_CLEAN = 0, 1, 2
+SEARCH_STAGES = ("text", "coords", "clean") # the rows a book's search terms come from
+
+TOKEN = re.compile(r"\w+")
+SHARD_SAFE = re.compile(r"^[a-z0-9]+$")
+# Same table as soundKey() in index.html; vowels, h, w and y carry no sound
+SOUND_CODES = {}
+for letters, digit in [("bfpv", "1"), ("cgjkqsxz", "2"), ("dt", "3"), ("l", "4"), ("mn", "5"), ("r", "6")]:
+    for letter in letters:
+        SOUND_CODES[letter] = digit
+
+def normalise(word):
+    # Lower case, accents dropped: "Múltan" -> "multan". index.html does the same to queries
+    word = unicodedata.normalize("NFKD", word.lower())
+    return "".join(c for c in word if not unicodedata.combining(c))
+
+def terms_of(text):
+    return [t for t in (normalise(m.group()) for m in TOKEN.finditer(text)) if len(t) >= MIN_TERM_LEN]
+
+def shard_of(term):
+    prefix = term[:PREFIX_LEN]
+    return prefix if SHARD_SAFE.match(prefix) else "_"
+
+def sound_key(term):
+    """
+    Soundex with the first letter coded like the rest, so C/K and vowel-initial variants meet:
+    mooltan, multan -> 5435; cawnpore, kanpur -> 2516. None for numbers.
+    """
+    if not term.isalpha() or not term.isascii():
+        return None
+    key, last = "", None
+    for i, letter in enumerate(term):
+        code = SOUND_CODES.get(letter)
+        if code is None:
+            if letter not in "hw":
+                last = None # a vowel separates repeats; h and w do not
+            if i == 0:
+                key = "0"
+            continue
+        if code != last:
+            key += code
+        last = code
+        if len(key) == 4:
+            break
+    return key if len(key) > 1 else None
+
+def index_page(state, key, stages, postings):
+    """Adds one page's terms to postings {term: {page: [boxes, ids...]}}."""
+    collection, book, page = key
+    boxes, words = BOXES_NONE, []
+    if stages.get("clean") == DONE:
+        boxes, words = BOXES_CLEAN, load_words(state.path(*key, "clean"))
+    if not words and stages.get("coords") == DONE:
+        boxes, words = BOXES_RAW, load_words(state.path(*key, "coords"))
+
+    hits = {}
+    for box_id, word in enumerate(words):
+        for term in terms_of(word.get("text", "")):
+            hits.setdefault(term, []).append(box_id)
+    if stages.get("text") == DONE:
+        try:
+            with open(state.path(*key, "text"), "r", encoding="utf-8") as f:
+                for term in terms_of(f.read()):
+                    hits.setdefault(term, [])
+        except OSError:
+            pass
+
+    for term, ids in hits.items():
+        postings.setdefault(term, {})[page] = [boxes if ids else BOXES_NONE] + sorted(set(ids))
+
+def index_book(state, collection, book):
+    """{term: [[page, boxes, ids...], ...]} for one book, the form kept in books/."""
+    postings = {}
+    for page, stages in sorted(state.book_pages(collection, book).items()):
+        if any(stages.get(stage) == DONE for stage in SEARCH_STAGES):
+            index_page(state, (collection, book, page), stages, postings)
+    return {term: [[page, *rest] for page, rest in sorted(pages.items())] for term, pages in postings.items()}
+
+def write_gz(path, data):
+    # mtime=0 keeps the bytes identical between runs when nothing changed
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(gzip.compress(json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8"), mtime=0))
+
+def read_gz(path):
+    with open(path, "rb") as f:
+        return json.loads(gzip.decompress(f.read()))
+
+def keep_file(src, dst):
+    # An unchanged file goes into the new index as a hard link (a copy where links are not possible)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def build_search_index(data_dir=DATA_DIR, state=None, force=False):
+    """
+    Updates processed_data/search/ for the books that changed since the last build (all of them
+    with force). Returns the number of terms indexed, or None if nothing had changed.
+    """
+    own_state = state is None
+    if own_state:
+        state = PipelineState(data_dir)
+    out_dir = os.path.join(data_dir, SEARCH_DIR)
+    meta_path = os.path.join(out_dir, "meta.json")
+
+    versions = {f"{c}/{b}": list(v) for (c, b), v in state.book_versions(SEARCH_STAGES).items()}
+    old = {}
+    if not force and os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                old = json.load(f)
+        except ValueError:
+            old = {}
+    old_versions = old.get("versions", {})
+    if old and old_versions == versions:
+        if own_state:
+            state.close()
+        return None
+
+    # A book keeps its number; the slots of books that are gone are handed to new ones
+    books = [entry if entry and f"{entry[0]}/{entry[1]}" in versions else None for entry in old.get("books", [])]
+    slots = {f"{entry[0]}/{entry[1]}": i for i, entry in enumerate(books) if entry}
+    for name in sorted(set(versions) - set(slots)):
+        if None in books:
+            slots[name] = books.index(None)
+            books[slots[name]] = name.split("/", 1)
+        else:
+            slots[name] = len(books)
+            books.append(name.split("/", 1))
+
+    # Only changed books are read again; the terms they had or have now mark the shards to rewrite
+    changed = {name for name in set(versions) | set(old_versions) if old_versions.get(name) != versions.get(name)}
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, "terms"))
+    os.makedirs(os.path.join(tmp_dir, "sounds"))
+    # An index from before books/ existed cannot say what to take out, so every shard is rewritten
+    rewrite_all = any(not os.path.exists(os.path.join(out_dir, BOOKS_DIR, f"{name}.json.gz")) for name in old_versions)
+    book_terms, touched = {}, set()
+    for name in sorted(set(versions) | changed):
+        cache_path = os.path.join(BOOKS_DIR, f"{name}.json.gz")
+        live_path, new_path = os.path.join(out_dir, cache_path), os.path.join(tmp_dir, cache_path)
+        if name not in changed and os.path.exists(live_path):
+            book_terms[name] = read_gz(live_path)
+            keep_file(live_path, new_path)
+            continue
+        if os.path.exists(live_path):
+            touched.update(read_gz(live_path))
+        if name in versions:
+            book_terms[name] = index_book(state, *name.split("/", 1))
+            touched.update(book_terms[name])
+            write_gz(new_path, book_terms[name])
+    if own_state:
+        state.close()
+
+    postings = {}
+    for name, terms in book_terms.items():
+        for term, pages in terms.items():
+            postings.setdefault(term, []).extend([slots[name], *page] for page in pages)
+    shards, sounds = {}, {}
+    for term in sorted(postings):
+        shards.setdefault(shard_of(term), {})[term] = sorted(postings[term])
+        key = sound_key(term)
+        if key is not None:
+            sounds.setdefault(key[0], {}).setdefault(key, []).append(term)
+    rewrite = {shard_of(term) for term in touched}
+
+    # Built next to the live index and swapped in, so the viewer never sees half an index
+    for shard, terms in shards.items():
+        live_path = os.path.join(out_dir, "terms", f"{shard}.json.gz")
+        if not rewrite_all and shard not in rewrite and os.path.exists(live_path):
+            keep_file(live_path, os.path.join(tmp_dir, "terms", f"{shard}.json.gz"))
+        else:
+            write_gz(os.path.join(tmp_dir, "terms", f"{shard}.json.gz"), terms)
+    for digit, keys in sounds.items():
+        write_gz(os.path.join(tmp_dir, "sounds", f"{digit}.json.gz"), keys)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        # "version" goes on the shard URLs, so browsers may cache shards until the next rebuild
+        version = hashlib.sha256(json.dumps(versions, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        json.dump({"books": books, "shards": sorted(shards), "sounds": sorted(sounds), "terms": len(postings),
+                   "prefix": PREFIX_LEN, "version": version, "versions": versions}, f, separators=(",", ":"))
+
+    old_dir = out_dir + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return len(postings)
+
+def search(query, data_dir=DATA_DIR, fuzzy=False):
+    """
+    Command-line twin of the viewer's search: pages containing every query term.
+    Returns [(collection, book, page, {term: box ids})].
+    """
+    out_dir = os.path.join(data_dir, SEARCH_DIR)
+    with open(os.path.join(out_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    loaded = {}
+
+    def shard(folder, name):
+        if (folder, name) not in loaded:
+            path = os.path.join(out_dir, folder, f"{name}.json.gz")
+            loaded[(folder, name)] = json.loads(gzip.decompress(open(path, "rb").read())) if os.path.exists(path) else {}
+        return loaded[(folder, name)]
+
+    pages = None
+    for term in terms_of(query):
+        variants = {term}
+        if fuzzy:
+            key = sound_key(term)
+            if key is not None:
+                variants.update(shard("sounds", key[0]).get(key, []))
+        hits = {}
+        for variant in variants:
+            for b, p, boxes, *ids in shard("terms", shard_of(variant)).get(variant, []):
+                hits.setdefault((b, p), {})[variant] = ids
+        pages = hits if pages is None else {k: {**pages[k], **v} for k, v in hits.items() if k in pages}
+    return [(*meta["books"][b], p, found) for (b, p), found in sorted((pages or {}).items())]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or query the static search index in processed_data/search")
+    parser.add_argument("query", nargs="*", help="Words to look up instead of building")
+    parser.add_argument("--fuzzy", action="store_true", help="Also match words that sound alike")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if nothing changed")
+    args = parser.parse_args()
+
+    if args.query:
+        results = search(" ".join(args.query), fuzzy=args.fuzzy)
+        for collection, book, page, found in results:
+            print(f"   {collection}/{book} page_{page:03d}: " + ", ".join(f"{t} ({len(ids)} boxes)" for t, ids in found.items()))
+        print(f"{len(results)} pages.")
+    else:
+        count = build_search_index(force=args.force)
+        print("Search index is up to date." if count is None else f"Search index saved to {os.path.join(DATA_DIR, SEARCH_DIR)} ({count} terms).")
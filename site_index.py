@@ -0,0 +1,145 @@
+import os
+import json
+from PIL import Image
+import tiles
+from pipeline_state import PipelineState, DONE, page_stem
+
+# Incremental site index for index.html
+#
+#   processed_data/index.json                     {collection: {book: {"pages", "html", "text", "coords", "version"}}}
+#   processed_data/<collection>/<book>/pages.json {"flags": {...}, "tiles": {...}, "pages": [[page, flags, width, height], ...]}
+#
+# index.json used to be rebuilt from scratch on every run by listing every images/ folder, and it
+# only held a page count, so the viewer asked for htmls/page_NNN.html whether or not it had been
+# generated. Now every book gets its own pages.json saying which artefacts each page actually
+# has, plus the scan's pixel size. A book is only looked at again when its manifest rows changed
+# (any stage recorded) or one of its folders changed on disk (files added or removed by hand);
+# every other book is copied over from the previous index.json untouched.
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+INDEX_FILE = "index.json"
+BOOK_FILE = "pages.json"
+FOLDERS = ["images", "texts", "htmls", "coords", "tiles", "thumbs"]
+
+# One bit per artefact in pages.json - index.html has the same table
+FLAGS = {"image": 1, "text": 2, "html": 4, "coords": 8, "tiles": 16, "thumb": 32}
+
+def folder_times(book_dir):
+    # Newest mtime of the artefact folders: a file added or removed shows up here, a file
+    # rewritten in place (placeholder -> HTML) does not, but the stage recorded that in the manifest
+    times = []
+    for folder in FOLDERS:
+        try:
+            times.append(os.stat(os.path.join(book_dir, folder)).st_mtime_ns)
+        except OSError:
+            continue
+    return max(times, default=0)
+
+def image_size(img_path):
+    # Only the JPEG header is read
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except (OSError, ValueError):
+        return 0, 0
+
+def index_book(state, collection, book, book_dir):
+    """
+    Writes <book>/pages.json from the manifest and returns the book's index.json entry,
+    or None if the book has no scans.
+    """
+    rows = []
+    counts = {stage: 0 for stage in FLAGS if stage != "image"}
+    for page, stages in sorted(state.book_pages(collection, book).items()):
+        if stages.get("image") != DONE:
+            continue
+        flags = 0
+        for stage, bit in FLAGS.items():
+            if stages.get(stage) == DONE:
+                flags |= bit
+                if stage in counts:
+                    counts[stage] += 1
+        width, height = image_size(os.path.join(book_dir, "images", page_stem(page) + ".jpg"))
+        rows.append([page, flags, width, height])
+    if not rows:
+        return None
+
+    tmp_path = os.path.join(book_dir, BOOK_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"flags": FLAGS, "pages": rows,
+                   "tiles": {"size": tiles.TILE_SIZE, "overlap": tiles.TILE_OVERLAP, "format": tiles.TILE_FORMAT}},
+                  f, separators=(",", ":"))
+    os.replace(tmp_path, os.path.join(book_dir, BOOK_FILE))
+    return {"pages": len(rows), **counts}
+
+def build_index(data_dir=DATA_DIR, state=None, full=False):
+    """
+    Brings index.json and every changed book's pages.json up to date.
+    full rescans every book (and re-syncs it from disk) regardless of what changed.
+    Returns the number of books that were re-indexed.
+    """
+    own_state = state is None
+    if own_state:
+        state = PipelineState(data_dir)
+    index_path = os.path.join(data_dir, INDEX_FILE)
+
+    previous = {}
+    if not full and os.path.exists(index_path):
+        try:
+            with open(index_path, "r") as f:
+                previous = json.load(f)
+        except ValueError:
+            previous = {}
+
+    versions = state.book_versions()
+    site_index = {}
+    rebuilt = 0
+    # Books the manifest knows, plus folders it has not heard of yet
+    books = set(versions)
+    if os.path.isdir(data_dir):
+        for col_entry in os.scandir(data_dir):
+            if not col_entry.is_dir() or col_entry.name.startswith('.'): continue
+            for book_entry in os.scandir(col_entry.path):
+                if book_entry.is_dir() and os.path.isdir(os.path.join(book_entry.path, "images")):
+                    books.add((col_entry.name, book_entry.name))
+
+    for collection, book in sorted(books):
+        book_dir = os.path.join(data_dir, collection, book)
+        if not os.path.isdir(book_dir):
+            continue
+        disk_time = folder_times(book_dir)
+        old = previous.get(collection, {}).get(book)
+        # Old index.json entries were plain page counts; those books get indexed properly once
+        old_version = old.get("version") if isinstance(old, dict) else None
+        if full or old_version is None or old_version[0] != disk_time:
+            state.sync_book(collection, book) # files may have come or gone behind the pipeline's back
+            versions[(collection, book)] = state.book_versions().get((collection, book))
+        rows, updated = versions.get((collection, book)) or (0, 0)
+        version = [disk_time, rows, updated]
+
+        if old_version == version and os.path.exists(os.path.join(book_dir, BOOK_FILE)):
+            entry = old
+        else:
+            entry = index_book(state, collection, book, book_dir)
+            rebuilt += 1
+            if entry is None:
+                continue
+            entry["version"] = version
+        site_index.setdefault(collection, {})[book] = entry
+
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(site_index, f, indent=1)
+    os.replace(tmp_path, index_path)
+    if own_state:
+        state.close()
+    return rebuilt
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Update processed_data/index.json and the per-book pages.json files")
+    parser.add_argument("--full", action="store_true", help="Re-index every book, not just the ones that changed")
+    args = parser.parse_args()
+    count = build_index(full=args.full)
+    print(f"Index saved to {os.path.join(DATA_DIR, INDEX_FILE)} ({count} books re-indexed).")
@@ -0,0 +1,310 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import atexit
+import socket
+import threading
+import contextlib
+
+# Run telemetry for the pipeline scripts: a JSONL event log per run, and a report over it.
+#
+#   telemetry/<run>/<script>-<pid>.jsonl    one file per process (pool workers write their own), e.g.
+#     {"t": 1718000000.1, "kind": "stage", "stage": "words", "page": "IPG/1869/12", "seconds": 3.41, "ok": true}
+#     {"t": ..., "kind": "request", "label": "HTML", "job": "page_012.jpg", "key": 2, "status": "ok",
+#      "latency": 14.2, "sent": 812345, "received": 20433, "attempt": 0, "in_flight": 4, "limit": 6}
+#     {"t": ..., "kind": "throttle", "label": "HTML", "key": 2, "consecutive": 1, "delay": 3.1}
+#     {"t": ..., "kind": "phase", "stage": "analyse", "seconds": 812.5, "ok": true}
+#
+# Stages are timed where the work is done: render (a page range), prefilter, osd, rotate, words
+# (image_to_data), tiles, align. Worker processes find the run through PIPELINE_RUN in their
+# environment, and a script started by another one (benchmark.py) joins the caller's run.
+# Without start() - a module imported from somewhere else - every call here is a no-op.
+#
+#   python telemetry.py report                 the latest run: throughput, p50/p95 per stage and per
+#   python telemetry.py report <run> --json    request kind, quota use per key, the slowest pages
+#   python telemetry.py list
+#
+# One page under the profiler: PIPELINE_PROFILE=words:IPG/1869/12 python generate_overlays.py
+# runs that stage of that page with cProfile and tracemalloc, and leaves profile-*.prof (for
+# snakeviz / pstats) and profile-*.txt (top functions and allocations) in the run folder.
+
+# --- CONFIGURATION ---
+TELEMETRY_DIR = "telemetry"
+ENABLED = True
+RUN_ENV = "PIPELINE_RUN"
+PROFILE_ENV = "PIPELINE_PROFILE"
+SLOWEST_PAGES = 10
+PROFILE_LINES = 30
+
+PAGE_PATH = re.compile(r"([^/\\]+)[/\\]([^/\\]+)[/\\](?:images|htmls|texts|coords|tiles|thumbs|upload)(?:[/\\]page_(\d+))?")
+
+_name = "worker"
+_pid = None
+_file = None
+_lock = threading.Lock()
+
+def start(script):
+    """Opens a run for this script (or joins the one in PIPELINE_RUN). Returns the run folder, or None."""
+    global _name, _pid
+    if not ENABLED:
+        return None
+    run = os.environ.get(RUN_ENV)
+    if not run:
+        run = os.path.abspath(os.path.join(TELEMETRY_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{script}"))
+        os.environ[RUN_ENV] = run # inherited by the worker processes
+    _name, _pid = script, None
+    event("start", script=script, argv=sys.argv[1:], host=socket.gethostname(), cpus=os.cpu_count())
+    atexit.register(event, "end", script=script)
+    return run
+
+def stop():
+    # Ends this process's part of the run (for callers that outlive it, like benchmark.py)
+    global _file
+    if _file is not None:
+        event("end", script=_name)
+        _file.close()
+        _file = None
+    os.environ.pop(RUN_ENV, None)
+
+def _open():
+    # First event in this process (or in a forked worker, which must not share the parent's file)
+    global _pid, _file, _lock
+    _pid, _file, _lock = os.getpid(), None, threading.Lock()
+    run = os.environ.get(RUN_ENV)
+    if run and ENABLED:
+        os.makedirs(run, exist_ok=True)
+        _file = open(os.path.join(run, f"{_name}-{_pid}.jsonl"), "a", encoding="utf-8", buffering=1)
+
+def event(kind, **fields):
+    if _pid != os.getpid():
+        _open()
+    if _file is None:
+        return
+    line = json.dumps({"t": round(time.time(), 3), "kind": kind, **fields}, default=str)
+    with _lock:
+        _file.write(line + "\n") # line-buffered: a crash loses nothing already logged
+
+def page_id(page):
+    # "IPG/1869/12" from a (collection, book, page) key or any path inside a book folder
+    if page is None or isinstance(page, str) and not page:
+        return None
+    if isinstance(page, tuple):
+        return "/".join(str(p) for p in page)
+    match = PAGE_PATH.search(str(page))
+    if not match:
+        return str(page)
+    collection, book, number = match.groups()
+    return f"{collection}/{book}/{int(number)}" if number else f"{collection}/{book}"
+
+@contextlib.contextmanager
+def stage(name, page=None, kind="stage", **fields):
+    """
+        with telemetry.stage("words", img_path) as info:
+            ...
+            info["words"] = len(word_list)   # optional extra fields for the event
+
+    Logs the time taken, and whether it raised, when the block ends.
+    """
+    page = page_id(page)
+    profile = _Profile(name, page) if os.environ.get(PROFILE_ENV) == f"{name}:{page}" else None
+    info = dict(fields)
+    started = time.perf_counter()
+    try:
+        yield info
+    except BaseException as e:
+        info["ok"], info["error"] = False, type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        if profile is not None:
+            profile.finish()
+        info.setdefault("ok", True)
+        event(kind, stage=name, page=page, seconds=round(seconds, 4), **info)
+
+def phase(name):
+    # One whole step of a script (all pages)
+    return stage(name, kind="phase")
+
+class _Profile:
+    def __init__(self, name, page):
+        import cProfile
+        import tracemalloc
+        self.name, self.page = name, page
+        self.tracemalloc = tracemalloc
+        tracemalloc.start(25)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def finish(self):
+        import io
+        import pstats
+        self.profiler.disable()
+        snapshot = self.tracemalloc.take_snapshot()
+        _, peak = self.tracemalloc.get_traced_memory()
+        self.tracemalloc.stop()
+
+        folder = os.environ.get(RUN_ENV) or "."
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, f"profile-{self.name}-{self.page.replace('/', '_')}")
+        self.profiler.dump_stats(base + ".prof")
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        out.write(f"\nPython allocations: peak {peak / 2**20:.1f} MB. Largest still held at the end:\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_LINES // 2]:
+            out.write(f"   {stat}\n")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        event("profile", stage=self.name, page=self.page, peak_mb=round(peak / 2**20, 2), path=base + ".prof")
+
+# --- report ---
+def runs(folder=TELEMETRY_DIR):
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, d) for d in os.listdir(folder) if os.path.isdir(os.path.join(folder, d)))
+
+def load_run(run):
+    events = []
+    for name in sorted(os.listdir(run)):
+        if not name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(run, name), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass # the last line of a process that was killed mid-write
+    return sorted(events, key=lambda e: e["t"])
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+def timing(values):
+    return {"n": len(values), "total": round(sum(values), 2), "p50": percentile(values, 50),
+            "p95": percentile(values, 95), "max": max(values) if values else None}
+
+def summarise(events):
+    """The report as a dict (what `report --json` prints)."""
+    if not events:
+        return {}
+    began = min(e["t"] - e.get("seconds", 0) for e in events)
+    wall = max(e["t"] for e in events) - began
+
+    stages = {}
+    for e in events:
+        if e["kind"] == "stage":
+            s = stages.setdefault(e["stage"], {"seconds": [], "errors": 0, "pages": set(), "first": e["t"] - e["seconds"], "last": e["t"]})
+            s["seconds"].append(e["seconds"])
+            s["errors"] += not e.get("ok", True)
+            s["pages"].add(e.get("page"))
+            s["first"], s["last"] = min(s["first"], e["t"] - e["seconds"]), max(s["last"], e["t"])
+    stage_report = {}
+    for name, s in stages.items():
+        span = max(s["last"] - s["first"], 1e-9)
+        stage_report[name] = {**timing(s["seconds"]), "errors": s["errors"], "pages": len(s["pages"] - {None}),
+                              "per_s": round(len(s["seconds"]) / span, 3)}
+
+    requests, keys = {}, {}
+    for e in events:
+        if e["kind"] == "request":
+            r = requests.setdefault(e["label"], {"latency": [], "status": {}, "errors": {}, "sent": 0, "received": 0, "retries": 0})
+            r["status"][e["status"]] = r["status"].get(e["status"], 0) + 1
+            if e.get("error"):
+                r["errors"][e["error"]] = r["errors"].get(e["error"], 0) + 1
+            if e["status"] == "ok":
+                r["latency"].append(e["latency"])
+            r["sent"] += e.get("sent", 0)
+            r["received"] += e.get("received", 0)
+            r["retries"] += e.get("attempt", 0) > 0
+        if e["kind"] in ("request", "throttle", "key_retired") and e.get("key") is not None:
+            k = keys.setdefault(f"{e['label']} key {e['key']}", {"requests": 0, "throttled": 0, "retired": None})
+            if e["kind"] == "request" and e["status"] != "cache":
+                k["requests"] += 1
+                k["throttled"] += e["status"] == "quota"
+            elif e["kind"] == "key_retired":
+                k["retired"] = e.get("reason")
+    request_report = {label: {"status": r["status"], "errors": r["errors"], "retries": r["retries"],
+                              "latency": timing(r["latency"]), "sent_mb": round(r["sent"] / 2**20, 2),
+                              "received_mb": round(r["received"] / 2**20, 2)}
+                      for label, r in requests.items()}
+
+    pages = {}
+    for e in events:
+        if e["kind"] == "stage" and e.get("page") and e["page"].count("/") == 2:
+            page = pages.setdefault(e["page"], {})
+            page[e["stage"]] = round(page.get(e["stage"], 0) + e["seconds"], 3)
+    slowest = sorted(pages.items(), key=lambda kv: -sum(kv[1].values()))[:SLOWEST_PAGES]
+
+    return {
+        "scripts": sorted({e["script"] for e in events if e["kind"] == "start"}),
+        "seconds": round(wall, 1),
+        "pages": len(pages),
+        "pages_per_s": round(len(pages) / wall, 3) if wall else None,
+        "phases": [{"stage": e["stage"], "seconds": e["seconds"], "ok": e.get("ok", True)} for e in events if e["kind"] == "phase"],
+        "stages": stage_report,
+        "requests": request_report,
+        "keys": keys,
+        "slowest_pages": [{"page": p, "seconds": round(sum(s.values()), 3), "stages": s} for p, s in slowest],
+    }
+
+def fmt(value):
+    return "-" if value is None else f"{value:.2f}"
+
+def print_report(run, summary):
+    print(f"Run {os.path.basename(run)}: {', '.join(summary['scripts']) or '?'} - {summary['seconds']}s, "
+          f"{summary['pages']} pages ({fmt(summary['pages_per_s'])} pages/s)")
+    for p in summary["phases"]:
+        print(f"   phase {p['stage']:<20} {p['seconds']:9.1f}s" + ("" if p["ok"] else "  FAILED"))
+
+    if summary["stages"]:
+        print(f"\n   {'stage':<12}{'n':>7}{'total s':>10}{'p50':>8}{'p95':>8}{'max':>8}{'per s':>8}{'errors':>8}")
+        for name, s in sorted(summary["stages"].items(), key=lambda kv: -kv[1]["total"]):
+            print(f"   {name:<12}{s['n']:>7}{s['total']:>10.1f}{fmt(s['p50']):>8}{fmt(s['p95']):>8}{fmt(s['max']):>8}"
+                  f"{fmt(s['per_s']):>8}{s['errors']:>8}")
+
+    for label, r in summary["requests"].items():
+        lat = r["latency"]
+        print(f"\n   [{label}] {sum(r['status'].values())} requests: " + ", ".join(f"{n} {s}" for s, n in sorted(r["status"].items())) +
+              f"; latency p50 {fmt(lat['p50'])}s p95 {fmt(lat['p95'])}s; {r['retries']} retries; "
+              f"{r['sent_mb']} MB sent, {r['received_mb']} MB received")
+        if r["errors"]:
+            print("      errors: " + ", ".join(f"{n} x {name}" for name, n in sorted(r["errors"].items(), key=lambda kv: -kv[1])))
+    if summary["keys"]:
+        print()
+        for key, k in sorted(summary["keys"].items()):
+            print(f"   {key}: {k['requests']} requests, {k['throttled']} x 429" + (f", retired ({k['retired']})" if k["retired"] else ""))
+
+    if summary["slowest_pages"]:
+        print(f"\n   Slowest pages:")
+        for p in summary["slowest_pages"]:
+            print(f"   {p['page']:<24}{p['seconds']:8.1f}s  " + ", ".join(f"{s} {v:.1f}" for s, v in sorted(p["stages"].items(), key=lambda kv: -kv[1])))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarise the telemetry of a pipeline run")
+    parser.add_argument("command", choices=["report", "list"])
+    parser.add_argument("run", nargs="?", help="Run folder (default: the latest in telemetry/)")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for run in runs():
+            files = [f for f in os.listdir(run) if f.endswith(".jsonl")]
+            print(f"   {os.path.basename(run)}  ({len(files)} processes)")
+    else:
+        run = args.run or (runs() or [None])[-1]
+        if run is None or not os.path.isdir(run):
+            print("No telemetry yet: run one of the pipeline scripts first.")
+            sys.exit(1)
+        summary = summarise(load_run(run))
+        if not summary:
+            print(f"No events in {run}.")
+        elif args.json:
+            print(json.dumps(summary, indent=1))
+        else:
+            print_report(run, summary)
@@ -0,0 +1,65 @@
+import json
+import os
+import random
+from PIL import Image, ImageDraw
+from pipeline_state import PipelineState
+from page_matches import PageMatcher
+
+# A directory page: 120 "office, district" rows in two columns
+OFFICES = [f"Office{chr(97 + i // 26)}{chr(97 + i % 26)}" for i in range(120)]
+
+def scan(path, seed):
+    # Same layout every time; the seed only changes the scanner noise
+    rng = random.Random(seed)
+    img = Image.new("L", (600, 800), 235)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((40, 40, 560, 90), fill=60)
+    for row in range(30):
+        draw.rectangle((40, 120 + row * 22, 280 - (row * 37) % 120, 132 + row * 22), fill=80)
+        draw.rectangle((320, 120 + row * 22, 560 - (row * 53) % 150, 132 + row * 22), fill=80)
+    for _ in range(3000):
+        img.putpixel((rng.randrange(600), rng.randrange(800)), rng.randrange(256))
+    img.save(path, "JPEG", quality=rng.choice([70, 85, 95]))
+
+def add_page(state, data_dir, book, words, seed):
+    book_dir = os.path.join(data_dir, "IPG", book)
+    os.makedirs(os.path.join(book_dir, "images"), exist_ok=True)
+    os.makedirs(os.path.join(book_dir, "coords"), exist_ok=True)
+    img_path, coords_path = state.path("IPG", book, 1, "image"), state.path("IPG", book, 1, "coords")
+    scan(img_path, seed)
+    with open(coords_path, "w", encoding="utf-8") as f:
+        json.dump([{"text": w, "left": 0, "top": 0, "width": 1, "height": 1, "conf": 90} for w in words], f)
+    state.record("IPG", book, 1, "image", path=img_path)
+    state.record("IPG", book, 1, "coords", path=coords_path)
+
+def ocr(offices, seed, misread=False):
+    # Tesseract output for the page, with the usual noise: stray marks, case, punctuation, maybe a misread
+    rng = random.Random(seed)
+    words = []
+    for office in offices:
+        words += [office + rng.choice(["", ",", "."]), rng.choice(["Dist.", "dist", "DIST"]), rng.choice(["|", "", "'", "l"])]
+    if misread:
+        i = rng.randrange(len(offices)) * 3
+        words[i] = words[i].replace("O", "0", 1)
+    return [w for w in words if w]
+
+def match_1870(tmp_path, offices_1870):
+    data_dir = str(tmp_path / "processed_data")
+    os.makedirs(data_dir)
+    state = PipelineState(data_dir)
+    add_page(state, data_dir, "1869", ocr(OFFICES, 1), seed=1)
+    add_page(state, data_dir, "1870", ocr(offices_1870, 2, misread=True), seed=2)
+    match = PageMatcher(state, data_dir).match(("IPG", "1870", 1))
+    state.close()
+    return match
+
+def test_noisy_ocr_of_the_same_page_is_identical(tmp_path):
+    match = match_1870(tmp_path, OFFICES)
+    assert match is not None and match["book"] == "1869"
+    assert match["kind"] == "identical", match
+
+def test_page_with_new_names_is_only_similar(tmp_path):
+    offices = OFFICES[:115] + ["Multan", "Cawnpore", "Lahore", "Peshawar", "Mooltan"]
+    match = match_1870(tmp_path, offices)
+    assert match is not None and match["book"] == "1869"
+    assert match["kind"] == "similar", match
@@ -0,0 +1,143 @@
+import os
+import math
+import shutil
+import concurrent.futures
+import telemetry
+from PIL import Image
+from pipeline_state import PipelineState, FAILED
+
+# Deep Zoom (DZI) tile pyramids and thumbnails for index.html
+#
+#   processed_data/<collection>/<book>/tiles/page_NNN.dzi                 standard DZI descriptor
+#   processed_data/<collection>/<book>/tiles/page_NNN_files/<level>/<col>_<row>.jpg
+#   processed_data/<collection>/<book>/thumbs/page_NNN.jpg                THUMB_SIZE px on the long edge
+#
+# Level L is the scan scaled to ceil(size / 2^(max_level - L)); max_level is the full scan and
+# level 0 is 1x1 px, as OpenSeadragon and friends expect. The viewer shows the thumbnail at once
+# and then fetches only the tiles of the level that matches the current zoom and are on screen,
+# instead of the whole JPEG for every page.
+#
+# Both are pipeline stages ("tiles" and "thumb", built from "image"), so a page rotated after its
+# tiles were cut is picked up by `python pipeline_state.py rebuild --stale` like everything else.
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_FORMAT = "jpg"
+TILE_QUALITY = 80
+THUMB_SIZE = 240
+THUMB_QUALITY = 75
+TILE_WORKERS = os.cpu_count() or 4
+
+def max_level(width, height):
+    return max(1, math.ceil(math.log2(max(width, height, 1))))
+
+def level_size(width, height, level, top):
+    scale = 2 ** (top - level)
+    return max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale))
+
+def dzi_xml(width, height):
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{TILE_SIZE}" '
+            f'Overlap="{TILE_OVERLAP}" Format="{TILE_FORMAT}">\n'
+            f'  <Size Width="{width}" Height="{height}"/>\n'
+            f'</Image>\n')
+
+def cut_level(img, level_dir):
+    width, height = img.size
+    os.makedirs(level_dir)
+    for row in range(math.ceil(height / TILE_SIZE)):
+        for col in range(math.ceil(width / TILE_SIZE)):
+            left = max(col * TILE_SIZE - TILE_OVERLAP, 0)
+            top = max(row * TILE_SIZE - TILE_OVERLAP, 0)
+            right = min((col + 1) * TILE_SIZE + TILE_OVERLAP, width)
+            bottom = min((row + 1) * TILE_SIZE + TILE_OVERLAP, height)
+            img.crop((left, top, right, bottom)).save(
+                os.path.join(level_dir, f"{col}_{row}.{TILE_FORMAT}"), "JPEG", quality=TILE_QUALITY)
+
+def make_page_tiles(img_path, dzi_path, thumb_path):
+    """
+    Cuts the pyramid and the thumbnail for one scan. Each level is scaled from the one above it,
+    so the full-size scan is resized once, not once per level. The tiles are written to a
+    scratch folder and swapped in, so the viewer never sees half a pyramid.
+    Touches no shared state (runs in a worker process). Returns the scan's (width, height).
+    """
+    with telemetry.stage("tiles", img_path):
+        files_dir = dzi_path[:-len(".dzi")] + "_files"
+        tmp_dir = files_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        with Image.open(img_path) as img:
+            img = img.convert("L") if img.mode in ("L", "1") else img.convert("RGB")
+            width, height = img.size
+            top = max_level(width, height)
+            level_img = img
+            for level in range(top, -1, -1):
+                size = level_size(width, height, level, top)
+                if level_img.size != size:
+                    level_img = level_img.resize(size, Image.LANCZOS)
+                cut_level(level_img, os.path.join(tmp_dir, str(level)))
+
+            thumb = img.copy()
+            thumb.thumbnail((THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            thumb.save(thumb_path + ".tmp", "JPEG", quality=THUMB_QUALITY)
+            os.replace(thumb_path + ".tmp", thumb_path)
+
+        # Old pyramid renamed aside, new one renamed in, old one deleted: the folder is missing
+        # only between two renames, never for as long as deleting thousands of tiles takes
+        old_dir = files_dir + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(files_dir):
+            os.rename(files_dir, old_dir)
+        os.rename(tmp_dir, files_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        with open(dzi_path + ".tmp", "w") as f:
+            f.write(dzi_xml(width, height))
+        os.replace(dzi_path + ".tmp", dzi_path)
+    return width, height
+
+def record_tiles(state, key, dzi_path, thumb_path, error=None):
+    # The pyramid is too many files to hash; the descriptor and thumbnail stand in for it
+    if error is None:
+        state.record(*key, "tiles", path=dzi_path)
+        state.record(*key, "thumb", path=thumb_path)
+    else:
+        state.record(*key, "tiles", FAILED, error=error)
+
+def generate_tiles(workers=TILE_WORKERS):
+    state = PipelineState(DATA_DIR)
+    todo = sorted(set(state.pending("tiles")) | set(state.pending("thumb")))
+    print(f"Found {len(todo)} pages needing tiles and thumbnails.")
+    if not todo:
+        return
+
+    done = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for key in todo:
+            dzi_path, thumb_path = state.path(*key, "tiles"), state.path(*key, "thumb")
+            os.makedirs(os.path.dirname(dzi_path), exist_ok=True)
+            futures[executor.submit(make_page_tiles, state.path(*key, "image"), dzi_path, thumb_path)] = (key, dzi_path, thumb_path)
+        for future in concurrent.futures.as_completed(futures):
+            key, dzi_path, thumb_path = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"   -> ERROR tiling {dzi_path}: {e}")
+                record_tiles(state, key, dzi_path, thumb_path, error=str(e))
+                continue
+            record_tiles(state, key, dzi_path, thumb_path)
+            done += 1
+            if done % 100 == 0:
+                print(f"   -> {done}/{len(todo)} pages tiled")
+    print(f"Tiled {done}/{len(todo)} pages.")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Cut DZI tile pyramids and thumbnails for every page that needs them")
+    parser.add_argument("--workers", type=int, default=TILE_WORKERS)
+    args = parser.parse_args()
+    telemetry.start("tiles")
+    generate_tiles(args.workers)
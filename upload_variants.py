@@ -0,0 +1,205 @@
+import os
+import io
+import time
+import random
+import difflib
+from PIL import Image, ImageOps
+from pipeline_state import load_ocr_script
+
+# --- CONFIGURATION ---
+DATA_DIR = "processed_data"
+KEY_FILE = "keys.txt"
+MODEL_NAME = "gemini-flash-latest"
+
+# Upload variants of each page, made just before a page is sent to Gemini.
+# The 150-dpi colour scans carry margins, paper colour and resolution that add nothing to a
+# transcription but cost upload time and image tokens. A variant is cached at
+#   processed_data/<collection>/<book>/upload/<profile>/page_NNN.jpg
+# and rebuilt only when the page image is newer than it.
+#
+# Pick a profile with:  python upload_variants.py --evaluate
+UPLOAD_PROFILES = {
+    "original": {},
+    "gray": {"grayscale": True},
+    "gray_crop": {"grayscale": True, "autocrop": True, "autocontrast": True},
+    "gray_crop_1536": {"grayscale": True, "autocrop": True, "autocontrast": True, "long_edge": 1536},
+    "gray_crop_1024": {"grayscale": True, "autocrop": True, "autocontrast": True, "long_edge": 1024},
+    "gray_crop_150kb": {"grayscale": True, "autocrop": True, "autocontrast": True, "max_bytes": 150_000},
+}
+DEFAULT_PROFILE = "original" # until --evaluate has shown a smaller profile is no worse
+UPLOAD_QUALITY = 85
+CROP_THRESHOLD = 40 # grey levels a pixel must differ from the scan border to count as content
+CROP_PADDING = 0.02 # keep this fraction of the page around the detected content
+MIN_LONG_EDGE = 1024 # a byte budget never shrinks a page below this; past it the smallest attempt is sent
+
+def autocrop_box(gray):
+    """
+    Box (left, top, right, bottom) that crops away the scan border. The border colour is taken
+    from the outermost pixels; anything clearly different from it (the page on a dark scanner
+    bed, or the print on blank margins) is content. A little padding is kept so nothing at the
+    edge of the text is lost.
+    """
+    small = gray.copy()
+    small.thumbnail((400, 400))
+    w, h = small.size
+    border = [small.getpixel((x, 0)) for x in range(w)] + [small.getpixel((x, h - 1)) for x in range(w)]
+    border += [small.getpixel((0, y)) for y in range(h)] + [small.getpixel((w - 1, y)) for y in range(h)]
+    background = sorted(border)[len(border) // 2]
+
+    mask = small.point(lambda v: 255 if abs(v - background) > CROP_THRESHOLD else 0)
+    box = mask.getbbox()
+    if box is None:
+        return (0, 0, gray.width, gray.height)
+
+    scale_x, scale_y = gray.width / w, gray.height / h
+    pad_x, pad_y = gray.width * CROP_PADDING, gray.height * CROP_PADDING
+    left = max(0, int(box[0] * scale_x - pad_x))
+    top = max(0, int(box[1] * scale_y - pad_y))
+    right = min(gray.width, int(box[2] * scale_x + pad_x))
+    bottom = min(gray.height, int(box[3] * scale_y + pad_y))
+    # Never crop a page down to a sliver because of one speck
+    if (right - left) * (bottom - top) < 0.25 * gray.width * gray.height:
+        return (0, 0, gray.width, gray.height)
+    return (left, top, right, bottom)
+
+def encode_jpeg(im, quality):
+    buffer = io.BytesIO()
+    im.save(buffer, "JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def build_variant(img_path, settings):
+    # Returns the JPEG bytes of the upload variant
+    with Image.open(img_path) as src:
+        im = src.convert("L") if settings.get("grayscale") else src.convert("RGB")
+
+    if settings.get("autocrop"):
+        im = im.crop(autocrop_box(im if im.mode == "L" else im.convert("L")))
+    if settings.get("autocontrast"):
+        im = ImageOps.autocontrast(im, cutoff=1)
+    if settings.get("long_edge") and max(im.size) > settings["long_edge"]:
+        im.thumbnail((settings["long_edge"], settings["long_edge"]), Image.LANCZOS)
+
+    quality = settings.get("quality", UPLOAD_QUALITY)
+    data = encode_jpeg(im, quality)
+    max_bytes = settings.get("max_bytes")
+    # Byte budget: drop quality first, then resolution down to MIN_LONG_EDGE
+    while max_bytes and len(data) > max_bytes:
+        if quality > 50:
+            quality -= 10
+        elif max(im.size) > MIN_LONG_EDGE:
+            scale = max(0.85, MIN_LONG_EDGE / max(im.size))
+            im = im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))), Image.LANCZOS)
+        else:
+            break # still over budget, but any smaller would not be readable
+        data = encode_jpeg(im, quality)
+    return data
+
+def variant_path(img_path, profile):
+    # processed_data/IPG/1869/images/page_001.jpg -> processed_data/IPG/1869/upload/<profile>/page_001.jpg
+    img_dir, filename = os.path.split(img_path)
+    book_dir = os.path.dirname(img_dir)
+    return os.path.join(book_dir, "upload", profile, filename.rsplit('.', 1)[0] + ".jpg")
+
+def upload_image(img_path, profile=DEFAULT_PROFILE):
+    """
+    Path of the image to send for this page. Builds (or refreshes) the cached variant if needed.
+    """
+    settings = UPLOAD_PROFILES[profile]
+    if not settings:
+        return img_path
+
+    out_path = variant_path(img_path, profile)
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(img_path):
+        return out_path
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    data = build_variant(img_path, settings)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def load_text_prompt():
+    return load_ocr_script().TEXT_PROMPT
+
+def evaluate(sample_size=12, profiles=None, seed=1869):
+    """
+    Transcribes a sample of already-transcribed pages with each profile and compares the result
+    with the existing texts/*.txt (made from the full colour scan). Prints upload size, latency
+    and agreement per profile. Responses are not cached here, so the latencies are real.
+    """
+    from gemini_engine import image_part, make_client
+    from rate_limit import load_key_specs
+
+    pages = []
+    for col_name in sorted(os.listdir(DATA_DIR)):
+        col_path = os.path.join(DATA_DIR, col_name)
+        if not os.path.isdir(col_path): continue
+        for book_id in sorted(os.listdir(col_path)):
+            txt_dir = os.path.join(col_path, book_id, "texts")
+            img_dir = os.path.join(col_path, book_id, "images")
+            if not os.path.isdir(txt_dir) or not os.path.isdir(img_dir): continue
+            for file in os.listdir(txt_dir):
+                txt_path = os.path.join(txt_dir, file)
+                img_path = os.path.join(img_dir, file.replace(".txt", ".jpg"))
+                if file.endswith(".txt") and os.path.getsize(txt_path) > 0 and os.path.exists(img_path):
+                    pages.append((img_path, txt_path))
+
+    if not pages:
+        print("No transcribed pages to compare against.")
+        return
+
+    random.Random(seed).shuffle(pages)
+    pages = pages[:sample_size]
+    client = make_client(load_key_specs(KEY_FILE)[0][0])
+    prompt = load_text_prompt()
+    profiles = profiles or list(UPLOAD_PROFILES)
+
+    print(f"Evaluating {len(profiles)} profiles on {len(pages)} pages...\n")
+    print(f"   {'profile':<18} {'avg KB':>8} {'avg latency':>12} {'agreement':>10}")
+    for profile in profiles:
+        sizes, latencies, agreements = [], [], []
+        for img_path, txt_path in pages:
+            upload_path = upload_image(img_path, profile)
+            sizes.append(os.path.getsize(upload_path))
+            with open(txt_path, "r", encoding="utf-8") as f:
+                reference = f.read()
+            start = time.monotonic()
+            try:
+                response = client.models.generate_content(model=MODEL_NAME, contents=[image_part(upload_path), prompt])
+            except Exception as e:
+                print(f"   {profile}: error on {img_path}: {e}")
+                time.sleep(4)
+                continue
+            latencies.append(time.monotonic() - start)
+            agreements.append(difflib.SequenceMatcher(None, reference, response.text or "", autojunk=False).ratio())
+            time.sleep(4) # Rate limit safety
+
+        if latencies:
+            print(f"   {profile:<18} {sum(sizes) / len(sizes) / 1024:>8.0f} {sum(latencies) / len(latencies):>11.1f}s "
+                  f"{sum(agreements) / len(agreements):>10.1%}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or evaluate upload variants of the page images")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=sorted(UPLOAD_PROFILES))
+    parser.add_argument("--evaluate", action="store_true", help="Compare every profile on a sample of transcribed pages")
+    parser.add_argument("--pages", type=int, default=12, help="Sample size for --evaluate")
+    args = parser.parse_args()
+
+    if args.evaluate:
+        evaluate(args.pages)
+    else:
+        count = 0
+        for col_name in sorted(os.listdir(DATA_DIR)):
+            col_path = os.path.join(DATA_DIR, col_name)
+            if not os.path.isdir(col_path): continue
+            for book_id in sorted(os.listdir(col_path)):
+                img_dir = os.path.join(col_path, book_id, "images")
+                if not os.path.isdir(img_dir): continue
+                for file in sorted(os.listdir(img_dir)):
+                    if file.lower().endswith((".jpg", ".png")):
+                        upload_image(os.path.join(img_dir, file), args.profile)
+                        count += 1
+        print(f"Built {args.profile} variants for {count} pages.")